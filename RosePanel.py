@@ -1,10 +1,18 @@
 from toolbox.permissions import permissions as perms
-from toolbox.storage import var, settings_path, dt
-from toolbox.accounts import user_account
+from toolbox.storage import var, settings_path, serializers, dt
+from toolbox.accounts import user_account, accounts
+from toolbox.account_index import account_index
+from toolbox.records import account_record
+from toolbox.passwords import passwords
+from toolbox.sessions import session_expiry, signed_tokens, log_token_changes
+from toolbox.sampler import resource_sampler
 from toolbox.pylog import pylog, logman
 from toolbox.webserver import webserver
 from difflib import get_close_matches
+from toolbox.sqlstore import sqlstore
+from toolbox.shards import shards, sharded_tables, _list_shards
 from toolbox.RoseApi import rose_api
+from toolbox.registry import server_registry, server_dirs, registry_path
 from toolbox.thorns import thorns
 from toolbox.errors import error
 import multiprocessing
@@ -12,7 +20,6 @@ import platform
 import datetime
 import dotenv
 import random
-import json
 import time
 import os
 
@@ -40,14 +47,22 @@ cmds_dict = {
         'msg': "Manage the panel.",
         'args': ['stop', 'start'],
     },
+    "accounts": {
+        'msg': "Manage accounts.",
+        'args': ['import'],
+    },
     "sessions": {
         'msg': "Manage active sessions.",
-        'args': ['list'],
+        'args': ['list', 'expiry'],
     },
     "server": {
         'msg': "Manage and interact with servers.",
         'args': ['create', 'delete', 'list', 'start', 'stop'],
     },
+    "storage": {
+        'msg': "Manage how the panel's data is stored.",
+        'args': ['migrate', 'convert'],
+    },
 }
 
 colours = {
@@ -86,9 +101,10 @@ class rose:
                 if not executing_similar[0]:
                     print("Welcome to the RosePanel CLI.")
                     print("Type 'help' for a list of commands.")
-                    cmd = input(f"{colours['green']}RosePanel{colours['reset']}> ").lower()
-                    args = cmd.split(" ")[1:]
-                    cmd = cmd.split(" ")[0]
+                    cmd = input(f"{colours['green']}RosePanel{colours['reset']}> ")
+                    # Only the command and sub-command are case-insensitive, so things like file paths keep their case.
+                    args = [arg.lower() if index == 0 else arg for index, arg in enumerate(cmd.split(" ")[1:])]
+                    cmd = cmd.split(" ")[0].lower()
                 else:
                     cmd = executing_similar[1]
                     args = executing_similar[2]
@@ -98,7 +114,7 @@ class rose:
                     logging.debug(f'User input: {cmd}')
                     logging.debug(f'Arguments: {args}')
 
-                max_args_possible = 1 # No arguments implemented yet.
+                max_args_possible = 2
                 # If there are no args, pad the list with None.
                 if len(args) == 0:
                     args = [None] * max_args_possible
@@ -170,15 +186,12 @@ class rose:
                         run_success = True
 
                     root_email = var.get("root_email")
-                    root_user = dict(var.get(f'accounts//{root_email}'))
                     try:
-                        root_user = user_account(
-                            email_address=root_user.get('email_address', None),
-                            password=root_user.get('password', None)
-                        )
-                    except (error.AccountNotFound, error.InvalidCredentials) as err:
+                        # The CLI is already trusted, and only the password's hash is stored, so this doesn't log in.
+                        root_user = user_account.trusted(root_email)
+                    except error.AccountNotFound as err:
                         print(f"{colours['red']}Critical Error: {err}.{colours['reset']}")
-                        print(f"Does account '{root_user.get('email_address', 'Undefined')}' exist with a valid password?")
+                        print(f"Does account '{root_email}' exist?")
                         continue
 
                     if args[0] == 'create':
@@ -360,10 +373,9 @@ class rose:
 
                                 target_server = thorns.get_idtype_target(target_server, 'suid')
 
-                                cmd_pipe = root_user.start_server(identifier=target_server)
+                                process_pid = root_user.start_server(identifier=target_server)
                                 # Save to shared dict for API and other places to access.
-                                shared_dict[target_server] = {}
-                                shared_dict[target_server]['cmd_pipe'] = cmd_pipe
+                                shared_dict[target_server] = {'process_pid': process_pid}
 
                                 run_success = True
                                 break
@@ -371,14 +383,51 @@ class rose:
                                 print(f"{colours['yellow']}No servers found. Please create a server first using 'server create'{colours['reset']}")
                                 run_success = True
                                 break
+                elif cmd == 'accounts':
+                    if args[0] is None:
+                        print('Invalid usage. Usage: accounts <command>')
+                        print('Commands')
+                        print('- accounts import <file.csv|file.jsonl>')
+                        run_success = True
+                    elif args[0] == 'import':
+                        run_success = True
+                        import_file = args[1] if len(args) > 1 else None
+                        if import_file is None or not os.path.isfile(import_file):
+                            print('Invalid usage. Usage: accounts import <file.csv|file.jsonl>')
+                            print('CSV files need a header row of: email_address,password,permissions')
+                            continue
+
+                        rows, unreadable = accounts.read_import(import_file)
+                        print(f"Importing {len(rows)} account(s)...")
+                        result = accounts.bulk_create(rows, causes_email='RosePanel')
+
+                        for message in unreadable:
+                            print(f"{colours['red']}{message}{colours['reset']}")
+                        for row_error in result['errors']:
+                            print(f"{colours['red']}Row {row_error['row'] + 1} ({row_error['email_address']}): {row_error['error']}{colours['reset']}")
+                        print(f"{colours['green']}Created {len(result['created'])} account(s).{colours['reset']}")
                 elif cmd == 'sessions':
-                    if len(args) == 0:
+                    if args[0] is None:
                         print('Invalid usage. Usage: sessions <command>')
                         print('Commands')
                         print('- sessions list')
+                        print('- sessions expiry')
+                        run_success = True
+                    elif args[0] == 'expiry':
+                        stats = shared_dict.get('session_expiry')
+                        if stats is None:
+                            print("The session sweeper has not reported in yet.")
+                            run_success = True
+                            continue
+
+                        print(f"Sessions waiting to expire: {stats['queue_depth']}")
+                        if stats['next_expiry'] is not None:
+                            print(f"Next expiry: {datetime.datetime.fromtimestamp(stats['next_expiry'])}")
+                        print(f"Expired so far: {stats['expired_total']} over {stats['sweeps']} sweep(s)")
+                        print(f"Sweep lag: {stats['last_lag']:.3f}s (worst {stats['max_lag']:.3f}s)")
                         run_success = True
                     elif args[0] == 'list':
-                        sessions = dict(var.get('tokens'))
+                        sessions = var.fields('tokens', ['belongs_to', 'expire_on'])
                         if sessions == {}:
                             print("No sessions found.")
                             continue
@@ -395,6 +444,61 @@ class rose:
                         # Wraps up the session in the appropriate formatting.
                         print("=========================")
                         run_success = True
+                elif cmd == 'storage':
+                    if args[0] is None:
+                        print('Invalid usage. Usage: storage <command>')
+                        print('Commands')
+                        print('- storage migrate')
+                        print(f"- storage convert <{'/'.join(serializers.formats)}>")
+                        run_success = True
+                    elif args[0] == 'migrate':
+                        if str(os.environ.get('STORAGE_ENGINE', 'json')).lower() != 'sqlite':
+                            if str(os.environ.get('STORAGE_LAYOUT', 'single')).lower() == 'sharded':
+                                moved_count = shards.migrate(settings_path)
+                                print(f"{colours['green']}Moved {moved_count} account(s) and token(s) into shards.{colours['reset']}")
+                                run_success = True
+                                continue
+
+                            # Migrating while still on JSON files would leave the panel looking at empty files.
+                            print(f"{colours['yellow']}Set STORAGE_ENGINE=sqlite or STORAGE_LAYOUT=sharded in secrets.env and restart before migrating.{colours['reset']}")
+                            run_success = True
+                            continue
+
+                        files = [settings_path, registry_path]
+                        for server_id in server_dirs():
+                            files.append(f'servers/{server_id}/config.json')
+
+                        migrated_count = 0
+                        for file in files:
+                            if sqlstore.migrate(file) is True:
+                                migrated_count += 1
+                        print(f"{colours['green']}Migrated {migrated_count} file(s) into sqlite.{colours['reset']}")
+                        run_success = True
+                    elif args[0] == 'convert':
+                        run_success = True
+                        format = args[1].lower() if len(args) > 1 and args[1] is not None else None
+                        if format not in serializers.formats:
+                            print(f"Invalid usage. Usage: storage convert <{'/'.join(serializers.formats)}>")
+                            continue
+                        if str(os.environ.get('STORAGE_ENGINE', 'json')).lower() == 'sqlite':
+                            print(f"{colours['yellow']}The sqlite engine does not use JSON files, so there is nothing to convert.{colours['reset']}")
+                            continue
+
+                        files = [settings_path]
+                        for table in sharded_tables:
+                            files += _list_shards(settings_path, table)
+                        files.append(registry_path)
+                        for server_id in server_dirs():
+                            files.append(f'servers/{server_id}/config.json')
+
+                        converted_count = 0
+                        for file in files:
+                            if os.path.exists(file) and var.convert(file=file, format=format) is True:
+                                converted_count += 1
+                        # So anything this process writes from now on stays in the new format.
+                        os.environ['STORAGE_FORMAT'] = format
+                        print(f"{colours['green']}Converted {converted_count} file(s) to the {format} format.{colours['reset']}")
+                        print(f"{colours['yellow']}Set STORAGE_FORMAT={format} in secrets.env so the files stay in this format after a restart.{colours['reset']}")
                 elif cmd in ["uwu", 'owo']: # lol
                     print("owo" if cmd == "uwu" else "owo")
                     time.sleep(1)
@@ -525,14 +629,15 @@ class rose:
                     continue
 
         if os.environ.get('CLEAR_SESSIONS_ON_EXIT', True):
-            # Clear the sessions.
-            accounts_dict = dict(var.get('accounts'))
-            for user in accounts_dict:
-                accounts_dict[user]['current_session'] = None
-            # Save the changes.
-            var.set(f'accounts', accounts_dict, file=settings_path)
-            # Clear the tokens.
-            var.set('tokens', {}, file=settings_path)
+            # Clear the sessions, and the tokens, in one write.
+            with var.transaction(file=settings_path) as tx:
+                for user, account in var.fields('accounts', ['current_session']).items():
+                    if account.get('current_session') is not None:
+                        tx.set(f'accounts//{user}//current_session', None)
+                tx.set('tokens', {})
+                log_token_changes(tx, None)
+            if signed_tokens.enabled():
+                signed_tokens.revoke_all()
 
         print(f"{colours['green']}Thank you. Goodbye!{colours['reset']}")
 
@@ -577,45 +682,17 @@ class rose:
                 print(f"- {cmd}: {desc['msg']}\n{args_msg}")
             return cmds_dict
 
-    def session_token_killer():
+    def session_token_killer(shared=None):
         '''
         Intended to be ran in a thread.
-        Looks over sessions for their expiry date and deletes them if they are expired.
-        '''
-        old_sessions = None
-
-        while True:
-            # Get all the sessions
-            sessions = dict(var.get('tokens'))
-            try:
-                for token in sessions.keys():
-                    session = sessions[token]
-                    if session['expire_on'] < datetime.datetime.now().timestamp():
-                        del sessions[token]
-                        session_owner = session['belongs_to']
-                        var.set(f'accounts//{session_owner}//current_session', None, file=settings_path)
-                        var.delete(f'tokens//{token}', file=settings_path)
-            except RuntimeError: # Handles the dictionary changing size during iteration.
-                continue
-            except KeyboardInterrupt:
-                break
+        Deletes sessions as they expire. See sessions.session_expiry.
 
-            # Do it all at once to prevent spamming the disk.
-            try:
-                var.set(f'tokens', sessions, file=settings_path)
-            except json.JSONDecodeError:
-                # If the file is empty, we can't decode it. So we just skip it.
-                continue
-
-            try:
-                old_same = old_sessions == sessions
-                time.sleep(15 if not old_same else 30) # If the sessions haven't changed, sleep for 60 seconds.
-
-                # Buffers the old sessions from changing so that the wait time isnt longer if the sessions are changing.
-                if not old_same and random.choice([True, False]):
-                    old_sessions = sessions
-            except KeyboardInterrupt:
-                break
+        :param shared: The shared dict to publish the sweeper's stats into.
+        '''
+        try:
+            session_expiry.run(shared=shared)
+        except KeyboardInterrupt:
+            pass
         return True
 
     def find_similar(cmd:str, cmd_args:list, ask_to_execute=False) -> dict:
@@ -677,8 +754,7 @@ class rose:
 
         # Create the config file
         if not os.path.exists(settings_path):
-            with open(settings_path, 'w+') as f:
-                json.dump(dt.SETTINGS, f, indent=4)
+            var.fill_json(file=settings_path, data=dt.SETTINGS)
 
         print(f"{colours['reset']}We need to ask you some questions before we can continue.")
 
@@ -706,11 +782,12 @@ class rose:
             break
 
         # Create the first account
-        ROOT_USER = dt.ACCOUNT
-        ROOT_USER['email_address'] = email_address
-        ROOT_USER['password'] = admin_password
+        root_user = account_record(email_address=email_address, password=passwords.hash(admin_password))
 
-        var.set(f'accounts//{email_address}', ROOT_USER)
+        with var.transaction(file=settings_path) as tx:
+            tx.set(f'accounts//{email_address}', root_user.to_dict())
+            account_index.bump(tx)
+        account_index.add(email_address)
 
         # Gives root user root permissions
         perms.set(
@@ -742,6 +819,9 @@ if __name__ == "__main__":
     if var.get('first_start'):
         rose.welcome_cli()
 
+    # Catches servers added, changed or removed while the panel was off.
+    server_registry.rebuild()
+
     shared_dict = multiprocessing.Manager().dict()
 
     ROSE_GUI = multiprocessing.Process(
@@ -766,10 +846,18 @@ if __name__ == "__main__":
 
     SESSION_KILLER = multiprocessing.Process(
         target=rose.session_token_killer,
-        name="sessionkiller"
+        name="sessionkiller",
+        args=(shared_dict,)
     )
     SESSION_KILLER.start()
 
+    RESOURCE_SAMPLER = multiprocessing.Process(
+        target=resource_sampler.run,
+        name="resourcesampler",
+        args=(shared_dict,)
+    )
+    RESOURCE_SAMPLER.start()
+
     # Logs debug information for debugging problems with the program in support tickets/servers.
     logging.debug("Rose Panel and Pylog has started.")
     logging.debug(f"GUI Process ID: {ROSE_GUI.pid}")
@@ -0,0 +1,245 @@
+# Benchmarks the storage layer (var) and the things built directly on it (sessions, permissions).
+# Each size runs in its own process inside a temporary directory, so caches, import-time paths and logs
+# never leak between sizes or into the real panel directory.
+#
+# Usage: python benchmarks/bench_storage.py [--sizes 10,100,1000] [--iterations 200] [--output results.json]
+# Storage settings (engine, layout, journal, format) are taken from the environment unless passed in.
+import subprocess
+import statistics
+import tempfile
+import argparse
+import platform
+import datetime
+import random
+import json
+import time
+import sys
+import os
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_sizes = [10, 100, 1000, 10000, 100000]
+
+class benchmark:
+    def percentiles(latencies:list) -> dict:
+        '''
+        Summarises a list of latencies (in nanoseconds) in milliseconds.
+
+        :param latencies: The latency of each call.
+        :return: A dict of the count, percentiles, mean and throughput.
+        '''
+        ordered = sorted(latencies)
+
+        def pick(fraction):
+            return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))] / 1e6
+
+        total_seconds = sum(ordered) / 1e9
+        return {
+            'count': len(ordered),
+            'p50_ms': pick(0.50),
+            'p90_ms': pick(0.90),
+            'p99_ms': pick(0.99),
+            'max_ms': ordered[-1] / 1e6,
+            'mean_ms': statistics.fmean(ordered) / 1e6,
+            'ops_per_sec': len(ordered) / total_seconds if total_seconds > 0 else None,
+        }
+
+    def measure(call, iterations:int, max_seconds:float, setup=None) -> dict:
+        '''
+        Times a call over and over.
+
+        :param call: Takes the iteration number. Is what gets timed.
+        :param iterations: How many times to call it.
+        :param max_seconds: Stops early once this much time has been spent, so huge sizes don't run for hours.
+        :param setup: Takes the iteration number and is run before each call, untimed.
+        '''
+        latencies = []
+        started = time.monotonic()
+        for iteration in range(iterations):
+            if setup is not None:
+                setup(iteration)
+            before = time.perf_counter_ns()
+            call(iteration)
+            latencies.append(time.perf_counter_ns() - before)
+            if time.monotonic() - started > max_seconds:
+                break
+        return benchmark.percentiles(latencies)
+
+    def synthetic_settings(size:int, rng:random.Random) -> dict:
+        '''
+        Makes a settings file with size accounts and size tokens (one per account).
+        '''
+        from toolbox.permissions import permissions
+        from toolbox.storage import dt
+
+        settings = json.loads(json.dumps(dt.SETTINGS))
+        settings['first_start'] = False
+        # Otherwise sessions.new would just hand back the account's existing token after the first call.
+        settings['one_token_accounts'] = False
+        expire_on = (datetime.datetime.now() + datetime.timedelta(days=1)).timestamp()
+
+        for number in range(size):
+            email = f'user{number}@bench.local'
+            token = f'bench{rng.getrandbits(256):064x}'
+            account = json.loads(json.dumps(dt.ACCOUNT))
+            account['email_address'] = email
+            account['password'] = f'{rng.getrandbits(128):032x}'
+            account['current_session'] = token
+            # Every permission but Administrator, so require() checks each one instead of returning early.
+            account['permissions'] = sum(permissions.dict) & ~permissions.ADMINISTRATOR
+            settings['accounts'][email] = account
+            settings['tokens'][token] = {
+                'expire_on': expire_on,
+                'belongs_to': email,
+            }
+        return settings
+
+    def run_size(size:int, iterations:int, max_seconds:float, seed:int) -> dict:
+        '''
+        Runs every operation against a settings file of the given size. Must be run from an empty directory,
+        as the panel keeps its files relative to the working directory.
+        '''
+        sys.path.insert(0, repo_root)
+        from toolbox.storage import var, settings_path
+        from toolbox.permissions import permissions
+        from toolbox.sessions import sessions
+
+        rng = random.Random(seed)
+        settings = benchmark.synthetic_settings(size, rng)
+        emails = list(settings['accounts'].keys())
+        tokens = list(settings['tokens'].keys())
+        # The same random picks for every size and run, so results can be compared.
+        picks = [rng.randrange(size) for _ in range(iterations)]
+
+        before = time.perf_counter_ns()
+        var.fill_json(file=settings_path, data=settings)
+        fill_ms = (time.perf_counter_ns() - before) / 1e6
+        del settings
+
+        results = {}
+        results['var.get'] = benchmark.measure(
+            lambda i: var.get(f'accounts//{emails[picks[i]]}//current_session', file=settings_path),
+            iterations, max_seconds
+        )
+        results['var.set'] = benchmark.measure(
+            lambda i: var.set(f'accounts//{emails[picks[i]]}//password', f'changed{i}', file=settings_path),
+            iterations, max_seconds
+        )
+        results['var.delete'] = benchmark.measure(
+            lambda i: var.delete(f'tokens//{tokens[picks[i]]}//scratch', file=settings_path),
+            iterations, max_seconds,
+            setup=lambda i: var.set(f'tokens//{tokens[picks[i]]}//scratch', {}, file=settings_path),
+        )
+        # Cold, so this is the cost of reading everything back off the disk.
+        results['var.load_all'] = benchmark.measure(
+            lambda i: var.load_all(file=settings_path),
+            iterations, max_seconds,
+            setup=lambda i: var.clear_cache(),
+        )
+        results['sessions.new'] = benchmark.measure(
+            lambda i: sessions.new(emails[picks[i]]),
+            iterations, max_seconds
+        )
+        checked_perms = [value for value in permissions.dict if value != permissions.ADMINISTRATOR]
+        results['permissions.require'] = benchmark.measure(
+            lambda i: permissions.require(checked_perms, emails[picks[i]]),
+            iterations, max_seconds
+        )
+
+        disk_bytes = 0
+        for root, dirs, files in os.walk(os.getcwd()):
+            # The log queue is not part of what was stored.
+            dirs[:] = [name for name in dirs if name != 'logs']
+            for name in files:
+                disk_bytes += os.path.getsize(os.path.join(root, name))
+
+        return {
+            'size': size,
+            'fill_ms': fill_ms,
+            'disk_bytes': disk_bytes,
+            'operations': results,
+        }
+
+    def storage_config() -> dict:
+        return {
+            'engine': os.environ.get('STORAGE_ENGINE', 'json'),
+            'layout': os.environ.get('STORAGE_LAYOUT', 'single'),
+            'journal': os.environ.get('STORAGE_JOURNAL', 'False'),
+            'format': os.environ.get('STORAGE_FORMAT', 'pretty'),
+        }
+
+    def git_commit() -> str:
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=repo_root, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def run(sizes:list, iterations:int, max_seconds:float, seed:int) -> dict:
+        '''
+        Runs each size in a fresh process and temporary directory, and collects the results.
+        '''
+        results = []
+        for size in sizes:
+            print(f"Benchmarking {size} accounts and tokens...", file=sys.stderr)
+            with tempfile.TemporaryDirectory(prefix='rose_bench_') as workdir:
+                result_path = os.path.join(workdir, 'result.json')
+                datadir = os.path.join(workdir, 'data')
+                os.makedirs(datadir)
+                subprocess.run([
+                    sys.executable, os.path.abspath(__file__), '--worker',
+                    '--sizes', str(size), '--iterations', str(iterations),
+                    '--max-seconds', str(max_seconds), '--seed', str(seed), '--output', result_path,
+                ], cwd=datadir, check=True)
+                with open(result_path, 'r') as f:
+                    results.append(json.load(f))
+
+        return {
+            'meta': {
+                'created': datetime.datetime.now().isoformat(),
+                'commit': benchmark.git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'iterations': iterations,
+                'max_seconds': max_seconds,
+                'seed': seed,
+                'storage': benchmark.storage_config(),
+            },
+            'results': results,
+        }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks RosePanel's storage layer against synthetic settings files.")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in default_sizes),
+                        help="Comma separated numbers of accounts (and tokens) to benchmark with.")
+    parser.add_argument('--iterations', type=int, default=200, help="How many times to run each operation.")
+    parser.add_argument('--max-seconds', type=float, default=10, help="Time limit per operation per size.")
+    parser.add_argument('--seed', type=int, default=1, help="Seed for the synthetic data and random picks.")
+    parser.add_argument('--output', default=None, help="Where to write the JSON results. Defaults to stdout.")
+    parser.add_argument('--engine', choices=['json', 'sqlite'], help="Overrides STORAGE_ENGINE.")
+    parser.add_argument('--layout', choices=['single', 'sharded'], help="Overrides STORAGE_LAYOUT.")
+    parser.add_argument('--journal', choices=['True', 'False'], help="Overrides STORAGE_JOURNAL.")
+    parser.add_argument('--format', choices=['pretty', 'compact', 'binary'], help="Overrides STORAGE_FORMAT.")
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    for option, variable in [('engine', 'STORAGE_ENGINE'), ('layout', 'STORAGE_LAYOUT'),
+                             ('journal', 'STORAGE_JOURNAL'), ('format', 'STORAGE_FORMAT')]:
+        if getattr(args, option) is not None:
+            os.environ[variable] = getattr(args, option)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip() != '']
+
+    if args.worker:
+        output = benchmark.run_size(sizes[0], args.iterations, args.max_seconds, args.seed)
+    else:
+        output = benchmark.run(sizes, args.iterations, args.max_seconds, args.seed)
+
+    if args.output is None:
+        print(json.dumps(output, indent=4))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
@@ -0,0 +1,10 @@
+# The toolbox keeps its files (settings.json, servers/, logs/) relative to the working directory, and some
+# modules fix those paths on import. So the tests run in a temporary directory, switched to before any of
+# them import the toolbox, and never touch the real panel directory.
+import tempfile
+import sys
+import os
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_root)
+os.chdir(tempfile.mkdtemp(prefix='rose_tests_'))
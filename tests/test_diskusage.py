@@ -0,0 +1,53 @@
+from toolbox import diskusage as diskusage_module
+from toolbox.diskusage import disk_usage
+import threading
+import os
+
+def _fake_server(monkeypatch, suid):
+    '''
+    A server whose registry entry the test can switch on and off, and whose stops are only counted.
+    '''
+    registry = {suid: {'online': True}}
+    stops = []
+    stopped = threading.Event()
+
+    def stop(tracked):
+        stops.append(tracked.suid)
+        registry[suid]['online'] = False
+        stopped.set()
+
+    monkeypatch.setattr(diskusage_module, 'quota_action', 'stop')
+    monkeypatch.setattr(diskusage_module.server_registry, 'owned_by', lambda email_address=None: registry)
+    monkeypatch.setattr(disk_usage, '_stop', stop)
+    return registry, stops, stopped
+
+def test_server_started_again_while_over_quota_is_stopped_again(monkeypatch):
+    suid = 'thorn_over_quota'
+    registry, stops, stopped = _fake_server(monkeypatch, suid)
+    os.makedirs(suid, exist_ok=True)
+    with open(os.path.join(suid, 'world.dat'), 'wb') as f:
+        f.write(b'x' * 64 * 1024)
+
+    disk_usage.track(suid, suid, quota=1024)
+    assert stopped.wait(5)
+    tracked = disk_usage.servers[suid]
+    assert tracked.over_quota is True
+
+    # Seen offline, then started again while still over its quota.
+    disk_usage._check_quota(tracked)
+    assert tracked.stopping is False
+    stopped.clear()
+    registry[suid]['online'] = True
+    disk_usage._check_quota(tracked)
+    assert stopped.wait(5)
+    assert stops == [suid, suid]
+
+    # Back under the quota, so starting it again is left alone.
+    disk_usage._check_quota(tracked)
+    os.remove(os.path.join(suid, 'world.dat'))
+    disk_usage._reconcile(tracked)
+    registry[suid]['online'] = True
+    disk_usage._check_quota(tracked)
+    assert tracked.over_quota is False
+    assert stops == [suid, suid]
+    disk_usage.untrack(suid)
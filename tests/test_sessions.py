@@ -0,0 +1,49 @@
+from toolbox.sessions import sessions, signed_tokens
+from toolbox.accounts import user_account
+from toolbox.security import settings_path
+from toolbox.storage import var
+import time
+
+def _signed_account(monkeypatch, email_address):
+    monkeypatch.setenv('SESSION_TOKENS', 'signed')
+    account = user_account(email_address, 'a password', is_registering=True)
+    return account, account.get_token()
+
+def test_signed_tokens_are_checked_without_the_settings_file(monkeypatch):
+    account, token = _signed_account(monkeypatch, 'stateless@x.y')
+    assert not var.exists(f'tokens//{token}', file=settings_path)
+    # Loaded once per process, like the token index.
+    assert sessions.validate(token) is True
+
+    def no_reads(*args, **kwargs):
+        raise AssertionError("The settings file was read.")
+    monkeypatch.setattr(var, 'get', no_reads)
+    monkeypatch.setattr(var, 'exists', no_reads)
+    monkeypatch.setattr(var, 'load_all', no_reads)
+    entry = sessions.lookup(token)
+    assert entry.email_address == 'stateless@x.y'
+    assert entry.permissions == 0
+
+def test_signed_tokens_end_like_random_ones(monkeypatch):
+    account, token = _signed_account(monkeypatch, 'ends@x.y')
+    payload, signature = token.split('.')
+    assert sessions.validate(f'{payload}.{signature[:-2]}AA') is False
+
+    assert user_account(token=token).logout() is True
+    assert sessions.validate(token) is False
+
+    token = account.get_token()
+    signed_tokens.revoke_all()
+    assert sessions.validate(token) is False
+    time.sleep(0.01)
+    token = account.get_token()
+    assert sessions.validate(token) is True
+
+    account.delete()
+    assert sessions.validate(token) is False
+
+    monkeypatch.setenv('SESSION_TOKENS', 'random')
+    other, _ = _signed_account(monkeypatch, 'switched@x.y')
+    token = other.get_token()
+    monkeypatch.setenv('SESSION_TOKENS', 'random')
+    assert sessions.validate(token) is False
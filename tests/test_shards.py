@@ -0,0 +1,35 @@
+from toolbox.storage import var
+from toolbox.security import settings_path
+
+def test_whole_table_get_does_not_share_the_cache(monkeypatch):
+    monkeypatch.setenv('STORAGE_LAYOUT', 'sharded')
+    var.set('accounts//shared@x.y', {'email_address': 'shared@x.y', 'permissions': 1}, file=settings_path)
+
+    accounts = var.get('accounts', file=settings_path)
+    accounts['shared@x.y']['permissions'] = 'MUTATED'
+    with var.transaction(file=settings_path) as tx:
+        tx.get('accounts')['shared@x.y']['permissions'] = 'MUTATED'
+
+    assert var.get('accounts', file=settings_path)['shared@x.y']['permissions'] == 1
+    assert var.get('accounts//shared@x.y//permissions', file=settings_path) == 1
+    assert var.load_all(file=settings_path)['accounts']['shared@x.y']['permissions'] == 1
+
+def test_transaction_table_get_leaves_out_deleted_records(monkeypatch):
+    monkeypatch.setenv('STORAGE_LAYOUT', 'sharded')
+    var.set('accounts//kept@x.y', {'email_address': 'kept@x.y'}, file=settings_path)
+    var.set('accounts//deleted@x.y', {'email_address': 'deleted@x.y'}, file=settings_path)
+
+    with var.transaction(file=settings_path) as tx:
+        tx.delete('accounts//deleted@x.y')
+        tx.set('tokens//shard_token', {'belongs_to': 'kept@x.y'})
+        accounts = tx.get('accounts')
+        assert 'deleted@x.y' not in accounts
+        assert 'kept@x.y' in accounts
+        assert 'shard_token' not in accounts
+
+def test_fields_reads_every_shard(monkeypatch):
+    monkeypatch.setenv('STORAGE_LAYOUT', 'sharded')
+    var.set('tokens//fields_token', {'belongs_to': 'fields@x.y', 'expire_on': 2.0}, file=settings_path)
+
+    tokens = var.fields('tokens', ['belongs_to'], file=settings_path)
+    assert tokens['fields_token'] == {'belongs_to': 'fields@x.y'}
@@ -0,0 +1,48 @@
+from toolbox.storage import var, serializers, _read_document
+from toolbox.sqlstore import database_path
+import os
+
+def test_migrate_to_sqlite_keeps_pending_journal(monkeypatch):
+    file = os.path.abspath('migrate_journal.json')
+    monkeypatch.setenv('STORAGE_JOURNAL', 'true')
+    var.set('accounts//before@x.y', {'email_address': 'before@x.y'}, file=file, dt_default={'accounts': {}})
+    var.set('accounts//journaled@x.y', {'email_address': 'journaled@x.y'}, file=file, dt_default={'accounts': {}})
+    # The writes are only in the journal, as it hasn't been compacted yet.
+    assert os.path.exists(file + '.journal')
+
+    monkeypatch.setenv('STORAGE_JOURNAL', 'false')
+    monkeypatch.setenv('STORAGE_ENGINE', 'sqlite')
+    assert sorted(var.get('accounts', file=file, dt_default=None)) == ['before@x.y', 'journaled@x.y']
+    assert os.path.exists(database_path(file))
+    assert not os.path.exists(file)
+    assert not os.path.exists(file + '.journal')
+    with open(file + '.migrated', 'rb') as f:
+        assert 'journaled@x.y' in serializers.loads(f.read())['accounts']
+
+def test_transaction_leaves_the_cached_document_alone(monkeypatch):
+    file = os.path.abspath('copy_on_write.json')
+    monkeypatch.setenv('STORAGE_JOURNAL', 'true')
+    var.set('accounts', {'a@x.y': {'permissions': 1}, 'b@x.y': {'permissions': 2}}, file=file, dt_default={})
+    before = _read_document(file)
+
+    with var.transaction(file=file, dt_default={}) as tx:
+        tx.set('accounts//a@x.y//permissions', 3)
+        tx.delete('accounts//b@x.y')
+        account = tx.get('accounts//a@x.y')
+        account['permissions'] = 'changed by the caller'
+
+    assert before['accounts'] == {'a@x.y': {'permissions': 1}, 'b@x.y': {'permissions': 2}}
+    assert var.get('accounts', file=file, dt_default={}) == {'a@x.y': {'permissions': 3}}
+
+def test_fields_reads_only_the_named_fields():
+    file = os.path.abspath('fields.json')
+    var.set('tokens', {
+        'a': {'belongs_to': 'a@x.y', 'expire_on': 1.0, 'extra': {'big': 1}},
+        'b': {'belongs_to': 'b@x.y'},
+        'c': 'not a record',
+    }, file=file, dt_default={})
+
+    tokens = var.fields('tokens', ['belongs_to', 'expire_on'], file=file)
+    assert tokens == {'a': {'belongs_to': 'a@x.y', 'expire_on': 1.0}, 'b': {'belongs_to': 'b@x.y'}}
+    assert var.fields('missing', ['belongs_to'], file=file) == {}
+    assert var.fields('tokens', ['belongs_to'], file='no_such_file.json') == {}
@@ -0,0 +1,44 @@
+from toolbox.storage import var, dt
+from toolbox.registry import server_registry
+from toolbox import thorns as thorns_module
+from toolbox.thorns import thorns, supervisor
+import os
+
+def _survives_everything(monkeypatch):
+    '''
+    Makes every PID look alive and ignore every signal, like a process that survives SIGKILL or a reused
+    PID that belongs to someone else.
+    '''
+    sent = []
+    monkeypatch.setattr(thorns_module, '_process_alive', lambda pid: True)
+    monkeypatch.setattr(thorns_module, 'stop_timeout', 0.01)
+    monkeypatch.setattr(thorns_module.os, 'killpg', lambda pid, sig: sent.append(sig))
+    return sent
+
+def test_stop_unowned_survivor_is_logged_not_raised(monkeypatch):
+    sent = _survives_everything(monkeypatch)
+    warnings = []
+    monkeypatch.setattr(thorns_module.logging, 'warning', warnings.append)
+
+    supervisor.stop_unowned('thorn_survivor', 999999, 2)
+
+    assert sent == [2, 2, 15, 9]
+    assert 'did not stop, even after SIGKILL' in warnings[-1]
+
+def test_stop_marks_a_surviving_server_offline(monkeypatch):
+    suid = 'thorn_survivor_offline'
+    config = f'servers/{suid}/config.json'
+    os.makedirs(f'servers/{suid}', exist_ok=True)
+    server = dict(dt.SERVER_INSTANCE, identifier='survivor', server_unique_id=suid, online=True, process_pid=999999)
+    var.fill_json(file=config, data=server)
+    server_registry.add(server)
+    _survives_everything(monkeypatch)
+    # Nothing in this process runs it, so it goes down the unowned path.
+    monkeypatch.setattr(supervisor, 'request_stop', lambda suid, server: False)
+
+    assert thorns.stop(suid, 'RosePanel') is True
+
+    saved = var.load_all(file=config, dt_default=dt.SERVER_INSTANCE)
+    assert saved['online'] is False
+    assert saved['process_pid'] is None
+    assert server_registry.owned_by()[suid]['online'] is False
@@ -1,12 +1,20 @@
 from toolbox.permissions import permissions
 from quart import request as quart_request
-from toolbox.accounts import user_account
+from toolbox.accounts import user_account, accounts, user_cache
+from toolbox.ratelimit import rate_limiter, limit
+from toolbox.account_index import normalize
+from toolbox.passwords import passwords
+from toolbox.audit import audit, actions as audit_actions
+from toolbox.sessions import sessions
 from toolbox.pylog import pylog, logman
 from toolbox.errors import error
 from toolbox.storage import var
+from toolbox.thorns import thorns
 from quart_cors import cors
 import multiprocessing
+import functools
 import datetime
+import asyncio
 import uvicorn
 import quart
 import os
@@ -24,6 +32,67 @@ port_number = var.get('api//port', 5005)
 app = quart.Quart(__name__)
 app = cors(app, allow_origin="*", allow_headers="*")
 
+def authenticated(handler):
+    '''
+    For routes that need a logged in user. Checks the request's token and puts its user_account in quart.g.user,
+    taken from user_cache so each request doesn't build the account from storage again.
+    '''
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        data = await quart_request.get_json()
+        token = data.get('token', None) if isinstance(data, dict) else None
+        if token is None:
+            return {
+                'message': 'Missing required fields.'
+            }, 400
+        quart.g.user = user_cache.get(token)
+        return await handler(*args, **kwargs)
+    return wrapper
+
+# Per route, how many requests a client IP and a single account (or token) may make. 'N/seconds', or 'off'.
+# Several tabs of the panel check the same token, so that limit is generous and kept per IP as well.
+rate_limits = {
+    'login': {
+        'ip': limit.from_env('RATE_LIMIT_LOGIN_IP', '20/60'),
+        'account': limit.from_env('RATE_LIMIT_LOGIN_ACCOUNT', '5/60'),
+    },
+    'validate_token': {
+        'ip': limit.from_env('RATE_LIMIT_VALIDATE_IP', '300/60'),
+        'account': limit.from_env('RATE_LIMIT_VALIDATE_TOKEN', '240/60'),
+    },
+}
+
+def rate_limited(route:str, account_field:str, account_key=str, per_ip:bool=False):
+    '''
+    Limits how often a route can be called, by client IP and by account, answering 429 with a Retry-After header
+    once a limit is hit. The buckets are in memory, so checking them is cheap and never reads the settings file.
+
+    :param route: The name of the route in rate_limits.
+    :param account_field: The field of the request's JSON that says which account it is for.
+    :param account_key: Turns that field into the account's bucket key.
+    :param per_ip: Keep a separate account bucket for each client IP, so one client using it up doesn't stop others.
+    '''
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            data = await quart_request.get_json()
+            account = data.get(account_field, None) if isinstance(data, dict) else None
+            account = account_key(account) if isinstance(account, str) else None
+            if per_ip and account is not None:
+                account = (quart_request.remote_addr, account)
+            identities = {
+                'ip': quart_request.remote_addr,
+                'account': account,
+            }
+            wait = rate_limiter.check(route, rate_limits[route], identities)
+            if wait > 0:
+                return {
+                    'message': 'Too many requests. Please try again later.'
+                }, 429, {'Retry-After': rate_limiter.retry_after(wait)}
+            return await handler(*args, **kwargs)
+        return wrapper
+    return decorator
+
 class error_handlers:
     # Class doesn't do much more than make errors not result in No Returns.
     # Also provides a string message for the error.
@@ -72,6 +141,18 @@ class error_handlers:
             'needed_perms': needed_permissions
         }, 401
 
+    @app.errorhandler(error.StorageLockTimeout)
+    def storage_busy(err):
+        return {
+            'message': 'The panel is busy. Please try again.'
+        }, 503
+
+    @app.errorhandler(thorns.errors.ServerDoesNotExist)
+    def server_not_found(err):
+        return {
+            'message': 'Server not found.'
+        }, 404
+
     @app.errorhandler(AssertionError)
     def assert_err(err):
         return {
@@ -124,6 +205,7 @@ class rose_api:
         }, 200
 
     @app.route("/api/validate_token", methods=["POST"])
+    @rate_limited('validate_token', 'token', per_ip=True)
     async def validate_token():
         post_data = await quart_request.get_json()
         token = post_data.get('token', None)
@@ -132,17 +214,14 @@ class rose_api:
                 'message': 'Missing required fields.'
             }, 400
 
-        try:
-            user = user_account(token=token, is_registering=False)
-        except:
-            return 'bad', 401
-
-        if user.current_session == token:
+        # Every open panel tab calls this every few seconds, so it is answered from the in-memory token index.
+        if sessions.validate(token) is True:
             return 'ok', 200
         else:
             return 'bad', 401
 
     @app.route("/api/login", methods=["POST"])
+    @rate_limited('login', 'email_address', normalize)
     async def login():
         post_data = await quart_request.get_json()
 
@@ -160,9 +239,11 @@ class rose_api:
                 'message': 'specify if the user is registering or logging in.'
             }, 400
 
-        # This also handles registration and login
+        # This also handles registration and login. Run on the password pool, as hashing would stall the event loop.
         try:
-            user = user_account(email_address=email_address, password=password, is_registering=is_registering)
+            user = await passwords.offload(
+                user_account, email_address=email_address, password=password, is_registering=is_registering
+            )
         except (error.InvalidCredentials, error.AccountNotFound, error.AccountAlreadyExists) as err:
             return {
                 'message': str(err)
@@ -176,24 +257,35 @@ class rose_api:
         }, 200
 
     @app.route("/api/servers/list", methods=["POST"])
+    @authenticated
     async def list_servers():
         data = await quart_request.get_json()
-        token = data.get('token', None)
         own_servers_only = data.get('own_servers_only', True)
         assert own_servers_only in [True, False], "own_servers_only must be a boolean."
 
-        user = user_account(token=token)
+        user = quart.g.user
         servers = user.list_servers(own_servers_only=own_servers_only)  # Await the async operation here
+
+        # The configs don't hold live resource use. The sampler publishes it into the shared dict instead.
+        sampled = (shared_dict.get('resources', None) if shared_dict is not None else None) or {}
+        sampled_servers = sampled.get('servers', {})
+        for server in servers.values():
+            usage = sampled_servers.get(server.get('server_unique_id'))
+            if usage is None:
+                continue
+            for resource in ['RAM', 'CPU', 'STORAGE']:
+                if resource in usage:
+                    server['resources'][resource]['used'] = usage[resource]['used']
         return {
             'servers': servers
         }, 200
 
     @app.route("/api/servers/create", methods=["POST"])
+    @authenticated
     async def create_server():
         data = await quart_request.get_json()
-        token = data.get('token', None)
 
-        user = user_account(token=token)
+        user = quart.g.user
         user.create_server(
             identifier=data.get('identifier', None),
             description=data.get('description', None),
@@ -207,16 +299,78 @@ class rose_api:
             'message': 'Server created successfully.'
         }, 200
 
-    @app.route("/api/accounts/permissions", methods=["POST"])
-    async def get_my_perms():
+    @app.route("/api/servers/console", methods=["POST"])
+    @authenticated
+    async def server_console():
+        data = await quart_request.get_json()
+        identifier = data.get('identifier', None)
+        lines = data.get('lines', 200)
+        since_offset = data.get('since_offset', None)
+        assert isinstance(identifier, str), "identifier must be a string."
+        assert isinstance(lines, int) and 0 < lines <= 5000, "lines must be between 1 and 5000."
+        assert since_offset is None or (isinstance(since_offset, int) and since_offset >= 0), \
+            "since_offset must be a positive integer."
+
+        user = quart.g.user
+        # Reads files, so kept off the event loop.
+        console = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(user.server_console, identifier, lines=lines, since_offset=since_offset)
+        )
+        return console, 200
+
+    @app.route("/api/accounts/bulk_create", methods=["POST"])
+    @authenticated
+    async def bulk_create_accounts():
         data = await quart_request.get_json()
-        token = data.get('token', None)
+        rows = data.get('accounts', None)
+        if rows is None:
+            return {
+                'message': 'Missing required fields.'
+            }, 400
+        assert isinstance(rows, list), "accounts must be a list."
+
+        user = quart.g.user
+        # Not on the password pool itself, as bulk_create spreads its hashing over that pool.
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(accounts.bulk_create, rows, causes_email=user.email_address)
+        )
+        return result, 200
 
-        user = user_account(token=token)
+    @app.route("/api/accounts/permissions", methods=["POST"])
+    @authenticated
+    async def get_my_perms():
+        user = quart.g.user
         return {
             'permissions': user.permissions
         }, 200
 
+    @app.route("/api/audit", methods=["POST"])
+    @authenticated
+    async def get_audit_log():
+        data = await quart_request.get_json()
+        user = quart.g.user
+
+        # Anyone can see what they did. Seeing what others did (or everyone, with an actor of null) needs Administrator.
+        actor = data.get('actor', user.email_address)
+        if actor != user.email_address:
+            permissions.require([permissions.ADMINISTRATOR], user.email_address)
+
+        start = data.get('start', None)
+        end = data.get('end', None)
+        action = data.get('action', None)
+        limit = data.get('limit', 100)
+        assert start is None or isinstance(start, (int, float)), "start must be a timestamp."
+        assert end is None or isinstance(end, (int, float)), "end must be a timestamp."
+        assert action is None or action in audit_actions, f"action must be one of {', '.join(audit_actions)}."
+        assert isinstance(limit, int) and 0 < limit <= 1000, "limit must be between 1 and 1000."
+
+        records = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(audit.query, start=start, end=end, actor=actor, action=action, limit=limit)
+        )
+        return {
+            'records': records
+        }, 200
+
 if __name__ == "__main__":
     LOGMAN_Thread = multiprocessing.Process(target=logman)
     LOGMAN_Thread.start()
@@ -0,0 +1,124 @@
+from toolbox.storage import var, settings_path, _sqlite_engine, _sharded_layout
+from toolbox.pylog import pylog
+import threading
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+def normalize(email_address:str) -> str:
+    '''
+    The form emails are compared in, so 'Someone@Example.com' and 'someone@example.com' are the same account.
+    '''
+    return str(email_address).strip().casefold()
+
+def location(email_address:str) -> str:
+    '''
+    Where an account's record is stored. The settings file, the account's shard, or the sqlite table.
+    '''
+    if _sqlite_engine() is not None:
+        from toolbox.sqlstore import database_path
+        return f'{database_path(settings_path)}#accounts'
+    if _sharded_layout(settings_path) is not None:
+        from toolbox.shards import shard_path
+        return shard_path(settings_path, 'accounts', email_address)
+    return os.path.abspath(settings_path)
+
+class account_index:
+    '''
+    An in-memory index of the accounts in the settings file, so checking an account exists (or finding it
+    by any capitalisation of its email) is a dict lookup instead of a read of the settings file.
+
+    Registering and deleting accounts update it directly, and bump 'accounts_version' in the settings file.
+    Other processes watch that key and rebuild their index from the account keys when it changes.
+    '''
+    # email -> where the record is stored
+    locations = {}
+    # normalized email -> email as stored
+    normalized = {}
+    loaded_pid = None
+    lock = threading.Lock()
+
+    def _ensure_loaded() -> None:
+        if account_index.loaded_pid == os.getpid():
+            return
+        with account_index.lock:
+            if account_index.loaded_pid == os.getpid():
+                return
+            # Watch first, so nothing that changes while we read is missed.
+            var.watch(settings_path, 'accounts_version', account_index._on_change)
+            account_index._rebuild()
+            account_index.loaded_pid = os.getpid()
+
+    def _rebuild() -> None:
+        locations = {}
+        normalized = {}
+        for email_address in var.keys('accounts', file=settings_path):
+            locations[email_address] = location(email_address)
+            normalized[normalize(email_address)] = email_address
+        account_index.locations = locations
+        account_index.normalized = normalized
+
+    def _on_change(key_prefix, version) -> None:
+        with account_index.lock:
+            account_index._rebuild()
+
+    def bump(tx) -> None:
+        '''
+        Marks that accounts were added or removed, so other processes rebuild their index.
+        Call with the transaction that adds or removes the account.
+        '''
+        tx.set('accounts_version', (tx.get('accounts_version') or 0) + 1)
+
+    def add(email_address:str) -> None:
+        if account_index.loaded_pid != os.getpid():
+            return
+        account_index.locations[email_address] = location(email_address)
+        account_index.normalized[normalize(email_address)] = email_address
+
+    def remove(email_address:str) -> None:
+        if account_index.loaded_pid != os.getpid():
+            return
+        account_index.locations.pop(email_address, None)
+        if account_index.normalized.get(normalize(email_address)) == email_address:
+            del account_index.normalized[normalize(email_address)]
+
+    def exists(email_address:str) -> bool:
+        '''
+        Checks if an account exists, by its email exactly as stored.
+        '''
+        account_index._ensure_loaded()
+        if email_address in account_index.locations:
+            return True
+        # It may have been registered by another process a moment ago, and the watch hasn't caught up yet.
+        if var.exists(f'accounts//{email_address}', file=settings_path):
+            account_index.add(email_address)
+            return True
+        return False
+
+    def resolve(email_address:str) -> str:
+        '''
+        Finds an account by its email in any capitalisation.
+
+        :return: The email as the account is stored under, or None if there is no such account.
+        '''
+        account_index._ensure_loaded()
+        if email_address in account_index.locations:
+            return email_address
+        stored = account_index.normalized.get(normalize(email_address))
+        if stored is not None:
+            return stored
+        if account_index.exists(email_address):
+            return email_address
+        return None
+
+    def find(email_address:str) -> str:
+        '''
+        :return: Where the account's record is stored, or None if there is no such account.
+        '''
+        stored = account_index.resolve(email_address)
+        if stored is None:
+            return None
+        return account_index.locations.get(stored) or location(stored)
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
@@ -1,14 +1,120 @@
 from toolbox.permissions import permissions as perms
-from toolbox.storage import var, settings_path, dt
+from toolbox.storage import var, settings_path
+from toolbox.account_index import account_index, normalize
+from toolbox.records import account_record
+from toolbox.passwords import passwords
+from toolbox.audit import audit
 from toolbox.security import sanitize
-from toolbox.sessions import sessions
+from toolbox.sessions import sessions, token_index, signed_tokens, log_token_changes
+from toolbox.registry import server_registry
 from toolbox.thorns import thorns
 from toolbox.errors import error
+from collections import OrderedDict
 from toolbox.pylog import pylog
+import threading
+import json
+import time
+import csv
 import os
 
 logging = pylog(filename='logs/rose_%TIMENOW%.log')
 
+class accounts:
+    def bulk_create(rows:list, causes_email:str) -> dict:
+        '''
+        Creates many accounts at once, all in one write. Rows that are not valid are skipped and reported,
+        and the rest are still created.
+
+        :param rows: A list of dicts with 'email_address', 'password' and optionally 'permissions'.
+        The permissions can be a mask or permission names, see permissions.parse_mask.
+        The password can be one already hashed by RosePanel, in which case it is stored as it is.
+        Otherwise it is sanitized like the password given when registering or logging in.
+        :param causes_email: The email address of the user doing this, or 'RosePanel' for the CLI.
+        :return: {'created': [emails], 'errors': [{'row': index, 'email_address': email, 'error': message}]}
+        '''
+        if causes_email != 'RosePanel':
+            perms.require([perms.MANAGE_PERMISSIONS], causes_email)
+
+        errors = []
+        valid = []
+        seen = set()
+        for index, row in enumerate(rows):
+            email_address = row.get('email_address') if isinstance(row, dict) else None
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError("Row must be an object with 'email_address' and 'password'.")
+                if not isinstance(email_address, str) or email_address.strip() == '':
+                    raise ValueError("Missing email_address.")
+                email_address = email_address.strip()
+                if sanitize(email_address) != email_address or '@' not in email_address:
+                    raise ValueError("Not a valid email address.")
+                password = row.get('password')
+                if not isinstance(password, str) or password == '':
+                    raise ValueError("Missing password.")
+                if not passwords.is_hashed(password):
+                    # Logging in sanitizes the password before checking it, so it is stored the same way registering does.
+                    password = sanitize(password)
+                    if password == '':
+                        raise ValueError("Password has no usable characters.")
+                permission_mask = perms.parse_mask(row.get('permissions'))
+                if normalize(email_address) in seen:
+                    raise ValueError("The same email address is in the import more than once.")
+                if account_index.resolve(email_address) is not None:
+                    raise ValueError("Account already exists.")
+            except ValueError as err:
+                errors.append({'row': index, 'email_address': email_address, 'error': str(err)})
+                continue
+
+            seen.add(normalize(email_address))
+            valid.append((index, email_address, password, permission_mask))
+
+        # Hashing is by far the slowest part, so it is spread over the password pool.
+        to_hash = [password for _, _, password, _ in valid if not passwords.is_hashed(password)]
+        hashed = iter(passwords.hash_many(to_hash))
+
+        created = []
+        with var.transaction(file=settings_path) as tx:
+            for index, email_address, password, permission_mask in valid:
+                if tx.get(f'accounts//{email_address}') is not None:
+                    # Registered by someone else since it was checked.
+                    errors.append({'row': index, 'email_address': email_address, 'error': "Account already exists."})
+                    continue
+                if not passwords.is_hashed(password):
+                    password = next(hashed)
+                account = account_record(email_address=email_address, password=password, permissions=permission_mask)
+                tx.set(f'accounts//{email_address}', account.to_dict())
+                created.append(email_address)
+            if len(created) != 0:
+                account_index.bump(tx)
+
+        for email_address in created:
+            account_index.add(email_address)
+        errors.sort(key=lambda row_error: row_error['row'])
+        logging.info(f"{causes_email} created {len(created)} accounts in bulk. {len(errors)} rows had errors.")
+        return {'created': created, 'errors': errors}
+
+    def read_import(file:str) -> tuple:
+        '''
+        Reads the rows of an account import file for bulk_create.
+        CSV files need a header row (email_address,password,permissions). Anything else is read as JSON lines.
+
+        :return: (the rows, a list of messages about lines that could not be read)
+        '''
+        with open(file, 'r', newline='', encoding='utf-8') as f:
+            if file.lower().endswith('.csv'):
+                return [dict(row) for row in csv.DictReader(f)], []
+
+            rows = []
+            unreadable = []
+            for line_number, line in enumerate(f, start=1):
+                if line.strip() == '':
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError as err:
+                    unreadable.append(f"Line {line_number} is not valid JSON: {err}")
+            return rows, unreadable
+
 class user_account:
     def __init__(self, email_address: str = None, password: str = None, token: str = None, is_registering=False):
         '''
@@ -25,14 +131,15 @@ class user_account:
         # If a token is provided, then we can skip the login process.
         if token is not None:
             token = sanitize(token)  # Sanitize the token incase it's been tampered with.
-            # Check if the account exists.
-            email_address = var.get(f"tokens//{token}//belongs_to")
-            if email_address is None:
-                raise error.AccountNotFound(email_address)
-            self.email_address = email_address
+            # Found the same way sessions.validate checks it, without touching the disk.
+            session = sessions.lookup(token)
+            if session is None:
+                raise error.AccountNotFound(None)
+            self.email_address = session.email_address
             self.current_session = token
-            self.password = var.get(f"accounts//{email_address}//password")
-            self.permissions = perms.load(email_address)
+            # Only the hash is stored, and nothing needs it once logged in.
+            self.password = None
+            self.permissions = perms.load(session.email_address)
             return
 
         # Makes sure input is safe.
@@ -55,36 +162,61 @@ class user_account:
             """
             if not is_registering:
                 # Essentially login code. Checks password and email are fine, which then makes getting a token easy.
+                # Check if the account exists. Emails match in any capitalisation.
+                stored_email = account_index.resolve(email_address)
+                if stored_email is None:
+                    raise error.AccountNotFound(email_address)
+                email_address = stored_email
                 self.email_address = email_address
                 self.current_session = None
                 self.password = password
                 self.permissions = perms.load(email_address)
-                # Check if the account exists.
-                try:
-                    var.get(f"accounts//{email_address}")
-                except KeyError:
-                    raise error.AccountNotFound(email_address)
 
                 saved_password = var.get(f"accounts//{email_address}//password")
                 # Check if the password is correct.
-                if password != saved_password or password is None:
+                if passwords.verify(password, saved_password) is not True:
+                    audit.record('login_failed', email_address)
                     raise error.InvalidCredentials(email_address, password)
+                # Upgrades plaintext passwords, and hashes made with an older algorithm or cost.
+                if passwords.needs_rehash(saved_password):
+                    var.set(f"accounts//{email_address}//password", passwords.hash(password), file=settings_path)
+                    logging.info(f"Rehashed the password of {email_address}")
                 break
             else:
-                # Checks if the account already exists.
-                if var.get(f"accounts//{email_address}") is not None:
+                # Checks if the account already exists, in any capitalisation.
+                if account_index.resolve(email_address) is not None:
                     raise error.AccountAlreadyExists(email_address)
                 # Register the account.
-                account = dt.ACCOUNT
-                account['password'] = password
-                account['email_address'] = email_address
-                var.set(f'accounts//{email_address}', account, file=settings_path)
+                account = account_record(password=passwords.hash(password), email_address=email_address)
+                with var.transaction(file=settings_path) as tx:
+                    tx.set(f'accounts//{email_address}', account.to_dict())
+                    account_index.bump(tx)
+                account_index.add(email_address)
+                audit.record('register', email_address)
                 is_registering = False
                 # User always starts with no permissions.
                 logging.info(f"Account {email_address} Created")
                 continue
+        audit.record('login', email_address)
         logging.info(f"Account {email_address} Logged In")
 
+    def trusted(email_address:str) -> 'user_account':
+        '''
+        Gets an account without logging in to it, for callers that are already trusted, such as the CLI acting as root.
+        Never call this with an email address a user gave without checking their password or token first.
+
+        :param email_address: The account's email, in any capitalisation.
+        '''
+        stored_email = account_index.resolve(email_address) if email_address is not None else None
+        if stored_email is None:
+            raise error.AccountNotFound(email_address)
+        account = user_account.__new__(user_account)
+        account.email_address = stored_email
+        account.current_session = var.get(f"accounts//{stored_email}//current_session")
+        account.password = var.get(f"accounts//{stored_email}//password")
+        account.permissions = perms.load(stored_email)
+        return account
+
     def get_token(self) -> bool:
         '''
         Attempts to login with the provided credentials.
@@ -97,18 +229,50 @@ class user_account:
 
         return token
 
+    def delete(self) -> bool:
+        '''
+        Deletes the account, and its current session if it has one.
+        '''
+        with var.transaction(file=settings_path) as tx:
+            token = tx.get(f"accounts//{self.email_address}//current_session")
+            if token is not None:
+                tx.delete(f"tokens//{token}")
+                log_token_changes(tx, [token])
+            if tx.delete(f"accounts//{self.email_address}") is not True:
+                raise error.AccountNotFound(self.email_address)
+            account_index.bump(tx)
+
+        account_index.remove(self.email_address)
+        perms.cache.pop(self.email_address, None)
+        if signed_tokens.enabled():
+            # Signed tokens aren't stored, so every one issued to the account so far is revoked instead.
+            signed_tokens.revoke_account(self.email_address)
+        if token is not None:
+            token_index.drop(token)
+            user_cache.invalidate(token)
+        self.current_session = None
+        audit.record('account_delete', self.email_address)
+        logging.info(f"Account {self.email_address} Deleted")
+        return True
+
     def logout(self) -> bool:
         '''
         Logs out the account with the specified token.
         '''
-        # Check if the account exists.
-        token = var.get(f"accounts//{self.email_address}//current_session")
+        if signed_tokens.is_signed(self.current_session):
+            # Signed tokens aren't stored, so it is the one this account was found with.
+            token = self.current_session
+        else:
+            # Check if the account exists.
+            token = var.get(f"accounts//{self.email_address}//current_session")
         if token is None:
             return False
 
         # Delete the token.
         sessions.delete(token)
+        user_cache.invalidate(token)
         self.current_session = None
+        audit.record('logout', self.email_address)
         logging.info(f"Account {self.email_address} Logged Out")
 
         return True
@@ -129,18 +293,11 @@ class user_account:
                 email_address=self.email_address
             )
 
-        server_list = os.listdir('servers')
+        # The registry says which servers to list and what they are called, so only those configs are opened.
+        owner = self.email_address if own_servers_only else None
         processed_server_list = {}
-        for server_id in server_list:
-            servers_data = var.load_all(file=f'servers/{server_id}/config.json')
-            if own_servers_only:
-                if servers_data['owner'] == self.email_address:
-                    server_name = thorns.get_idtype_target(server_id, 'name')
-                    processed_server_list[server_name] = servers_data
-                continue
-            else:
-                server_name = thorns.get_idtype_target(server_id, 'name')
-                processed_server_list[server_name] = servers_data
+        for server_id, entry in server_registry.owned_by(owner).items():
+            processed_server_list[entry['identifier']] = var.load_all(file=f'servers/{server_id}/config.json')
         '''
         NOTE: THis is an example of what the processed_server_list would look like.
         (Only some data only shown here. You'll find the full dict in storage.py > class DT > SERVER_INSTANCE)
@@ -198,3 +355,65 @@ class user_account:
     def stop_server(self, name_id):
         suid = thorns.get_idtype_target(name_id, 'suid')
         return thorns.stop(suid, self.email_address)
+
+    def server_console(self, identifier, lines:int=200, since_offset:int=None) -> dict:
+        '''
+        Gets a server's console output. See thorns.tail. Needs 'List any server' for servers the user doesn't own.
+        '''
+        suid = thorns.get_idtype_target(identifier, 'suid')
+        if suid is None:
+            raise thorns.errors.ServerDoesNotExist(f"Server '{identifier}' does not exist.")
+        entry = server_registry.owned_by().get(suid)
+        if entry is None or entry['owner'] != self.email_address:
+            perms.require([perms.LIST_OTHERS_SERVERS], email_address=self.email_address)
+        return thorns.tail(suid, lines=lines, since_offset=since_offset)
+
+class user_cache:
+    '''
+    A small LRU cache of the user_account made for each token, so a burst of API requests from the same
+    browser doesn't build the same account from storage over and over. Entries last USER_CACHE_TTL seconds,
+    and are thrown away early if the token stops being valid (logout, expiry) or the account's permissions change.
+    '''
+    max_size = 512
+    entries = OrderedDict()
+    lock = threading.Lock()
+
+    def ttl() -> float:
+        return float(os.environ.get('USER_CACHE_TTL', 5))
+
+    def get(token:str) -> user_account:
+        '''
+        Returns the user_account for a token.
+        Raises error.InvalidToken if the token does not exist or has expired.
+        '''
+        # Cheap (in memory), and is what notices logouts and expiry, even ones made by other processes.
+        if sessions.validate(token) is not True:
+            user_cache.invalidate(token)
+            raise error.InvalidToken(token)
+
+        now = time.monotonic()
+        with user_cache.lock:
+            entry = user_cache.entries.get(token)
+        if entry is not None:
+            user, expires_at, permission_mask = entry
+            if expires_at > now and perms.mask(user.email_address) == permission_mask:
+                with user_cache.lock:
+                    if token in user_cache.entries:
+                        user_cache.entries.move_to_end(token)
+                return user
+
+        try:
+            user = user_account(token=token)
+        except error.AccountNotFound:
+            raise error.InvalidToken(token)
+
+        with user_cache.lock:
+            user_cache.entries[token] = (user, now + user_cache.ttl(), perms.mask(user.email_address))
+            user_cache.entries.move_to_end(token)
+            while len(user_cache.entries) > user_cache.max_size:
+                user_cache.entries.popitem(last=False)
+        return user
+
+    def invalidate(token:str) -> None:
+        with user_cache.lock:
+            user_cache.entries.pop(token, None)
@@ -0,0 +1,219 @@
+from toolbox.storage import file_lock
+from toolbox.pylog import pylog
+import threading
+import bisect
+import struct
+import time
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+audit_dir = 'audit'
+
+# The actions that can be recorded. A record stores the action's position in this tuple, so only ever add to the end.
+actions = (
+    'login',
+    'login_failed',
+    'register',
+    'logout',
+    'account_delete',
+    'server_create',
+    'server_delete',
+    'server_start',
+    'server_stop',
+    'permission_change',
+)
+
+# time, action, who did it, what it was done to. Every record is the same size, so the n'th one is at n * size.
+record_struct = struct.Struct('<dB7x128s128s')
+# time, record number. One for every index_every records of a segment.
+index_struct = struct.Struct('<dQ')
+index_every = 64
+# How many records to read from a segment at once.
+read_chunk = 256
+
+def _pack_text(text) -> bytes:
+    if text is None:
+        return b''
+    encoded = str(text).encode()
+    if len(encoded) > 128:
+        encoded = encoded[:128]
+    return encoded
+
+def _unpack_text(raw:bytes) -> str:
+    # A cut off multi-byte character is dropped rather than failing the whole read.
+    return raw.rstrip(b'\0').decode(errors='ignore')
+
+class audit:
+    '''
+    An append-only log of what users have done (logging in, making and starting servers, and so on), kept
+    out of the settings file so it never makes that file bigger.
+
+    Records are a fixed size and go into one segment file per day (UTC), 'audit/<date>.seg', in time order.
+    Every index_every'th record also gets an entry in 'audit/<date>.idx', so a time range can be found by
+    reading the small index and then only the part of the segment it points to.
+    Old days can be removed just by deleting their two files.
+    '''
+    # index path -> (size it was, [times], [record numbers])
+    index_cache = {}
+    index_lock = threading.Lock()
+
+    def segment_path(day:str) -> str:
+        return os.path.join(audit_dir, f'{day}.seg')
+
+    def index_path(day:str) -> str:
+        return os.path.join(audit_dir, f'{day}.idx')
+
+    def day_of(timestamp:float) -> str:
+        return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+    def record(action:str, actor:str, subject:str=None) -> bool:
+        '''
+        Adds a record to the log. A failure to write is logged, and never stops the action itself.
+
+        :param action: One of audit.actions.
+        :param actor: The email of whoever did it.
+        :param subject: What it was done to, such as a server's identifier.
+        :return: True if it was recorded.
+        '''
+        assert action in actions, f"Unknown audit action '{action}'."
+        try:
+            os.makedirs(audit_dir, exist_ok=True)
+            with file_lock(os.path.join(audit_dir, 'segments'), exclusive=True):
+                now = time.time()
+                day = audit.day_of(now)
+                with open(audit.segment_path(day), 'ab+') as f:
+                    size = f.seek(0, os.SEEK_END)
+                    # Drops half a record left by a crash mid-write, so every record stays in its place.
+                    number, leftover = divmod(size, record_struct.size)
+                    if leftover:
+                        f.truncate(number * record_struct.size)
+                    # Keeps the segment in time order even if the clock steps backwards.
+                    if number > 0:
+                        f.seek((number - 1) * record_struct.size)
+                        last_time, = struct.unpack('<d', f.read(8))
+                        now = max(now, last_time)
+
+                    # Append mode, so this always lands at the end.
+                    f.write(record_struct.pack(now, actions.index(action), _pack_text(actor), _pack_text(subject)))
+
+                if number % index_every == 0:
+                    with open(audit.index_path(day), 'ab') as f:
+                        f.write(index_struct.pack(now, number))
+        except OSError as err:
+            logging.error(f"Could not record '{action}' by {actor} in the audit log.", exception=err)
+            return False
+        return True
+
+    def _load_index(day:str) -> tuple:
+        path = audit.index_path(day)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return [], []
+
+        with audit.index_lock:
+            cached = audit.index_cache.get(path)
+            if cached is not None and cached[0] == size:
+                return cached[1], cached[2]
+
+        with open(path, 'rb') as f:
+            raw = f.read(size - size % index_struct.size)
+        times = []
+        numbers = []
+        for entry_time, number in index_struct.iter_unpack(raw):
+            times.append(entry_time)
+            numbers.append(number)
+
+        with audit.index_lock:
+            audit.index_cache[path] = (size, times, numbers)
+        return times, numbers
+
+    def _read_segment(day:str, start:float, end:float):
+        '''
+        Yields the records of one day between start and end, newest first. The segment is read backwards in
+        chunks from the last record that can be in range, so the newest few records only cost reading its end.
+        '''
+        try:
+            f = open(audit.segment_path(day), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            # Half a record at the end (from a crash mid-write) is left out.
+            upper = f.seek(0, os.SEEK_END) // record_struct.size
+
+            # Records are in time order, so the index bounds the range. Nothing from the first indexed record
+            # after 'end' on can be in it, and nothing before the last indexed record before 'start' can.
+            times, numbers = audit._load_index(day)
+            position = bisect.bisect_right(times, end)
+            if position < len(times):
+                upper = min(upper, numbers[position])
+            position = bisect.bisect_left(times, start) - 1
+            lower = numbers[position] if position >= 0 else 0
+
+            while upper > lower:
+                first = max(lower, upper - read_chunk)
+                f.seek(first * record_struct.size)
+                chunk = f.read((upper - first) * record_struct.size)
+                usable = len(chunk) - len(chunk) % record_struct.size
+                for entry in reversed(list(record_struct.iter_unpack(chunk[:usable]))):
+                    if entry[0] > end:
+                        continue
+                    if entry[0] < start:
+                        return
+                    yield entry
+                upper = first
+
+    def days() -> list:
+        '''
+        Every day that has a segment, oldest first.
+        '''
+        if not os.path.isdir(audit_dir):
+            return []
+        return sorted(name[:-4] for name in os.listdir(audit_dir) if name.endswith('.seg'))
+
+    def query(start:float=None, end:float=None, actor:str=None, action:str=None, limit:int=100) -> list:
+        '''
+        Finds records in a time range, newest first. Segments are read from the newest record backwards, and
+        reading stops as soon as there are enough.
+
+        :param start: The earliest time (timestamp) to include. Defaults to the start of the log.
+        :param end: The latest time to include. Defaults to now.
+        :param actor: Only records by this email.
+        :param action: Only records of this action.
+        :param limit: The most records to return.
+        :return: A list of dicts with 'time', 'action', 'actor' and 'subject'.
+        '''
+        assert action is None or action in actions, f"Unknown audit action '{action}'."
+        start = float('-inf') if start is None else float(start)
+        end = time.time() if end is None else float(end)
+
+        days = audit.days()
+        if start != float('-inf'):
+            days = [day for day in days if day >= audit.day_of(max(start, 0))]
+        days = [day for day in days if day <= audit.day_of(end)]
+
+        action_code = None if action is None else actions.index(action)
+        # Compared the way it was stored, so very long emails still match.
+        if actor is not None:
+            actor = _unpack_text(_pack_text(actor))
+        results = []
+        for day in reversed(days):
+            for entry_time, code, raw_actor, raw_subject in audit._read_segment(day, start, end):
+                if action_code is not None and code != action_code:
+                    continue
+                entry_actor = _unpack_text(raw_actor)
+                if actor is not None and entry_actor != actor:
+                    continue
+                results.append({
+                    'time': entry_time,
+                    'action': actions[code] if code < len(actions) else f'unknown({code})',
+                    'actor': entry_actor,
+                    'subject': _unpack_text(raw_subject) or None,
+                })
+                if len(results) >= limit:
+                    return results
+        return results
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
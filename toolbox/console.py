@@ -0,0 +1,198 @@
+import threading
+import os
+
+# The most console output kept on disk per server. Half of it is the segment being written, and half the one before.
+max_bytes = int(os.environ.get('CONSOLE_LOG_MAX_BYTES', 8 * 1024 * 1024))
+# How much of the newest output the supervisor keeps in memory for each running server.
+memory_bytes = 64 * 1024
+# The most a single read returns, so a client far behind catches up over several reads.
+max_read_bytes = 256 * 1024
+read_block = 64 * 1024
+
+def console_dir(suid:str) -> str:
+    return os.path.join('servers', suid, 'console')
+
+def _segments(directory:str) -> list:
+    '''
+    The segments in a console directory as (start offset, path), oldest first.
+    Each segment is named after the offset of its first byte, so offsets keep counting up across rotations and restarts.
+    '''
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    segments = []
+    for name in names:
+        if name.endswith('.log') and name[:-4].isdigit():
+            segments.append((int(name[:-4]), os.path.join(directory, name)))
+    return sorted(segments)
+
+def _size(path:str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+class console_log:
+    '''
+    Where a server's output (stdout and stderr) goes. It is a ring buffer on disk, made of two segment files in
+    'servers/<suid>/console' that each hold up to half of CONSOLE_LOG_MAX_BYTES. Once the newest is full a new
+    one is started and the oldest is deleted, so a chatty server can never fill the disk.
+
+    Every byte has an offset, which only ever goes up. Clients keep the 'next_offset' of a read and pass it
+    back to only get what is new.
+    '''
+    def __init__(self, suid:str):
+        self.directory = console_dir(suid)
+        os.makedirs(self.directory, exist_ok=True)
+        segments = _segments(self.directory)
+        if segments:
+            self.segment_start, path = segments[-1]
+            self.segment_size = _size(path)
+        else:
+            self.segment_start, self.segment_size = 0, 0
+        self.file = None
+        # The newest output, and the offset of its first byte.
+        self.memory = bytearray()
+        self.memory_start = self.end_offset()
+        self.lock = threading.Lock()
+
+    def end_offset(self) -> int:
+        return self.segment_start + self.segment_size
+
+    def _rotate(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.segment_start = self.end_offset()
+        self.segment_size = 0
+        # Keeps the segment before the new one, so there is always up to a full half of history.
+        for start, path in _segments(self.directory)[:-1]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def write(self, data:bytes) -> None:
+        '''
+        Adds output to the log.
+        '''
+        with self.lock:
+            if self.segment_size >= max_bytes // 2:
+                self._rotate()
+            if self.file is None:
+                path = os.path.join(self.directory, f'{self.segment_start:020d}.log')
+                self.file = open(path, 'ab', buffering=0)
+            self.file.write(data)
+            self.segment_size += len(data)
+
+            self.memory += data
+            if len(self.memory) > memory_bytes:
+                cut = len(self.memory) - memory_bytes
+                del self.memory[:cut]
+                self.memory_start += cut
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def tail(self, lines:int=200, since_offset:int=None) -> dict:
+        '''
+        Like console_log.read, but answered from memory when the newest output is enough.
+        '''
+        with self.lock:
+            memory = bytes(self.memory)
+            memory_start = self.memory_start
+        end = memory_start + len(memory)
+
+        if since_offset is not None:
+            if since_offset >= memory_start:
+                start = min(since_offset, end)
+                return _result(memory[start - memory_start:][:max_read_bytes], start, end, False)
+        else:
+            start = _line_start(memory, lines)
+            if start is not None or memory_start == 0:
+                return _result(memory[start or 0:], memory_start + (start or 0), end, False)
+        return console_log.read(self.directory, lines, since_offset)
+
+    def read(directory:str, lines:int=200, since_offset:int=None) -> dict:
+        '''
+        Reads a server's output from disk, without loading more of it than is returned.
+
+        :param directory: The server's console directory.
+        :param lines: How many of the last lines to return, if since_offset isn't given.
+        :param since_offset: Returns the output from this offset on (up to max_read_bytes of it).
+        :return: A dict of 'offset' (of the first byte returned), 'next_offset' (to pass back next time), 'data',
+        and 'truncated', which is True if output from since_offset had already been rotated away.
+        '''
+        segments = _segments(directory)
+        if not segments:
+            return _result(b'', 0, 0, False)
+        sizes = [_size(path) for start, path in segments]
+        end = segments[-1][0] + sizes[-1]
+
+        if since_offset is not None:
+            truncated = since_offset < segments[0][0]
+            start = min(max(since_offset, segments[0][0]), end)
+            return _result(_read_range(segments, sizes, start, min(end, start + max_read_bytes)), start, end, truncated)
+
+        # Reads blocks backwards from the end until enough lines have been seen.
+        chunks = []
+        newlines = 0
+        position = end
+        oldest = segments[0][0]
+        while position > oldest and newlines <= lines and end - position < max_read_bytes:
+            block_start = max(oldest, position - read_block)
+            block = _read_range(segments, sizes, block_start, position)
+            chunks.insert(0, block)
+            newlines += block.count(b'\n')
+            position = block_start
+        data = b''.join(chunks)
+
+        start = _line_start(data, lines)
+        if start is None:
+            start = 0
+        return _result(data[start:], position + start, end, False)
+
+def _line_start(data:bytes, lines:int):
+    '''
+    Where the last 'lines' lines of data start, or None if data has fewer lines than that.
+    Output that doesn't end in a newline counts as a line.
+    '''
+    position = len(data)
+    if data.endswith(b'\n'):
+        position -= 1
+    for _ in range(lines):
+        position = data.rfind(b'\n', 0, position)
+        if position == -1:
+            return None
+    return position + 1
+
+def _read_range(segments:list, sizes:list, start:int, end:int) -> bytes:
+    parts = []
+    for (segment_start, path), size in zip(segments, sizes):
+        segment_end = segment_start + size
+        if segment_end <= start or segment_start >= end:
+            continue
+        try:
+            with open(path, 'rb') as f:
+                f.seek(max(start, segment_start) - segment_start)
+                parts.append(f.read(min(end, segment_end) - max(start, segment_start)))
+        except FileNotFoundError:
+            # Rotated away while we were reading.
+            continue
+    return b''.join(parts)
+
+def _result(data:bytes, offset:int, end:int, truncated:bool) -> dict:
+    return {
+        'offset': offset,
+        'next_offset': offset + len(data),
+        'end_offset': end,
+        'data': data.decode(errors='replace'),
+        'truncated': truncated,
+    }
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
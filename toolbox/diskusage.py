@@ -0,0 +1,316 @@
+from toolbox.registry import server_registry, config_path
+from toolbox.watcher import inotify
+from toolbox.storage import var, dt
+from toolbox.pylog import pylog
+import threading
+import time
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+# How often every server's content directory is walked in full, in case an event was ever missed.
+reconcile_interval = float(os.environ.get('DISK_USAGE_RECONCILE_INTERVAL', 3600))
+# What happens to a server that goes over its storage quota. 'warn' only logs it, 'stop' also stops the server.
+quota_action = str(os.environ.get('STORAGE_QUOTA_ACTION', 'warn')).lower()
+# How long to collect events for before recounting the directories they were in.
+settle_delay = 0.5
+
+# Everything that can change the size of what is in a directory.
+dir_events = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE |
+              inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO | inotify.IN_DELETE_SELF)
+
+def _entry_size(entry:os.DirEntry) -> int:
+    '''
+    How much disk an entry takes up, like du counts it. Falls back to its size where there are no block counts.
+    '''
+    try:
+        stat = entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+        return 0
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+class tracked_server:
+    '''
+    The disk usage of one server's content directory, kept as a total per directory (of the files directly in it),
+    so a change only means recounting the directory it happened in.
+    '''
+    __slots__ = ('suid', 'root', 'quota', 'dirs', 'total', 'over_quota', 'stopping', 'walked_at')
+
+    def __init__(self, suid:str, root:str, quota:int):
+        self.suid = suid
+        self.root = root
+        self.quota = quota
+        # directory -> bytes used by the files directly in it.
+        self.dirs = {}
+        self.total = 0
+        self.over_quota = False
+        # Whether a stop for going over the quota is still under way.
+        self.stopping = False
+        self.walked_at = None
+
+class disk_usage:
+    '''
+    Keeps up to date totals of how much disk each server's content directory uses, without walking the whole
+    tree again every time it is asked. Each directory is walked once with os.scandir, then inotify says which
+    directories changed and only those are recounted. Every DISK_USAGE_RECONCILE_INTERVAL seconds each tree is
+    walked in full anyway. Without inotify, that walk is the only way the totals change.
+
+    Servers that go over their STORAGE quota are warned about, or stopped if STORAGE_QUOTA_ACTION is 'stop'.
+    '''
+    servers = {}
+    # watch descriptor -> (suid, directory), and (suid, directory) -> watch descriptor.
+    wds = {}
+    paths = {}
+    notifier = None
+    thread = None
+    pid = None
+    lock = threading.Lock()
+    watch_limit_warned = False
+
+    def start() -> None:
+        '''
+        Starts the thread that applies changes. Call once per process, before track().
+        '''
+        if disk_usage.pid == os.getpid() and disk_usage.thread is not None:
+            return
+        disk_usage.pid = os.getpid()
+        disk_usage.servers = {}
+        disk_usage.wds = {}
+        disk_usage.paths = {}
+        try:
+            disk_usage.notifier = inotify()
+        except OSError:
+            disk_usage.notifier = None
+            logging.info(f"inotify is not available, so disk usage is only recounted every {reconcile_interval} seconds.")
+        disk_usage.thread = threading.Thread(target=disk_usage._run, name='disk usage', daemon=True)
+        disk_usage.thread.start()
+
+    def track(suid:str, root:str, quota:int=None) -> None:
+        '''
+        Starts tracking a server's content directory.
+
+        :param quota: The most bytes it may use, or None for no limit.
+        '''
+        with disk_usage.lock:
+            if suid in disk_usage.servers:
+                disk_usage.servers[suid].quota = quota
+                return
+            tracked = tracked_server(suid, os.path.abspath(root), quota)
+            disk_usage.servers[suid] = tracked
+            disk_usage._walk(tracked, tracked.root)
+            tracked.walked_at = time.monotonic()
+        disk_usage._check_quota(tracked)
+
+    def untrack(suid:str) -> None:
+        with disk_usage.lock:
+            tracked = disk_usage.servers.pop(suid, None)
+            if tracked is not None:
+                disk_usage._forget(tracked, tracked.root)
+
+    def usage(suid:str) -> int:
+        '''
+        :return: How many bytes a server's content directory uses, or None if it isn't tracked.
+        '''
+        tracked = disk_usage.servers.get(suid)
+        return None if tracked is None else tracked.total
+
+    def sync() -> None:
+        '''
+        Tracks every server in the registry, and stops tracking any that were deleted.
+        A new server's config is read once, for its content directory and quota.
+        '''
+        registered = server_registry.owned_by()
+        for suid in list(disk_usage.servers):
+            if suid not in registered:
+                disk_usage.untrack(suid)
+        for suid in registered:
+            if suid in disk_usage.servers:
+                continue
+            try:
+                server = var.load_all(file=config_path(suid), dt_default=None)
+            except FileNotFoundError:
+                continue
+            # Where the server runs, the same as thorns uses when starting it.
+            content_dir = server.get('content_dir') or os.path.dirname(os.path.abspath(config_path(suid)))
+            if not os.path.isdir(content_dir):
+                continue
+            total = (server.get('resources') or dt.SERVER_INSTANCE['resources'])['STORAGE'].get('total')
+            disk_usage.track(suid, content_dir, None if total in [None, -1] else int(total) * 1024 * 1024)
+
+    def _watch(tracked:tracked_server, directory:str) -> None:
+        if disk_usage.notifier is None or (tracked.suid, directory) in disk_usage.paths:
+            return
+        try:
+            wd = disk_usage.notifier.add_watch(directory, dir_events)
+        except OSError as err:
+            # Usually the inotify watch limit. The reconcile walk still catches changes here, just later.
+            if not disk_usage.watch_limit_warned:
+                disk_usage.watch_limit_warned = True
+                logging.warning(f"Could not watch '{directory}' for disk usage ({err}). Raise fs.inotify.max_user_watches if this keeps happening.")
+            return
+        disk_usage.wds[wd] = (tracked.suid, directory)
+        disk_usage.paths[(tracked.suid, directory)] = wd
+
+    def _count(tracked:tracked_server, directory:str) -> list:
+        '''
+        Recounts the files directly in a directory, and updates the server's total.
+
+        :return: The sub-directories in it.
+        '''
+        used = 0
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        used += _entry_size(entry)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            disk_usage._forget(tracked, directory)
+            return []
+        tracked.total += used - tracked.dirs.get(directory, 0)
+        tracked.dirs[directory] = used
+        return subdirs
+
+    def _walk(tracked:tracked_server, directory:str) -> None:
+        '''
+        Watches and counts a directory and everything under it.
+        '''
+        stack = [directory]
+        while stack:
+            path = stack.pop()
+            # Watched before counting, so nothing written during the count is missed.
+            disk_usage._watch(tracked, path)
+            stack.extend(disk_usage._count(tracked, path))
+
+    def _forget(tracked:tracked_server, directory:str) -> None:
+        '''
+        Drops a directory and everything under it, such as when it is deleted or moved away.
+        '''
+        prefix = directory + os.sep
+        for path in [path for path in tracked.dirs if path == directory or path.startswith(prefix)]:
+            tracked.total -= tracked.dirs.pop(path)
+            wd = disk_usage.paths.pop((tracked.suid, path), None)
+            if wd is not None:
+                disk_usage.wds.pop(wd, None)
+                if disk_usage.notifier is not None:
+                    disk_usage.notifier.remove_watch(wd)
+
+    def _apply(events:list) -> None:
+        '''
+        Recounts the directories that events happened in. New directories are walked, and removed ones dropped.
+        '''
+        dirty = set()
+        for wd, mask, _, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                # Events were lost, so every tree is walked again.
+                for tracked in list(disk_usage.servers.values()):
+                    tracked.walked_at = None
+                continue
+            target = disk_usage.wds.get(wd)
+            if target is None:
+                continue
+            suid, directory = target
+            tracked = disk_usage.servers.get(suid)
+            if tracked is None:
+                continue
+
+            if mask & inotify.IN_IGNORED:
+                # The directory itself is gone, and so is its watch.
+                disk_usage.wds.pop(wd, None)
+                disk_usage.paths.pop(target, None)
+                continue
+            if mask & inotify.IN_ISDIR and name:
+                path = os.path.join(directory, name)
+                if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    disk_usage._forget(tracked, path)
+                elif mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    disk_usage._walk(tracked, path)
+                continue
+            dirty.add((suid, directory))
+
+        for suid, directory in dirty:
+            tracked = disk_usage.servers.get(suid)
+            if tracked is not None and directory in tracked.dirs:
+                disk_usage._count(tracked, directory)
+
+    def _reconcile(tracked:tracked_server) -> None:
+        '''
+        Walks a server's whole tree again, and corrects its total if it had drifted.
+        '''
+        before = tracked.total
+        disk_usage._forget(tracked, tracked.root)
+        disk_usage._walk(tracked, tracked.root)
+        tracked.walked_at = time.monotonic()
+        if tracked.total != before:
+            logging.info(f"Disk usage of '{tracked.suid}' was off by {tracked.total - before} bytes, and has been corrected.")
+
+    def _check_quota(tracked:tracked_server) -> None:
+        '''
+        Warns when a server goes over its quota or back under it. With STORAGE_QUOTA_ACTION 'stop', a server is
+        stopped whenever it is found online and over its quota, such as after being started again while still over.
+        '''
+        over = tracked.quota is not None and tracked.total > tracked.quota
+        if over != tracked.over_quota:
+            tracked.over_quota = over
+            if not over:
+                logging.info(f"Server '{tracked.suid}' is back under its storage quota.")
+            else:
+                logging.warning(
+                    f"Server '{tracked.suid}' is using {tracked.total // (1024 * 1024)} MiB, "
+                    f"over its storage quota of {tracked.quota // (1024 * 1024)} MiB."
+                )
+        if quota_action != 'stop' or not (over or tracked.stopping):
+            return
+        if not (server_registry.owned_by().get(tracked.suid) or {}).get('online'):
+            # Stopped, so it is stopped again if it is started while still over.
+            tracked.stopping = False
+            return
+        if not over or tracked.stopping:
+            return
+
+        logging.warning(f"Stopping server '{tracked.suid}', as it is over its storage quota.")
+        tracked.stopping = True
+        # This process doesn't run servers, so thorns.stop asks the supervisor that does, and waits for the
+        # server to exit. That is done off the thread that keeps the totals.
+        threading.Thread(target=disk_usage._stop, args=(tracked,), daemon=True).start()
+
+    def _stop(tracked:tracked_server) -> None:
+        from toolbox.thorns import thorns
+        try:
+            thorns.stop(tracked.suid, 'RosePanel')
+        except Exception as err:
+            logging.error(f"Could not stop server '{tracked.suid}', which is over its storage quota.", exception=err)
+            tracked.stopping = False
+        # Otherwise it stays set until the registry shows the server offline, so it isn't stopped twice.
+
+    def _run() -> None:
+        while True:
+            try:
+                if disk_usage.notifier is not None:
+                    events = disk_usage.notifier.read_events(timeout=settle_delay)
+                    if events:
+                        # Let a burst of writes finish, so each directory is only recounted once for all of it.
+                        time.sleep(settle_delay)
+                        events += disk_usage.notifier.read_events(timeout=0)
+                else:
+                    events = []
+                    time.sleep(settle_delay)
+
+                with disk_usage.lock:
+                    if events:
+                        disk_usage._apply(events)
+                    now = time.monotonic()
+                    for tracked in list(disk_usage.servers.values()):
+                        if tracked.walked_at is None or now - tracked.walked_at > reconcile_interval:
+                            disk_usage._reconcile(tracked)
+                    servers = list(disk_usage.servers.values())
+                for tracked in servers:
+                    disk_usage._check_quota(tracked)
+            except Exception as err:
+                logging.error("Updating disk usage failed.", exception=err)
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
@@ -56,6 +56,14 @@ class error:
         def __str__(self):
             return f"Insufficient permissions."
 
+    class StorageLockTimeout(Exception):
+        def __init__(self, file):
+            self.file = file
+            super().__init__(self.file)
+
+        def __str__(self):
+            return f"Timed out waiting for the lock on '{self.file}'."
+
     class exited_question(Exception):
         def __init__(self):
             super().__init__()
@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from toolbox.pylog import pylog
+import threading
+import functools
+import asyncio
+import hashlib
+import secrets
+import base64
+import hmac
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+def _b64encode(raw:bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+def _b64decode(text:str) -> bytes:
+    return base64.b64decode(text)
+
+class passwords:
+    '''
+    Hashes and checks account passwords. Hashes are stored as strings like
+    'scrypt$<log2 n>$<r>$<p>$<salt>$<hash>' or 'pbkdf2_sha256$<iterations>$<salt>$<hash>'.
+    Anything else is a legacy plaintext password, which still works and is rehashed on the next login.
+
+    Hashing is slow on purpose, so the API runs logins through offload() instead of in the event loop.
+    '''
+    # How many verified (password, hash) pairs to remember, so repeat logins skip the slow hash.
+    cache_size = 1024
+    cache = OrderedDict()
+    cache_lock = threading.Lock()
+    # Mixed into cache keys so the cache never holds anything a password could be recovered from.
+    cache_pepper = secrets.token_bytes(32)
+
+    pool = None
+    pool_pid = None
+    pool_lock = threading.Lock()
+
+    def algorithm() -> str:
+        '''
+        scrypt if this Python's OpenSSL has it, otherwise PBKDF2. Can be forced with PASSWORD_HASH_ALGORITHM.
+        '''
+        algorithm = str(os.environ.get('PASSWORD_HASH_ALGORITHM', 'scrypt')).lower()
+        if algorithm == 'scrypt' and not hasattr(hashlib, 'scrypt'):
+            return 'pbkdf2_sha256'
+        if algorithm not in ['scrypt', 'pbkdf2_sha256']:
+            raise ValueError(f"Unknown password hash algorithm '{algorithm}'. Use 'scrypt' or 'pbkdf2_sha256'.")
+        return algorithm
+
+    def cost() -> int:
+        '''
+        The cost factor from PASSWORD_HASH_COST. For scrypt it is log2 of n, and PBKDF2 does 2**cost * 20 iterations.
+        Each step up doubles how long a hash takes.
+        '''
+        return int(os.environ.get('PASSWORD_HASH_COST', 14))
+
+    def _derive(password:str, algorithm:str, params:list, salt:bytes) -> bytes:
+        if algorithm == 'scrypt':
+            log2_n, r, p = params
+            n = 1 << log2_n
+            return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=32)
+        iterations, = params
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, dklen=32)
+
+    def _params(algorithm:str) -> list:
+        if algorithm == 'scrypt':
+            return [passwords.cost(), 8, 1]
+        return [(1 << passwords.cost()) * 20]
+
+    def hash(password:str) -> str:
+        '''
+        Hashes a password with a fresh salt, using the current algorithm and cost.
+
+        :param password: The password to hash.
+        :return: The string to store.
+        '''
+        algorithm = passwords.algorithm()
+        params = passwords._params(algorithm)
+        salt = secrets.token_bytes(16)
+        digest = passwords._derive(password, algorithm, params, salt)
+        return '$'.join([algorithm] + [str(param) for param in params] + [_b64encode(salt), _b64encode(digest)])
+
+    def _parse(stored:str) -> tuple:
+        '''
+        :return: (algorithm, params, salt, digest), or None if stored is not a hash. (a legacy plaintext password)
+        '''
+        if not isinstance(stored, str):
+            return None
+        parts = stored.split('$')
+        try:
+            if parts[0] == 'scrypt' and len(parts) == 6:
+                return 'scrypt', [int(part) for part in parts[1:4]], _b64decode(parts[4]), _b64decode(parts[5])
+            if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+                return 'pbkdf2_sha256', [int(parts[1])], _b64decode(parts[2]), _b64decode(parts[3])
+        except ValueError:
+            return None
+        return None
+
+    def is_hashed(stored) -> bool:
+        return passwords._parse(stored) is not None
+
+    def _cache_key(password:str, stored:str) -> bytes:
+        return hmac.new(passwords.cache_pepper, f'{stored}\0{password}'.encode(), hashlib.sha256).digest()
+
+    def verify(password:str, stored:str) -> bool:
+        '''
+        Checks a password against what is stored for an account.
+
+        :param password: The password that was entered.
+        :param stored: The stored hash, or a legacy plaintext password.
+        :return: True if the password is correct.
+        '''
+        if password is None or stored is None:
+            return False
+
+        parsed = passwords._parse(stored)
+        if parsed is None:
+            return hmac.compare_digest(str(password).encode(), str(stored).encode())
+
+        cache_key = passwords._cache_key(password, stored)
+        with passwords.cache_lock:
+            if cache_key in passwords.cache:
+                passwords.cache.move_to_end(cache_key)
+                return True
+
+        algorithm, params, salt, digest = parsed
+        if not hmac.compare_digest(passwords._derive(password, algorithm, params, salt), digest):
+            return False
+
+        # Only correct passwords are remembered, so guessing always costs a full hash.
+        with passwords.cache_lock:
+            passwords.cache[cache_key] = True
+            if len(passwords.cache) > passwords.cache_size:
+                passwords.cache.popitem(last=False)
+        return True
+
+    def hash_many(plaintexts:list) -> list:
+        '''
+        Hashes several passwords at once, spread over the password pool. Do not call from a pool thread.
+
+        :return: The hashes, in the same order.
+        '''
+        return list(passwords.executor().map(passwords.hash, plaintexts))
+
+    def needs_rehash(stored:str) -> bool:
+        '''
+        Whether a stored password should be hashed again, as it is plaintext or was hashed with an older algorithm or cost.
+        '''
+        parsed = passwords._parse(stored)
+        if parsed is None:
+            return True
+        algorithm = passwords.algorithm()
+        return parsed[0] != algorithm or parsed[1] != passwords._params(algorithm)
+
+    def executor() -> ThreadPoolExecutor:
+        '''
+        The pool that logins and hashing are run on. Its size (PASSWORD_HASH_WORKERS) caps how many hashes run
+        at once, so a burst of logins queues up instead of eating every core. hashlib lets go of the GIL while
+        hashing, so the event loop keeps serving other requests in the meantime.
+        '''
+        if passwords.pool is None or passwords.pool_pid != os.getpid():
+            with passwords.pool_lock:
+                if passwords.pool is None or passwords.pool_pid != os.getpid():
+                    workers = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+                    passwords.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='passwords')
+                    passwords.pool_pid = os.getpid()
+        return passwords.pool
+
+    async def offload(func, *args, **kwargs):
+        '''
+        Runs a function that hashes or checks passwords (such as creating a user_account) on the password pool,
+        without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(passwords.executor(), functools.partial(func, *args, **kwargs))
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
@@ -1,6 +1,11 @@
+from toolbox.sessions import token_index, permission_mask
+from toolbox.account_index import account_index
 from toolbox.security import settings_path
 from toolbox.errors import error
 from toolbox.storage import var
+from toolbox.audit import audit
+import threading
+import os
 
 class permissions:
     '''
@@ -48,24 +53,119 @@ class permissions:
             raise ValueError(f"Permission {permission_name} not found.")
         return number
 
-    def require(needed_perms: list, email_address: str) -> bool:
-        '''Checks only if the user has the required permissions. Do not use this to check if a password is valid.'''
-        # Check if the email is valid.
-        if email_address not in dict(var.get('accounts')).keys():
-            raise error.AccountNotFound(email_address)
+    def parse_mask(value) -> int:
+        '''
+        Turns permissions given in any of the ways a person might write them into a mask.
+        Accepts a mask (int or digits), a permission name, or a list (or ';' separated string) of either.
+        Raises ValueError if any of them is not a known permission.
+        '''
+        if value is None or value == '':
+            return 0
+        if isinstance(value, str):
+            value = value.strip()
+            if ';' not in value:
+                value = int(value) if value.isdigit() else permissions.get_number(value)
+            else:
+                value = [part.strip() for part in value.split(';') if part.strip() != '']
+        if isinstance(value, (list, tuple)):
+            mask = 0
+            for part in value:
+                mask |= permissions.parse_mask(part)
+            return mask
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f"Permissions must be a number, a name or a list, not {type(value).__name__}.")
+
+        known_mask = permissions._needed_mask(list(permissions.dict))
+        if value < 0 or value & ~known_mask:
+            raise ValueError(f"Permission mask {value} has unknown permissions in it.")
+        return value
+
+    # email -> permission mask, so checks don't have to read the settings file.
+    # Cleared whenever 'permissions_version' in the settings file changes, which permissions.set() bumps.
+    cache = {}
+    cache_pid = None
+    cache_lock = threading.Lock()
+
+    def _clear_cache(key_prefix=None, value=None) -> None:
+        permissions.cache = {}
+
+    def _needed_mask(needed_perms) -> int:
+        if isinstance(needed_perms, int):
+            return needed_perms
+        needed_mask = 0
+        for needed_perm in needed_perms:
+            needed_mask |= needed_perm
+        return needed_mask
 
-        # Get the user's account perms
-        acc_perms = permissions.load(email_address)
-        if permissions.ADMINISTRATOR in acc_perms:
-            return True
+    def mask(email_address: str) -> int:
+        '''
+        Returns the permission bitmask of an account. Cached per account.
 
-        # Check if the user has the required permissions.
-        for needed_perm in needed_perms:
-            if acc_perms[needed_perm] is False:
-                raise error.InsufficientPermissions(needed_perm)
+        :param email_address: The email address of the account.
+        :return: The bitmask of the permissions the account has.
+        '''
+        if permissions.cache_pid != os.getpid():
+            with permissions.cache_lock:
+                if permissions.cache_pid != os.getpid():
+                    permissions.cache = {}
+                    # Other processes can change permissions too, so we need to hear about it.
+                    var.watch(settings_path, 'permissions_version', permissions._clear_cache)
+                    permissions.cache_pid = os.getpid()
+
+        account_mask = permissions.cache.get(email_address)
+        if account_mask is None:
+            key = f'accounts//{email_address}//permissions'
+            if var.exists(key, file=settings_path):
+                account_perms = var.get(key, file=settings_path)
+            elif account_index.exists(email_address):
+                # Older accounts may have never had a permission set.
+                account_perms = 0
+            else:
+                raise error.AccountNotFound(email_address)
+            account_mask = permission_mask(account_perms)
+            permissions.cache[email_address] = account_mask
+        return account_mask
+
+    def require_all(needed_perms, email_address: str) -> bool:
+        '''
+        Checks the user has every one of the permissions. Administrators always do.
+
+        :param needed_perms: A list of permissions, or the permissions OR'd together into one int.
+        :param email_address: The email address of the user.
+        :return: True, or raises error.InsufficientPermissions with the first permission missing.
+        '''
+        account_mask = permissions.mask(email_address)
+        if account_mask & permissions.ADMINISTRATOR:
+            return True
 
+        needed_mask = permissions._needed_mask(needed_perms)
+        missing = needed_mask & ~account_mask
+        if missing:
+            # The lowest missing bit, which is also the most powerful one.
+            raise error.InsufficientPermissions(missing & -missing)
         return True
 
+    def require_any(needed_perms, email_address: str) -> bool:
+        '''
+        Checks the user has at least one of the permissions. Administrators always do.
+
+        :param needed_perms: A list of permissions, or the permissions OR'd together into one int.
+        :param email_address: The email address of the user.
+        :return: True, or raises error.InsufficientPermissions with the list of permissions if they have none of them.
+        '''
+        account_mask = permissions.mask(email_address)
+        if account_mask & permissions.ADMINISTRATOR:
+            return True
+
+        needed_mask = permissions._needed_mask(needed_perms)
+        if account_mask & needed_mask or needed_mask == 0:
+            return True
+        raise error.InsufficientPermissions([value for value in permissions.dict if value & needed_mask])
+
+    def require(needed_perms: list, email_address: str) -> bool:
+        '''Checks only if the user has the required permissions. Do not use this to check if a password is valid.'''
+        return permissions.require_all(needed_perms, email_address)
+
     def set(causes_email: str, effects_email: str, permission: int, value: bool) -> bool:
         '''
         Saves the permissions to the user's account.
@@ -78,30 +178,56 @@ class permissions:
         '''
         assert isinstance(value, bool)
         # Checks if both accounts exist
-        if causes_email not in dict(var.get('accounts')).keys():
+        if causes_email != 'RosePanel' and not account_index.exists(causes_email):
             raise error.AccountNotFound(causes_email)
         # Checks if the user has the required permissions.
         if causes_email != 'RosePanel':
             permissions.require([permissions.MANAGE_PERMISSIONS], causes_email)
 
-        # Checks if the user exists.
-        if effects_email not in dict(var.get('accounts')).keys():
-            raise error.AccountNotFound(effects_email)
+        with var.transaction(file=settings_path) as tx:
+            # Checks if the user exists.
+            if tx.get(f'accounts//{effects_email}') is None:
+                raise error.AccountNotFound(effects_email)
 
-        var.set(f'accounts//{effects_email}//permissions//{permission}', value, file=settings_path)
+            # Older accounts store a dict of permissions, which is converted to a mask the first time one is set.
+            account_mask = permission_mask(tx.get(f'accounts//{effects_email}//permissions'))
+            if value is True:
+                account_mask |= int(permission)
+            else:
+                account_mask &= ~int(permission)
+            tx.set(f'accounts//{effects_email}//permissions', account_mask)
+            tx.set('permissions_version', (tx.get('permissions_version') or 0) + 1)
+
+        permissions.cache.pop(effects_email, None)
+        token_index.refresh_account(effects_email)
+        audit.record('permission_change', causes_email, effects_email)
         return True
 
-    def load(email_address: str) -> list:
+    def _migrate(email_address: str) -> None:
+        '''
+        Stores an older account's permissions (missing, or a dict of them) as a mask, so it only has to be
+        converted once. The permissions themselves don't change, so permissions_version isn't bumped.
+        '''
+        key = f'accounts//{email_address}//permissions'
+        if var.exists(key, file=settings_path) and isinstance(var.get(key, file=settings_path), int):
+            return
+        with var.transaction(file=settings_path) as tx:
+            if tx.get(f'accounts//{email_address}') is None:
+                return
+            account_perms = tx.get(key)
+            if not isinstance(account_perms, int):
+                tx.set(key, permission_mask(account_perms))
+
+    def load(email_address: str) -> dict:
         '''
-        Loads the permissions of the user.
+        Loads the permissions of the user. Older accounts are moved to a permission mask the first time.
 
         :param email_address: The email address of the user to load the permissions of.
-        :return: A list of permissions the user has.
+        :return: A dict of each permission to whether the user has it.
         '''
-        perms = dict(var.get(f'accounts//{email_address}//permissions', file=settings_path))
-        # Converts each key to an int and not a string from the dict
-        converted_perms = {int(k): v for k, v in perms.items()}
-        return converted_perms
+        account_mask = permissions.mask(email_address)
+        permissions._migrate(email_address)
+        return {value: bool(account_mask & value) for value in permissions.dict}
 
 if __name__ == "__main__":
     print("Do not run this file directly.")
@@ -0,0 +1,116 @@
+import threading
+import math
+import time
+import os
+
+class limit:
+    '''
+    How many requests a bucket allows. 'requests' can be made at once, and one more is allowed back
+    every 'per' / 'requests' seconds.
+    '''
+    __slots__ = ('requests', 'per', 'rate')
+
+    def __init__(self, requests:int, per:float):
+        assert requests > 0 and per > 0, "A rate limit needs a positive number of requests and seconds."
+        self.requests = requests
+        self.per = per
+        self.rate = requests / per
+
+    def parse(text:str):
+        '''
+        Parses a limit written like '10/60' (10 requests per 60 seconds). 'off' or '0' turns the limit off.
+
+        :return: A limit, or None if the limit is off.
+        '''
+        text = str(text).strip().lower()
+        if text in ['off', 'none', '0', '']:
+            return None
+        requests, _, per = text.partition('/')
+        return limit(int(requests), float(per or 1))
+
+    def from_env(name:str, default:str):
+        return limit.parse(os.environ.get(name, default))
+
+    def __repr__(self):
+        return f'limit({self.requests}/{self.per:g}s)'
+
+class rate_limiter:
+    '''
+    Token buckets kept in memory, so limiting a request never touches the disk.
+    Each bucket is just [tokens left, when it was last used], and is refilled when it is next looked at
+    instead of on a timer. Buckets that have refilled completely are the same as no bucket at all, so those
+    are thrown away when there get to be too many.
+    '''
+    max_buckets = 50000
+    buckets = {}
+    lock = threading.Lock()
+
+    def hit(key:tuple, rule:limit, now:float=None) -> float:
+        '''
+        Takes one token from a bucket.
+
+        :param key: What the bucket is for, such as ('login', 'ip', '127.0.0.1').
+        :param rule: The limit of the bucket.
+        :return: 0 if the request is allowed, otherwise how many seconds until it would be.
+        '''
+        if now is None:
+            now = time.monotonic()
+        with rate_limiter.lock:
+            bucket = rate_limiter.buckets.get(key)
+            if bucket is None:
+                if len(rate_limiter.buckets) >= rate_limiter.max_buckets:
+                    rate_limiter._prune(now, rule)
+                rate_limiter.buckets[key] = [rule.requests - 1, now]
+                return 0
+
+            tokens = min(rule.requests, bucket[0] + (now - bucket[1]) * rule.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / rule.rate
+
+    def _prune(now:float, rule:limit) -> None:
+        # Anything untouched for longer than a full refill of this limit holds no state worth keeping.
+        # Buckets with a slower limit may be forgotten early, which only ever errs towards letting requests through.
+        cutoff = now - rule.per
+        buckets = {key: bucket for key, bucket in rate_limiter.buckets.items() if bucket[1] > cutoff}
+        if len(buckets) >= rate_limiter.max_buckets:
+            # Still full of recent clients, so keep the most recently used half.
+            newest = sorted(buckets.items(), key=lambda item: item[1][1], reverse=True)
+            buckets = dict(newest[:rate_limiter.max_buckets // 2])
+        rate_limiter.buckets = buckets
+
+    def check(route:str, rules:dict, identities:dict) -> float:
+        '''
+        Checks a request against every limit of a route. A token is only taken from the buckets the request
+        is checked against, so a client stopped by its IP limit doesn't also use up the account's allowance.
+
+        :param route: The name of the route, such as 'login'.
+        :param rules: What each kind of bucket is limited to, such as {'ip': limit(10, 60), 'account': limit(5, 60)}.
+        :param identities: Who the request is from for each kind, such as {'ip': '127.0.0.1', 'account': 'a@b.c'}.
+        Kinds without an identity (or without a limit) are skipped.
+        :return: 0 if the request is allowed, otherwise how many seconds the client should wait.
+        '''
+        for kind, rule in rules.items():
+            identity = identities.get(kind)
+            if rule is None or identity is None:
+                continue
+            wait = rate_limiter.hit((route, kind, identity), rule)
+            if wait > 0:
+                return wait
+        return 0
+
+    def retry_after(wait:float) -> str:
+        '''
+        The value of a Retry-After header, which is whole seconds.
+        '''
+        return str(max(1, math.ceil(wait)))
+
+    def reset() -> None:
+        with rate_limiter.lock:
+            rate_limiter.buckets = {}
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
@@ -0,0 +1,70 @@
+from toolbox.storage import dt
+import copy
+
+class record:
+    '''
+    A typed, fixed-shape version of one of the dt templates. Every record made gets its own fresh
+    defaults, so unlike editing dt.ACCOUNT and friends in place, nothing is shared between records.
+
+    Subclasses list their fields in __slots__ (taken from the dt template they stand for), which also keeps
+    records smaller in memory than the equivalent dicts. Keys found in stored data that are not a field
+    are kept in 'extra', so converting to and from a dict never loses anything.
+    '''
+    __slots__ = ('extra',)
+    template = {}
+    fields = ()
+
+    def __init__(self, **values):
+        template = type(self).template
+        for name in type(self).fields:
+            if name in values:
+                value = values.pop(name)
+            else:
+                value = template[name]
+                if isinstance(value, (dict, list)):
+                    value = copy.deepcopy(value)
+            setattr(self, name, value)
+        self.extra = values
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fields = tuple(cls.template)
+
+    def to_dict(self) -> dict:
+        '''
+        Returns the record as a dict, ready to be stored with var.set().
+        '''
+        data = {name: getattr(self, name) for name in type(self).fields}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        '''
+        Makes a record out of a dict, such as one loaded with var.get(). Missing fields get their defaults.
+        '''
+        return cls(**dict(data))
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+class account_record(record):
+    template = dt.ACCOUNT
+    __slots__ = tuple(template)
+
+class token_record(record):
+    template = dt.TOKEN_DICT
+    __slots__ = tuple(template)
+
+class server_record(record):
+    template = dt.SERVER_INSTANCE
+    __slots__ = tuple(template)
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
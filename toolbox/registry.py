@@ -0,0 +1,206 @@
+from toolbox.storage import var, dt
+from toolbox.pylog import pylog
+import threading
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+servers_dir = 'servers'
+registry_path = os.path.join(servers_dir, 'registry.json')
+
+def server_dirs() -> list:
+    '''
+    The SUID of every server directory in 'servers', skipping the registry and anything else kept there.
+    '''
+    if not os.path.isdir(servers_dir):
+        return []
+    return [
+        name for name in os.listdir(servers_dir)
+        if name.startswith('thorn_') and os.path.isdir(os.path.join(servers_dir, name))
+    ]
+
+def config_path(suid:str) -> str:
+    return f'{servers_dir}/{suid}/config.json'
+
+def config_mtime(suid:str) -> int:
+    '''
+    When a server's config was last written, or None if it has none. Checks the sqlite database too, for STORAGE_ENGINE=sqlite.
+    '''
+    path = config_path(suid)
+    for candidate in [path, os.path.splitext(path)[0] + '.db']:
+        try:
+            return os.stat(candidate).st_mtime_ns
+        except FileNotFoundError:
+            continue
+    return None
+
+class server_registry:
+    '''
+    An index of every server by SUID and by name, kept in 'servers/registry.json', so finding a server
+    (or everything a user owns) is a dict lookup instead of opening every server's config.json.
+
+    Each entry holds the server's name, owner, online flag and process ID, and the mtime of its config when
+    the entry was made. Creating and deleting servers update it, and it is rebuilt when the panel starts, which only
+    re-reads the configs whose mtime has changed.
+
+    Writes bump 'version' in the registry, which other processes watch to reload their copy.
+    '''
+    # suid -> {'identifier', 'owner', 'online', 'process_pid', 'config_mtime'}
+    entries = {}
+    # name -> suid
+    names = {}
+    loaded_pid = None
+    lock = threading.Lock()
+
+    def _ensure_loaded() -> None:
+        if server_registry.loaded_pid == os.getpid():
+            return
+        with server_registry.lock:
+            if server_registry.loaded_pid == os.getpid():
+                return
+            # Watch first, so nothing that changes while we read is missed.
+            var.watch(registry_path, 'version', server_registry._on_change)
+            server_registry._reload()
+            server_registry.loaded_pid = os.getpid()
+
+    def _reload() -> None:
+        entries = dict(var.get('servers', default={}, file=registry_path, dt_default=dt.SERVER_REGISTRY) or {})
+        server_registry.entries = entries
+        server_registry.names = {entry['identifier']: suid for suid, entry in entries.items()}
+
+    def _on_change(key_prefix, version) -> None:
+        with server_registry.lock:
+            server_registry._reload()
+
+    def _entry(server:dict) -> dict:
+        return {
+            'identifier': server.get('identifier'),
+            'owner': server.get('owner'),
+            'online': bool(server.get('online')),
+            'process_pid': server.get('process_pid'),
+            'config_mtime': config_mtime(server.get('server_unique_id')),
+        }
+
+    def _write(changes:dict) -> None:
+        '''
+        Saves entries to the registry file, and bumps its version. An entry of None removes that server.
+        '''
+        with var.transaction(file=registry_path, dt_default=dt.SERVER_REGISTRY) as tx:
+            for suid, entry in changes.items():
+                if entry is None:
+                    tx.delete(f'servers//{suid}')
+                else:
+                    tx.set(f'servers//{suid}', entry)
+            tx.set('version', (tx.get('version') or 0) + 1)
+
+        if server_registry.loaded_pid != os.getpid():
+            return
+        with server_registry.lock:
+            for suid, entry in changes.items():
+                old = server_registry.entries.pop(suid, None)
+                if old is not None and server_registry.names.get(old['identifier']) == suid:
+                    del server_registry.names[old['identifier']]
+                if entry is not None:
+                    server_registry.entries[suid] = entry
+                    server_registry.names[entry['identifier']] = suid
+
+    def add(server:dict) -> None:
+        '''
+        Adds a server to the registry, or updates it.
+
+        :param server: The server's config, such as server_record.to_dict().
+        '''
+        server_registry._write({server['server_unique_id']: server_registry._entry(server)})
+
+    def remove(suid:str) -> None:
+        server_registry._write({suid: None})
+
+    def set_online(suid:str, online:bool, process_pid:int=None) -> None:
+        '''
+        Updates a server's online flag and process ID, after its config has been updated.
+        '''
+        server_registry._ensure_loaded()
+        entry = server_registry.entries.get(suid)
+        if entry is None:
+            return
+        entry = dict(entry, online=bool(online), process_pid=process_pid, config_mtime=config_mtime(suid))
+        server_registry._write({suid: entry})
+
+    def rebuild() -> int:
+        '''
+        Brings the registry in line with the server directories. Configs that haven't changed since their
+        entry was made are not opened again.
+
+        :return: How many servers are registered.
+        '''
+        os.makedirs(servers_dir, exist_ok=True)
+        existing = dict(var.get('servers', default={}, file=registry_path, dt_default=dt.SERVER_REGISTRY) or {})
+
+        changes = {}
+        found = set()
+        for suid in server_dirs():
+            mtime = config_mtime(suid)
+            if mtime is None:
+                continue
+            found.add(suid)
+            entry = existing.get(suid)
+            if entry is not None and entry.get('config_mtime') == mtime:
+                continue
+            server = var.load_all(file=config_path(suid), dt_default=dt.SERVER_INSTANCE)
+            server = dict(server, server_unique_id=suid)
+            changes[suid] = server_registry._entry(server)
+
+        for suid in existing:
+            if suid not in found:
+                changes[suid] = None
+
+        if changes or not os.path.exists(registry_path):
+            server_registry._write(changes)
+        if changes:
+            logging.info(f"Rebuilt the server registry. {len(changes)} server(s) were added, changed or removed.")
+        return len(found)
+
+    def suid_of(name:str) -> str:
+        '''
+        :return: The SUID of the server with this name, or None if there is no such server.
+        '''
+        server_registry._ensure_loaded()
+        suid = server_registry.names.get(name)
+        if suid is None:
+            # It may have been made by another process a moment ago, and the watch hasn't caught up yet.
+            with server_registry.lock:
+                server_registry._reload()
+            suid = server_registry.names.get(name)
+        return suid
+
+    def name_of(suid:str) -> str:
+        '''
+        :return: The name of the server with this SUID, or None if there is no such server.
+        '''
+        server_registry._ensure_loaded()
+        entry = server_registry.entries.get(suid)
+        if entry is None:
+            with server_registry.lock:
+                server_registry._reload()
+            entry = server_registry.entries.get(suid)
+        return None if entry is None else entry['identifier']
+
+    def exists(suid:str=None, name:str=None) -> bool:
+        if suid is not None:
+            return server_registry.name_of(suid) is not None
+        return server_registry.suid_of(name) is not None
+
+    def owned_by(email_address:str=None) -> dict:
+        '''
+        The servers a user owns, or every server if email_address is None.
+
+        :return: A dict of SUID to registry entry.
+        '''
+        server_registry._ensure_loaded()
+        return {
+            suid: entry for suid, entry in list(server_registry.entries.items())
+            if email_address is None or entry['owner'] == email_address
+        }
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
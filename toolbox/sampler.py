@@ -0,0 +1,246 @@
+from toolbox.registry import server_registry
+from toolbox.diskusage import disk_usage
+from toolbox.pylog import pylog
+import time
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+# How often servers are sampled, in seconds.
+sample_interval = float(os.environ.get('RESOURCE_SAMPLE_INTERVAL', 5))
+# Reading a process's children costs more than its stat, so each server's process tree is only walked again
+# every this many samples (or sooner if one of its processes exits). Between walks the known processes are read.
+tree_refresh_every = 6
+
+clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+cpu_count = os.cpu_count() or 1
+
+def _since_boot() -> float:
+    '''
+    Seconds since the system booted, the clock the start times in /proc/<pid>/stat count on.
+    '''
+    clock = getattr(time, 'CLOCK_BOOTTIME', None)
+    return time.clock_gettime(clock) if clock is not None else time.monotonic()
+
+def _read(path:str) -> bytes:
+    '''
+    One read() of a small /proc file. Returns None if the process has gone.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+    try:
+        return os.read(fd, 4096)
+    except (ProcessLookupError, OSError):
+        return None
+    finally:
+        os.close(fd)
+
+# pid -> an open /proc/<pid>/stat. A /proc file can be read again from the start, so keeping it open saves
+# opening and closing it every sample. Once the process exits, reading it fails instead of reading another process.
+stat_fds = {}
+
+def _read_stat_file(pid:int) -> bytes:
+    fd = stat_fds.get(pid)
+    if fd is None:
+        try:
+            fd = os.open(f'/proc/{pid}/stat', os.O_RDONLY)
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return None
+        except OSError:
+            # Out of file descriptors, so this one isn't kept open.
+            return _read(f'/proc/{pid}/stat')
+        stat_fds[pid] = fd
+    try:
+        return os.pread(fd, 4096, 0)
+    except OSError:
+        os.close(stat_fds.pop(pid))
+        return None
+
+def close_stat_files(keep) -> None:
+    '''
+    Closes the stat files of every process not in keep.
+    '''
+    for pid in [pid for pid in stat_fds if pid not in keep]:
+        os.close(stat_fds.pop(pid))
+
+def read_stat(pid:int) -> tuple:
+    '''
+    Reads a process's CPU time (in clock ticks), thread count, start time (in clock ticks since boot) and resident
+    memory (in bytes) from /proc/<pid>/stat. That is the same resident size /proc/<pid>/statm has, so one file is enough.
+
+    :return: (ticks, threads, started, rss), or None if the process has gone.
+    '''
+    raw = _read_stat_file(pid)
+    if not raw:
+        return None
+    # The command name is in brackets and may hold spaces, so the fields are counted from the last ')'.
+    fields = raw[raw.rfind(b')') + 2:].split()
+    # utime and stime are fields 14 and 15 of the whole line, num_threads is 20, starttime 22 and rss (in pages) 24.
+    return int(fields[11]) + int(fields[12]), int(fields[17]), int(fields[19]), int(fields[21]) * page_size
+
+def children(pid:int, threads:int) -> list:
+    '''
+    The direct children of a process, from /proc/<pid>/task/<tid>/children of each of its threads.
+    '''
+    if threads == 1:
+        # The only thread is the main one, whose ID is the process's, so there is no need to list them.
+        tids = [pid]
+    else:
+        try:
+            tids = os.listdir(f'/proc/{pid}/task')
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return []
+    found = []
+    for tid in tids:
+        raw = _read(f'/proc/{pid}/task/{tid}/children')
+        if raw:
+            found.extend(int(child) for child in raw.split())
+    return found
+
+class resource_sampler:
+    '''
+    Measures how much CPU and RAM each running server (and everything it started) uses, straight from /proc,
+    and publishes it into the shared dict as shared['resources'] rather than writing every config.json.
+    The API lays these over the 'resources' of the configs it returns.
+
+    CPU use is the share of the whole machine the server's processes used since the last sample, worked
+    out from the clock ticks /proc/<pid>/stat reports.
+    '''
+    # pid -> ticks at the last sample, for every process in every server's tree.
+    last_ticks = {}
+    last_sampled = None
+    # The same moment as last_sampled, in seconds since boot.
+    last_since_boot = None
+    # suid -> (root pid, [every pid in its tree]) as of the last walk.
+    trees = {}
+    samples = 0
+
+    def sample() -> dict:
+        '''
+        Samples every online server once.
+
+        :return: A dict of SUID to its resource use.
+        '''
+        now = time.monotonic()
+        since_boot = _since_boot()
+        elapsed = None if resource_sampler.last_sampled is None else now - resource_sampler.last_sampled
+        walk_all = resource_sampler.samples % tree_refresh_every == 0
+        resource_sampler.samples += 1
+        ticks_seen = {}
+        trees = {}
+        results = {}
+
+        for suid, entry in server_registry.owned_by().items():
+            root = entry.get('process_pid')
+            if not entry.get('online') or root is None:
+                continue
+
+            ticks_used = 0
+            threads = 0
+            rss = 0
+            processes = 0
+            known = resource_sampler.trees.get(suid)
+            walk = walk_all or known is None or known[0] != root
+            # Walks the server's process tree breadth first, or just reads the processes found last time.
+            tree = [root] if walk else list(known[1])
+            alive = []
+            position = 0
+            while position < len(tree):
+                pid = tree[position]
+                position += 1
+                stat = read_stat(pid)
+                if stat is None:
+                    continue
+                ticks, thread_count, started, process_rss = stat
+                ticks_seen[pid] = ticks
+                previous = resource_sampler.last_ticks.get(pid)
+                if previous is None:
+                    if elapsed is not None and started / clock_ticks >= resource_sampler.last_since_boot:
+                        # Started since the last sample, so all of its time is new.
+                        previous = 0
+                    else:
+                        # Was already running, but wasn't seen until this walk. Its time so far can't be split
+                        # between samples, so it only counts from here on.
+                        previous = ticks
+                ticks_used += ticks - previous
+                threads += thread_count
+                rss += process_rss
+                processes += 1
+                alive.append(pid)
+                if walk:
+                    tree.extend(children(pid, thread_count))
+            # Anything gone means the tree changed, so it is walked again next time.
+            if walk or len(alive) == len(tree):
+                trees[suid] = (root, alive)
+
+            if processes == 0:
+                continue
+            cpu_percent = None
+            if elapsed:
+                cpu_percent = round(100 * ticks_used / (elapsed * clock_ticks * cpu_count), 1)
+            results[suid] = {
+                'RAM': {'used': round(rss / (1024 * 1024), 1)},
+                'CPU': {'used': cpu_percent},
+                'processes': processes,
+                'threads': threads,
+            }
+
+        # Disk use is kept up to date by disk_usage, so is there for offline servers too.
+        for suid in server_registry.owned_by():
+            used = disk_usage.usage(suid)
+            if used is not None:
+                results.setdefault(suid, {})['STORAGE'] = {'used': round(used / (1024 * 1024), 1)}
+
+        close_stat_files(ticks_seen)
+        resource_sampler.last_ticks = ticks_seen
+        resource_sampler.trees = trees
+        resource_sampler.last_sampled = now
+        resource_sampler.last_since_boot = since_boot
+        return results
+
+    def run(shared=None) -> None:
+        '''
+        Samples forever, every RESOURCE_SAMPLE_INTERVAL seconds. Meant to be run in its own process.
+
+        :param shared: The shared dict to publish into.
+        '''
+        if not os.path.isdir('/proc'):
+            logging.warning("There is no /proc on this system, so server resource use will not be measured.")
+            return
+        try:
+            import resource
+            # A stat file is kept open per server process, so allow as many open files as the system lets us.
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY or soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ImportError, ValueError, OSError):
+            pass
+
+        disk_usage.start()
+        while True:
+            started = time.monotonic()
+            try:
+                # Picks up new and deleted servers. Only new ones are walked.
+                disk_usage.sync()
+                cpu_before = time.process_time()
+                resources = resource_sampler.sample()
+                if shared is not None:
+                    # One write per pass, as each write to the shared dict is a round trip to the manager.
+                    shared['resources'] = {
+                        'sampled_at': time.time(),
+                        # How much CPU time the pass itself took, to keep an eye on the sampler's own cost.
+                        'sample_cpu_ms': round((time.process_time() - cpu_before) * 1000, 2),
+                        'servers': resources,
+                    }
+            except Exception as err:
+                logging.error("Sampling server resources failed.", exception=err)
+            try:
+                time.sleep(max(0, sample_interval - (time.monotonic() - started)))
+            except KeyboardInterrupt:
+                return
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
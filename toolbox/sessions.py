@@ -1,11 +1,553 @@
-from toolbox.storage import var, dt, settings_path
+from toolbox.storage import var, settings_path
+from toolbox.records import token_record
 from toolbox.security import sanitize
 from toolbox.pylog import pylog
+import threading
+import hashlib
 import secrets
+import base64
+import heapq
+import hmac
 import datetime
+import json
+import time
+import os
 
 logging = pylog(filename='logs/rose_%TIMENOW%.log')
 
+# How many token changes 'token_changes' in the settings file remembers. A process that falls further behind
+# than this re-reads every token.
+change_log_size = 256
+
+def _get_if_exists(key:str, default=None) -> object:
+    # Settings files from before a key was added don't have it, and var.get logs an error for a missing key.
+    if var.exists(key, file=settings_path):
+        return var.get(key, file=settings_path)
+    return default
+
+def log_token_changes(tx, tokens) -> None:
+    '''
+    Records which tokens were added, changed or removed, in the transaction that changes them. Other processes
+    watch 'tokens_version', and then only re-read the tokens listed in 'token_changes' instead of all of them.
+
+    :param tx: The settings file transaction.
+    :param tokens: The tokens that changed, or None if they all did (such as when every session is cleared).
+    '''
+    version = (tx.get('tokens_version') or 0) + 1
+    changes = [] if tokens is None else list(tx.get('token_changes') or []) + [[version, token] for token in tokens]
+    if len(changes) > change_log_size:
+        changes = changes[-change_log_size:]
+        # Only whole versions are kept, so readers can tell what they missed. The oldest may have been cut short.
+        changes = [change for change in changes if change[0] != changes[0][0]]
+    if not changes:
+        # A None token tells readers to re-read everything.
+        changes = [[version, None]]
+    tx.set('token_changes', changes)
+    tx.set('tokens_version', version)
+
+def read_token_changes(since:int) -> tuple:
+    '''
+    Reads the sessions of the tokens that changed since a version of 'tokens_version'.
+
+    :return: (the version now, {token: its session, or None if it was removed}), or (the version now, None) if
+    the log doesn't go back far enough (or everything changed), so every token has to be re-read.
+    '''
+    changes = _get_if_exists('token_changes', []) or []
+    version = changes[-1][0] if changes else _get_if_exists('tokens_version', 0)
+    # The log only holds whole versions, trimmed from the front. It has everything after 'since' if it reaches back to the next one.
+    if since is None or not changes or changes[0][0] > since + 1 or since > version:
+        return version, None
+    tokens = {token for changed_at, token in changes if changed_at > since}
+    if None in tokens:
+        return version, None
+    return version, {token: _get_if_exists(f'tokens//{token}') for token in tokens}
+
+def permission_mask(account_perms) -> int:
+    '''
+    Returns an account's permissions as a bitmask. Accounts store the mask itself, but older ones
+    store a dict ({'1': True, '2': False, ...}) which is folded into one here.
+    '''
+    if isinstance(account_perms, int):
+        return account_perms
+    mask = 0
+    for permission, value in dict(account_perms or {}).items():
+        if value is True:
+            mask |= int(permission)
+    return mask
+
+class token_entry:
+    __slots__ = ('email_address', 'expire_on', 'permissions')
+
+    def __init__(self, email_address:str, expire_on:float, permissions:int):
+        self.email_address = email_address
+        self.expire_on = expire_on
+        self.permissions = permissions
+
+class token_index:
+    '''
+    An in-memory copy of the tokens in the settings file (token -> owner, expiry, permission mask), so checking
+    a token is a dict lookup instead of several reads of the settings file.
+
+    It is loaded the first time it is used in a process. From then on sessions.save/delete keep it up to date
+    directly, and a var.watch on 'tokens_version' picks up changes made by other processes (such as the CLI's
+    expiry sweeper), re-reading only the tokens that changed. (see read_token_changes)
+    '''
+    entries = {}
+    loaded = False
+    pid = None
+    subscription = None
+    # The 'tokens_version' the index is up to date with.
+    version = None
+    lock = threading.Lock()
+    # What the index reads of each token.
+    fields = ['belongs_to', 'expire_on']
+
+    def _ensure_loaded() -> None:
+        if token_index.loaded is True and token_index.pid == os.getpid():
+            return
+        with token_index.lock:
+            if token_index.loaded is True and token_index.pid == os.getpid():
+                return
+            # Watch first, so nothing that changes while we read is missed.
+            token_index.subscription = var.watch(settings_path, 'tokens_version', token_index._on_change)
+            token_index.version = _get_if_exists('tokens_version', 0)
+            token_index.entries = token_index._build(var.fields('tokens', token_index.fields, file=settings_path), {})
+            token_index.pid = os.getpid()
+            token_index.loaded = True
+
+    def _build(tokens:dict, previous:dict) -> dict:
+        '''
+        Builds the index from the tokens dict, reusing the entries of tokens that have not changed.
+        Only the fields the index needs are read, as copying every token and account out is slow.
+        '''
+        entries = {}
+        accounts = None
+        for token, session in (tokens or {}).items():
+            if not isinstance(session, dict):
+                continue
+            email_address = session.get('belongs_to')
+            expire_on = session.get('expire_on')
+            entry = previous.get(token)
+            if entry is not None and entry.email_address == email_address and entry.expire_on == expire_on:
+                entries[token] = entry
+                continue
+
+            if accounts is None:
+                accounts = var.fields('accounts', ['permissions'], file=settings_path)
+            account = accounts.get(email_address) or {}
+            entries[token] = token_entry(email_address, expire_on, permission_mask(account.get('permissions')))
+        return entries
+
+    def _on_change(key_prefix, version) -> None:
+        version, changed = read_token_changes(token_index.version)
+        if changed is None:
+            entries = token_index._build(var.fields('tokens', token_index.fields, file=settings_path), token_index.entries)
+            with token_index.lock:
+                token_index.entries = entries
+                token_index.version = version
+            return
+
+        with token_index.lock:
+            for token, session in changed.items():
+                if not isinstance(session, dict):
+                    token_index.entries.pop(token, None)
+                    continue
+                email_address = session.get('belongs_to')
+                expire_on = session.get('expire_on')
+                entry = token_index.entries.get(token)
+                if entry is None or entry.email_address != email_address or entry.expire_on != expire_on:
+                    account_perms = _get_if_exists(f'accounts//{email_address}//permissions', {})
+                    token_index.entries[token] = token_entry(email_address, expire_on, permission_mask(account_perms))
+            token_index.version = version
+
+    def lookup(token:str) -> token_entry:
+        '''
+        Returns the entry of a token, or None if the token does not exist or has expired.
+        '''
+        token_index._ensure_loaded()
+        entry = token_index.entries.get(token)
+        if entry is None:
+            return None
+        if entry.expire_on is not None and entry.expire_on < time.time():
+            return None
+        return entry
+
+    def put(token:str, email_address:str, expire_on:float, account_perms:dict=None) -> None:
+        # Only kept up to date once loaded. Before that there's nothing to update, and the load will see it.
+        if token_index.loaded is not True or token_index.pid != os.getpid():
+            return
+        if account_perms is None:
+            account_perms = var.get(f'accounts//{email_address}//permissions', default={}, file=settings_path)
+        token_index.entries[token] = token_entry(email_address, expire_on, permission_mask(account_perms))
+
+    def drop(token:str) -> None:
+        if token_index.loaded is not True or token_index.pid != os.getpid():
+            return
+        token_index.entries.pop(token, None)
+
+    def refresh_account(email_address:str) -> None:
+        '''
+        Updates the permission mask of every token of an account. Call after its permissions change.
+        '''
+        if token_index.loaded is not True or token_index.pid != os.getpid():
+            return
+        account_perms = var.get(f'accounts//{email_address}//permissions', default={}, file=settings_path)
+        mask = permission_mask(account_perms)
+        for entry in list(token_index.entries.values()):
+            if entry.email_address == email_address:
+                entry.permissions = mask
+
+class session_expiry:
+    '''
+    Deletes tokens as they expire. Tokens are kept in a min-heap ordered by expiry, so the sweeper sleeps
+    until exactly when the next token expires and then only touches the tokens that actually expired,
+    removing them all in one write. New and deleted tokens are picked up with a var.watch on 'tokens_version',
+    which only re-reads the tokens that changed. (see read_token_changes)
+    '''
+    heap = []
+    # token -> expire_on of everything that is scheduled. Heap entries that don't match are stale and skipped.
+    scheduled = {}
+    lock = threading.Lock()
+    wakeup = threading.Event()
+    # Upper bound on a single sleep, in case a change is ever missed.
+    max_sleep = 60
+    # The 'tokens_version' the schedule is up to date with.
+    version = None
+    counters = {
+        'sweeps': 0,
+        'expired_total': 0,
+        'last_lag': 0.0,
+        'max_lag': 0.0,
+        'last_sweep': None,
+    }
+
+    def schedule(tokens:dict, complete=True) -> None:
+        '''
+        Brings the schedule in line with the tokens dict of the settings file.
+
+        :param tokens: token -> session dict, like the 'tokens' key of the settings file.
+        :param complete: If True, tokens holds every token, so anything scheduled that isn't in it is dropped.
+        '''
+        tokens = dict(tokens or {})
+        with session_expiry.lock:
+            if complete:
+                for token in set(session_expiry.scheduled) - set(tokens):
+                    del session_expiry.scheduled[token]
+
+            earliest = session_expiry.heap[0][0] if session_expiry.heap else None
+            for token, session in tokens.items():
+                expire_on = session.get('expire_on') if isinstance(session, dict) else None
+                if expire_on is None or session_expiry.scheduled.get(token) == expire_on:
+                    continue
+                session_expiry.scheduled[token] = expire_on
+                heapq.heappush(session_expiry.heap, (expire_on, token))
+                if earliest is None or expire_on < earliest:
+                    earliest = expire_on
+                    session_expiry.wakeup.set()
+
+            # Deleted and re-scheduled tokens leave stale entries behind. Rebuild once they outnumber the live ones.
+            if len(session_expiry.heap) > 2 * len(session_expiry.scheduled) + 64:
+                session_expiry.heap = [(expire_on, token) for token, expire_on in session_expiry.scheduled.items()]
+                heapq.heapify(session_expiry.heap)
+
+    def unschedule(tokens) -> None:
+        with session_expiry.lock:
+            for token in tokens:
+                session_expiry.scheduled.pop(token, None)
+
+    def reload() -> None:
+        '''
+        Schedules every token in the settings file, dropping anything scheduled that is no longer there.
+        '''
+        version = _get_if_exists('tokens_version', 0)
+        session_expiry.schedule(var.fields('tokens', ['expire_on'], file=settings_path))
+        session_expiry.version = version
+
+    def _on_change(key_prefix, version) -> None:
+        version, changed = read_token_changes(session_expiry.version)
+        if changed is None:
+            session_expiry.reload()
+            return
+        session_expiry.unschedule([token for token, session in changed.items() if session is None])
+        session_expiry.schedule({token: session for token, session in changed.items() if session is not None}, complete=False)
+        session_expiry.version = version
+
+    def _pop_due(now:float) -> list:
+        due = []
+        with session_expiry.lock:
+            heap = session_expiry.heap
+            while heap and heap[0][0] <= now:
+                expire_on, token = heapq.heappop(heap)
+                if session_expiry.scheduled.get(token) != expire_on:
+                    continue
+                del session_expiry.scheduled[token]
+                due.append((expire_on, token))
+        return due
+
+    def sweep(now:float=None) -> int:
+        '''
+        Deletes every token that has expired, in a single write.
+
+        :return: How many tokens were deleted.
+        '''
+        now = time.time() if now is None else now
+        due = session_expiry._pop_due(now)
+        if len(due) == 0:
+            return 0
+
+        deleted = []
+        with var.transaction(file=settings_path) as tx:
+            for expire_on, token in due:
+                # Checked again against the file, in case the token was renewed or removed since it was scheduled.
+                session = tx.get(f'tokens//{token}')
+                if not isinstance(session, dict) or session.get('expire_on') is None:
+                    continue
+                if session['expire_on'] > now:
+                    session_expiry.schedule({token: session}, complete=False)
+                    continue
+                session_owner = session.get('belongs_to')
+                if tx.get(f'accounts//{session_owner}//current_session') == token:
+                    tx.set(f'accounts//{session_owner}//current_session', None)
+                tx.delete(f'tokens//{token}')
+                deleted.append(token)
+            if deleted:
+                log_token_changes(tx, deleted)
+
+        lag = now - min(expire_on for expire_on, _ in due)
+        counters = session_expiry.counters
+        counters['sweeps'] += 1
+        counters['expired_total'] += len(deleted)
+        counters['last_lag'] = lag
+        counters['max_lag'] = max(counters['max_lag'], lag)
+        counters['last_sweep'] = now
+        if deleted:
+            logging.info(f"Deleted {len(deleted)} expired session(s).")
+        return len(deleted)
+
+    def stats() -> dict:
+        '''
+        :return: The queue depth (tokens waiting to expire), when the next one expires, and how late sweeps ran. (lag, in seconds)
+        '''
+        with session_expiry.lock:
+            next_expiry = session_expiry.heap[0][0] if session_expiry.heap else None
+            data = dict(session_expiry.counters)
+            data['queue_depth'] = len(session_expiry.scheduled)
+            data['next_expiry'] = next_expiry
+        return data
+
+    def run(shared=None) -> None:
+        '''
+        Runs the sweeper forever. Intended to be run in its own thread or process.
+
+        :param shared: A shared dict (from the multiprocessing manager) to publish stats() into, as 'session_expiry'.
+        '''
+        # Watch first, so nothing that changes while we read is missed.
+        var.watch(settings_path, 'tokens_version', session_expiry._on_change)
+        session_expiry.reload()
+
+        while True:
+            session_expiry.sweep()
+            stats = session_expiry.stats()
+            if shared is not None:
+                shared['session_expiry'] = stats
+
+            if stats['next_expiry'] is None:
+                timeout = session_expiry.max_sleep
+            else:
+                timeout = min(max(stats['next_expiry'] - time.time(), 0), session_expiry.max_sleep)
+            session_expiry.wakeup.wait(timeout)
+            session_expiry.wakeup.clear()
+
+def _b64encode(raw:bytes) -> str:
+    # url-safe (no '/', which would break key paths) and without the '=' padding.
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def _b64decode(text:str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+class signed_tokens:
+    '''
+    Tokens that carry their owner, expiry and permission bits, signed with HMAC-SHA256. (payload.signature)
+    Used for new sessions when the SESSION_TOKENS environment variable is set to 'signed'.
+
+    They are never stored. A signed token is valid if its signature checks out, it hasn't expired, and it isn't
+    in the small set of revocations in revoked_sessions.json, which every process keeps in memory:
+    - 'revoked': the nonce of each logged out token, until it expires.
+    - 'accounts': tokens of an account issued before a time, such as when the account is deleted.
+    - 'before': every token issued before a time, such as when all sessions are cleared.
+    So checking one never reads the settings file. The permission bits are the account's at the time it was
+    issued. Routes still check the account's current permissions (see permissions.mask).
+    '''
+    key_path = 'toolbox/session.key'
+    revoked_path = 'revoked_sessions.json'
+    revoked_default = {'revoked': {}, 'accounts': {}, 'before': None, 'version': 0}
+    key = None
+    # nonce -> expire_on of revoked tokens that have not expired yet.
+    revoked = {}
+    # email -> [tokens issued at or before this are revoked, when the last of those expires]
+    revoked_accounts = {}
+    revoked_before = None
+    revoked_pid = None
+    lock = threading.Lock()
+
+    def enabled() -> bool:
+        return str(os.environ.get('SESSION_TOKENS', 'random')).lower() == 'signed'
+
+    def load_key() -> bytes:
+        '''
+        Loads the signing key, making a new one if there isn't one yet.
+        Deleting the key file logs everyone with a signed token out.
+        '''
+        if signed_tokens.key is not None:
+            return signed_tokens.key
+
+        with signed_tokens.lock:
+            if signed_tokens.key is None:
+                if not os.path.isfile(signed_tokens.key_path):
+                    os.makedirs(os.path.dirname(signed_tokens.key_path), exist_ok=True)
+                    try:
+                        fd = os.open(signed_tokens.key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                        with os.fdopen(fd, 'wb') as f:
+                            f.write(secrets.token_bytes(32))
+                        logging.info(f"Created a new session signing key at '{signed_tokens.key_path}'.")
+                    except FileExistsError:
+                        # Another process made it first.
+                        pass
+                with open(signed_tokens.key_path, 'rb') as f:
+                    signed_tokens.key = f.read()
+        return signed_tokens.key
+
+    def _sign(payload:str) -> str:
+        return _b64encode(hmac.new(signed_tokens.load_key(), payload.encode(), hashlib.sha256).digest())
+
+    def is_signed(token:str) -> bool:
+        # Random tokens are url-safe base64, which never has a '.' in it.
+        return isinstance(token, str) and token.count('.') == 1
+
+    def issue(email_address:str, expire_on:float, account_perms:int=0) -> str:
+        '''
+        Makes a signed token.
+
+        :param email_address: Who the token belongs to.
+        :param expire_on: The timestamp the token expires at.
+        :param account_perms: The account's permission mask.
+        :return: The token.
+        '''
+        payload = _b64encode(json.dumps({
+            'e': email_address,
+            'x': expire_on,
+            'i': time.time(),
+            'p': account_perms,
+            'n': _b64encode(secrets.token_bytes(12)),
+        }, separators=(',', ':')).encode())
+        return f'{payload}.{signed_tokens._sign(payload)}'
+
+    def _payload(token:str) -> dict:
+        '''
+        :return: The payload of a token if its signature is valid, otherwise None.
+        '''
+        if not signed_tokens.is_signed(token):
+            return None
+        payload, signature = token.split('.')
+        if not hmac.compare_digest(signature.encode(), signed_tokens._sign(payload).encode()):
+            return None
+        try:
+            data = json.loads(_b64decode(payload))
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+    def decode(token:str) -> dict:
+        '''
+        Checks a signed token's signature, expiry and whether it was revoked.
+
+        :return: The payload ('email_address', 'expire_on', 'issued_at', 'permissions', 'nonce'),
+        or None if the token is not valid.
+        '''
+        data = signed_tokens._payload(token)
+        if data is None:
+            return None
+        try:
+            signed_tokens._load_revocations()
+            if data['x'] < time.time() or data['n'] in signed_tokens.revoked:
+                return None
+            if signed_tokens.revoked_before is not None and data['i'] <= signed_tokens.revoked_before:
+                return None
+            account_cutoff = signed_tokens.revoked_accounts.get(data['e'])
+            if account_cutoff is not None and data['i'] <= account_cutoff[0]:
+                return None
+            return {
+                'email_address': data['e'],
+                'expire_on': data['x'],
+                'issued_at': data['i'],
+                'permissions': int(data['p']),
+                'nonce': data['n'],
+            }
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _load_revocations() -> None:
+        if signed_tokens.revoked_pid != os.getpid():
+            with signed_tokens.lock:
+                if signed_tokens.revoked_pid != os.getpid():
+                    # Watch first, so nothing that changes while we read is missed.
+                    var.watch(signed_tokens.revoked_path, 'version', signed_tokens._on_revoked)
+                    signed_tokens._on_revoked()
+                    signed_tokens.revoked_pid = os.getpid()
+
+    def _on_revoked(key_prefix=None, version=None) -> None:
+        revocations = var.load_all(file=signed_tokens.revoked_path, dt_default=signed_tokens.revoked_default)
+        signed_tokens.revoked = dict(revocations.get('revoked') or {})
+        signed_tokens.revoked_accounts = dict(revocations.get('accounts') or {})
+        signed_tokens.revoked_before = revocations.get('before')
+
+    def _revoke(key:str, value) -> None:
+        '''
+        Adds a revocation, dropping the ones that no longer matter as everything they cover has expired.
+        Other processes pick it up through 'version'.
+
+        :param key: The key in revoked_sessions.json, such as 'revoked//<nonce>'.
+        :param value: What to set it to.
+        '''
+        now = time.time()
+        with var.transaction(file=signed_tokens.revoked_path, dt_default=signed_tokens.revoked_default) as tx:
+            for nonce, expire_on in dict(tx.get('revoked') or {}).items():
+                if expire_on < now:
+                    tx.delete(f'revoked//{nonce}')
+            for email_address, (_, last_expiry) in dict(tx.get('accounts') or {}).items():
+                if last_expiry < now:
+                    tx.delete(f'accounts//{email_address}')
+            tx.set(key, value)
+            tx.set('version', (tx.get('version') or 0) + 1)
+        signed_tokens._on_revoked()
+
+    def revoke(token:str) -> bool:
+        '''
+        Stops a signed token from being accepted before it expires.
+
+        :return: True if it was revoked, False if it was not a validly signed token.
+        '''
+        data = signed_tokens._payload(token)
+        if data is None or 'n' not in data or 'x' not in data:
+            return False
+        # Expired tokens are rejected anyway, so there's no need to remember them.
+        if data['x'] >= time.time():
+            signed_tokens._revoke(f"revoked//{data['n']}", data['x'])
+        return True
+
+    def revoke_account(email_address:str) -> None:
+        '''
+        Stops every signed token issued to an account so far from being accepted, such as when it is deleted.
+        '''
+        # Kept until a token issued now would expire, as none issued before it can outlive that.
+        signed_tokens._revoke(f'accounts//{email_address}', [time.time(), sessions.expiry()])
+
+    def revoke_all() -> None:
+        '''
+        Stops every signed token issued so far from being accepted, such as when all sessions are cleared.
+        '''
+        signed_tokens._revoke('before', time.time())
+
 class sessions:
     def new(email_address:str, do_save:bool=True) -> str:
         '''
@@ -24,20 +566,54 @@ class sessions:
                 logging.info(f"Session {token} Continued for {email_address}")
                 return token
 
-        # Generate a new token.
-        token = secrets.token_urlsafe(64)
-
-        # Makes sure that the token does not have a / in it.
-        while '/' in token:
+        expire_on = sessions.expiry()
+        if signed_tokens.enabled():
+            # Signed tokens are never stored, so there is nothing to save.
+            account_perms = _get_if_exists(f'accounts//{email_address}//permissions', 0)
+            token = signed_tokens.issue(email_address, expire_on, permission_mask(account_perms))
+        else:
+            # Generate a new token.
             token = secrets.token_urlsafe(64)
 
-        # Save the token to the memory file if specified.
-        if do_save:
-            sessions.save(token, email_address)
+            # Makes sure that the token does not have a / in it.
+            while '/' in token:
+                token = secrets.token_urlsafe(64)
+
+            # Save the token to the memory file if specified.
+            if do_save:
+                sessions.save(token, email_address, expire_on=expire_on)
 
         logging.info(f"New Session {token} Created for {email_address}")
         return token
 
+    def lookup(token:str) -> token_entry:
+        '''
+        Finds who a token belongs to, without touching the disk. This is the one rule every route goes by.
+        A random token is valid while it is in the token index, which logging out, expiry, deleting the account
+        and clearing sessions all remove it from. A signed token is valid while its signature checks out, it has not
+        expired and it has not been revoked, which logging out, deleting the account and clearing sessions do.
+        (see signed_tokens)
+
+        :param token: The token to check.
+        :return: The token's entry, or None if it is not valid.
+        '''
+        if signed_tokens.is_signed(token):
+            # Only while signed tokens are in use, so switching back to random tokens ends every signed session.
+            payload = signed_tokens.decode(token) if signed_tokens.enabled() else None
+            if payload is None:
+                return None
+            return token_entry(payload['email_address'], payload['expire_on'], payload['permissions'])
+        return token_index.lookup(token)
+
+    def validate(token:str) -> bool:
+        '''
+        Checks if a token is valid. (see sessions.lookup)
+
+        :param token: The token to check.
+        :return: True if the token is valid.
+        '''
+        return sessions.lookup(token) is not None
+
     def find(email_address):
         '''
         Finds the token of the user.
@@ -49,28 +625,42 @@ class sessions:
         token = var.get(f'accounts//{email_address}//current_session')
         return token
 
-    def save(token:str, email_address:str, expire_in:datetime.timedelta=datetime.timedelta(hours=4)) -> bool:
+    def expiry(expire_in:datetime.timedelta=datetime.timedelta(hours=4)) -> float:
+        '''
+        Works out when a token made now expires. The 'token_lifespan' setting (in seconds) overrides expire_in.
+
+        :param expire_in: The time until the token expires.
+        :return: The timestamp it expires at.
+        '''
+        token_lifespan = var.get('token_lifespan')
+        if isinstance(token_lifespan, int):
+            # Convert the token lifespan to a timedelta object.
+            expire_in = datetime.timedelta(seconds=token_lifespan)
+        return (datetime.datetime.now() + expire_in).timestamp() # int/float for json file.
+
+    def save(token:str, email_address:str, expire_in:datetime.timedelta=datetime.timedelta(hours=4), expire_on:float=None) -> bool:
         '''
         Saves the token to the memory file.
 
         :param email_address: The email address of the user.
         :param expire_in: The time until the token expires.
+        :param expire_on: When the token expires, if already known. Overrides expire_in.
         :return:
         '''
         email_address = sanitize(email_address)
 
-        token_dict = dt.TOKEN_DICT
-        token_lifespan = var.get('token_lifespan')
-        if token_lifespan is int:
-            # Convert the token lifespan to a timedelta object.
-            expire_in = datetime.timedelta(seconds=token_lifespan)
+        if expire_on is None:
+            expire_on = sessions.expiry(expire_in)
 
-        # Dict is filled with None by default. Sets the values we need.
-        token_dict['expire_on'] = (datetime.datetime.now() + expire_in).timestamp() # int/float for json file.
-        token_dict['belongs_to'] = email_address
-        token_dict['activity'] = {'session_created': datetime.datetime.now().timestamp()} # same reason as above.
-        var.set(f'tokens//{token}', token_dict, file=settings_path)
-        var.set(f'accounts//{email_address}//current_session', token, file=settings_path)
+        token_data = token_record(
+            expire_on=expire_on,
+            belongs_to=email_address,
+        )
+        with var.transaction(file=settings_path) as tx:
+            tx.set(f'tokens//{token}', token_data.to_dict())
+            tx.set(f'accounts//{email_address}//current_session', token)
+            log_token_changes(tx, [token])
+        token_index.put(token, email_address, token_data.expire_on)
         return True
 
     def delete(token:str) -> bool:
@@ -81,15 +671,25 @@ class sessions:
         '''
         token = sanitize(token)
 
-        # Finds who the token belongs to
-        email = var.get(f'tokens//{token}//belongs_to')
+        if signed_tokens.is_signed(token):
+            # Never stored, so it is revoked instead.
+            payload = signed_tokens.decode(token)
+            signed_tokens.revoke(token)
+            email = None if payload is None else payload['email_address']
+            logging.info(f"Session {token} Deleted for {email}")
+            return True
 
-        # Deletes the token
-        var.delete(f'tokens//{token}')
+        with var.transaction(file=settings_path) as tx:
+            # Finds who the token belongs to
+            email = tx.get(f'tokens//{token}//belongs_to')
 
-        # Removes the 'current_session' from the user's account
+            # Deletes the token
+            tx.delete(f'tokens//{token}')
 
-        var.set(f'accounts//{email}//current_session', None, file=settings_path)
+            # Removes the 'current_session' from the user's account
+            tx.set(f'accounts//{email}//current_session', None)
+            log_token_changes(tx, [token])
+        token_index.drop(token)
         logging.info(f"Session {token} Deleted for {email}")
 
         return True
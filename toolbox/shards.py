@@ -0,0 +1,290 @@
+from toolbox.storage import (
+    key_seperator, key_path, settings_path, transaction as document_transaction, file_lock,
+    _read_document, _ensure_document, _get_path, _pick_fields, _active_transactions, journal_suffix, lock_suffix
+)
+from toolbox.pylog import pylog
+import hashlib
+import copy
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+# Top-level keys of the settings file that are kept one file per record when sharded.
+sharded_tables = ['accounts', 'tokens']
+
+# Settings files that have had their inline accounts/tokens moved out into shards by this process.
+_prepared = set()
+
+def shard_root(file) -> str:
+    '''
+    Returns the directory the shards of a file live in. (settings.json -> settings.shards)
+    '''
+    return os.path.splitext(os.path.abspath(file))[0] + '.shards'
+
+def shard_path(file, table:str, record_key:str) -> str:
+    '''
+    Returns the file a record lives in. Records are spread over sub-directories named after the first
+    two characters of the hash of their key, so no directory gets too big.
+    '''
+    digest = hashlib.sha256(str(record_key).encode()).hexdigest()
+    return os.path.join(shard_root(file), table, digest[:2], f'{digest}.json')
+
+def _is_shard(name:str) -> bool:
+    return name.endswith('.json') and not name.startswith('.')
+
+def _list_shards(file, table:str) -> list:
+    table_dir = os.path.join(shard_root(file), table)
+    shards = []
+    try:
+        prefixes = list(os.scandir(table_dir))
+    except FileNotFoundError:
+        return shards
+
+    for prefix in prefixes:
+        if not prefix.is_dir():
+            continue
+        for entry in os.scandir(prefix.path):
+            if _is_shard(entry.name):
+                shards.append(entry.path)
+    return shards
+
+def _read_shard(path) -> dict:
+    '''
+    Returns the cached document of a shard, or an empty dict if the record does not exist.
+    '''
+    # Checked first so looking up a record that doesn't exist doesn't leave a lock file behind for it.
+    if not os.path.exists(path):
+        return {}
+    try:
+        return _read_document(path)
+    except FileNotFoundError:
+        return {}
+
+def _remove_shard(path) -> None:
+    for suffix in ['', journal_suffix, lock_suffix]:
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+def _load_table(file, table:str) -> dict:
+    '''
+    Returns every record of a table. The records are copied, as the shards they come from are cached.
+    '''
+    records = {}
+    for path in _list_shards(file, table):
+        records.update(copy.deepcopy(_read_shard(path)))
+    return records
+
+def _prepare(file) -> None:
+    '''
+    Moves any accounts/tokens still stored inline in the settings file out into shards.
+    Only checks once per process, as after that everything is written to the shards.
+    '''
+    path = os.path.abspath(file)
+    if path in _prepared:
+        return
+    if os.path.exists(path):
+        shards.migrate(path)
+    _prepared.add(path)
+
+class transaction:
+    '''
+    The sharded version of storage.transaction. Keys under 'accounts//<email>' and 'tokens//<token>' are
+    routed to that record's own file, and everything else goes to the settings file as usual.
+
+    The settings file is locked for the whole transaction, which keeps writers that touch several records
+    from deadlocking each other. Each file is written atomically, but a transaction touching several files
+    is not atomic as a whole.
+    '''
+    def __init__(self, file=settings_path, dt_default=None):
+        self.file = file
+        self.dt_default = dt_default
+        self.base = None
+        self.shards = {}
+        self.outer = None
+
+    def __enter__(self):
+        path = os.path.abspath(self.file)
+        active = _active_transactions().get(path)
+        if active is not None:
+            self.outer = active
+            return active
+
+        _prepare(self.file)
+        self.base = document_transaction(file=self.file, dt_default=self.dt_default)
+        self.base.__enter__()
+        # Nested var.transaction() calls on the settings file should find this, not the plain base transaction.
+        _active_transactions()[path] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.outer is not None:
+            self.outer = None
+            return False
+
+        try:
+            for path, shard in self.shards.items():
+                is_empty = shard.data == {}
+                shard.__exit__(exc_type, exc_value, exc_traceback)
+                if is_empty and exc_type is None:
+                    _remove_shard(path)
+        finally:
+            self.shards = {}
+            _active_transactions()[os.path.abspath(self.file)] = self.base
+            self.base.__exit__(exc_type, exc_value, exc_traceback)
+        return False
+
+    def _shard(self, table:str, record_key:str, create=True) -> document_transaction:
+        '''
+        Returns the open transaction on a record's file, opening it if needed.
+        Returns None if create is False and the record does not exist.
+        '''
+        path = shard_path(self.file, table, record_key)
+        shard = self.shards.get(path)
+        if shard is None:
+            if create is False and not os.path.exists(path):
+                return None
+            shard = document_transaction(file=path, dt_default={})
+            shard.__enter__()
+            self.shards[path] = shard
+        return shard
+
+    def _clear_table(self, table:str) -> None:
+        for path in _list_shards(self.file, table):
+            if path in self.shards:
+                shard = self.shards[path]
+                for record_key in list(shard.data.keys()):
+                    shard.delete(record_key)
+            else:
+                with file_lock(path, exclusive=True):
+                    _remove_shard(path)
+
+    def get(self, key, default=None) -> object:
+        keys = key_path(key)
+        if keys[0] not in sharded_tables:
+            return self.base.get(key, default)
+
+        if len(keys) == 1:
+            records = _load_table(self.file, keys[0])
+            table_dir = os.path.join(shard_root(self.file), keys[0]) + os.sep
+            for path, shard in self.shards.items():
+                if not path.startswith(table_dir):
+                    continue
+                # What is on disk is from before this transaction, so records it deleted are dropped here.
+                for record_key in _read_shard(path):
+                    if record_key not in shard.data:
+                        records.pop(record_key, None)
+                records.update(copy.deepcopy(shard.data))
+            return records
+        shard = self._shard(keys[0], keys[1], create=False)
+        if shard is None:
+            return default
+        return shard.get(key_seperator.join(keys[1:]), default)
+
+    def set(self, key, value) -> bool:
+        keys = key_path(key)
+        if keys[0] not in sharded_tables:
+            return self.base.set(key, value)
+
+        if len(keys) == 1:
+            self._clear_table(keys[0])
+            for record_key, record in dict(value).items():
+                self._shard(keys[0], record_key).set(record_key, record)
+            return True
+        return self._shard(keys[0], keys[1]).set(key_seperator.join(keys[1:]), value)
+
+    def delete(self, key) -> bool:
+        keys = key_path(key)
+        if keys[0] not in sharded_tables:
+            return self.base.delete(key)
+
+        if len(keys) == 1:
+            self._clear_table(keys[0])
+            return True
+        shard = self._shard(keys[0], keys[1], create=False)
+        if shard is None:
+            return False
+        return shard.delete(key_seperator.join(keys[1:]))
+
+class shards:
+    '''
+    A storage layout for the settings file where every account and every token is its own small file,
+    so looking up or changing one touches one file no matter how many accounts there are.
+    It is used by storage.var when the STORAGE_LAYOUT environment variable is set to 'sharded'.
+    '''
+    def get(file, keys:list, default=None, dt_default=None) -> object:
+        _prepare(file)
+        if keys[0] not in sharded_tables:
+            _ensure_document(file, dt_default)
+            return copy.deepcopy(_get_path(_read_document(file), keys, default))
+
+        if len(keys) == 1:
+            return _load_table(file, keys[0])
+        record = _read_shard(shard_path(file, keys[0], keys[1]))
+        return copy.deepcopy(_get_path({keys[0]: record}, keys, default))
+
+    def keys(file, keys:list) -> list:
+        _prepare(file)
+        if keys[0] in sharded_tables and len(keys) == 1:
+            record_keys = []
+            for path in _list_shards(file, keys[0]):
+                record_keys.extend(_read_shard(path).keys())
+            return record_keys
+        value = shards.get(file, keys, default=None, dt_default=None)
+        return list(value) if isinstance(value, dict) else []
+
+    def fields(file, keys:list, names:list) -> dict:
+        _prepare(file)
+        if keys[0] in sharded_tables and len(keys) == 1:
+            records = {}
+            for path in _list_shards(file, keys[0]):
+                records.update(_pick_fields(_read_shard(path), names))
+            return records
+        return _pick_fields(shards.get(file, keys, default=None, dt_default=None), names)
+
+    def load_all(file, dt_default=None) -> dict:
+        _prepare(file)
+        _ensure_document(file, dt_default)
+        data = copy.deepcopy(_read_document(file))
+        for table in sharded_tables:
+            data[table] = _load_table(file, table)
+        return data
+
+    def fill(file, data:dict) -> bool:
+        # The records go to their shards, so the settings file itself starts out with the tables empty.
+        base_default = {key: ({} if key in sharded_tables else value) for key, value in dict(data).items()}
+        with transaction(file=file, dt_default=base_default) as tx:
+            for key, value in dict(data).items():
+                tx.set(key, value)
+        return True
+
+    def transaction(file=settings_path, dt_default=None) -> transaction:
+        return transaction(file=file, dt_default=dt_default)
+
+    def migrate(file) -> int:
+        '''
+        One-shot move of the accounts and tokens stored inline in a settings file out into shards.
+
+        :param file: The settings file to migrate.
+        :return: How many records were moved.
+        '''
+        path = os.path.abspath(file)
+        _prepared.add(path)
+        moved = 0
+        with transaction(file=path, dt_default=None) as tx:
+            for table in sharded_tables:
+                inline = tx.base.get(table, {})
+                if not isinstance(inline, dict) or len(inline) == 0:
+                    continue
+                for record_key, record in inline.items():
+                    tx._shard(table, record_key).set(record_key, record)
+                    moved += 1
+                tx.base.set(table, {})
+
+        if moved != 0:
+            logging.info(f"Moved {moved} accounts and tokens from '{file}' into shards.")
+        return moved
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
@@ -0,0 +1,315 @@
+from toolbox.storage import (
+    key_path, settings_path, file_lock, _set_path, _delete_path, _get_path, _pick_fields,
+    _read_document, _write_document, _discard_journal, _journal_signature, _document_cache
+)
+from toolbox.pylog import pylog
+import threading
+import sqlite3
+import json
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+# Top-level keys of the settings file that get their own indexed table instead of a single row in 'documents'.
+# The value is the column the table is keyed by.
+routed_tables = {
+    'accounts': 'email_address',
+    'tokens': 'token',
+}
+
+schema = '''
+CREATE TABLE IF NOT EXISTS documents (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS accounts (
+    email_address TEXT PRIMARY KEY,
+    current_session TEXT,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS accounts_current_session ON accounts (current_session);
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    belongs_to TEXT,
+    expire_on REAL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_belongs_to ON tokens (belongs_to);
+CREATE INDEX IF NOT EXISTS tokens_expire_on ON tokens (expire_on);
+'''
+
+# sqlite connections can't be shared between threads or survive a fork, so they are kept per thread and per process.
+_local = threading.local()
+
+def database_path(file) -> str:
+    '''
+    Returns the database that stands in for a var file. (settings.json -> settings.db)
+    '''
+    return os.path.splitext(os.path.abspath(file))[0] + '.db'
+
+def _uses_tables(file) -> bool:
+    return os.path.abspath(file) == os.path.abspath(settings_path)
+
+def _connections() -> dict:
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+def _connect(file, dt_default) -> sqlite3.Connection:
+    '''
+    Returns an open connection to the database for a file, creating the database if it does not exist yet.
+    If the database is missing but the JSON file exists, the JSON file is migrated into it first.
+    '''
+    db_path = database_path(file)
+    connections = _connections()
+
+    conn = connections.get(db_path)
+    if conn is not None:
+        if os.path.exists(db_path):
+            return conn
+        # The database was deleted under us (such as a server being deleted), so start over.
+        conn.close()
+        del connections[db_path]
+
+    if not os.path.exists(db_path):
+        if os.path.exists(file):
+            sqlstore.migrate(file)
+        elif dt_default is None:
+            raise FileNotFoundError(f"file '{file}' does not exist.")
+
+    is_new = not os.path.exists(db_path)
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')
+    conn.executescript(schema)
+    connections[db_path] = conn
+
+    if is_new:
+        _fill(conn, file, dt_default)
+    return conn
+
+def _unit(file, keys:list) -> tuple:
+    '''
+    Works out which part of the database a key path lives in.
+    That is a whole routed table, one row of a routed table, or one row of 'documents'.
+    '''
+    if _uses_tables(file) and keys[0] in routed_tables:
+        if len(keys) == 1:
+            return 'table', keys[0], None
+        return 'row', keys[0], keys[1]
+    return 'document', keys[0], None
+
+def _load_unit(conn, unit:tuple) -> dict:
+    '''
+    Loads the smallest part of the document that contains the unit, shaped like the JSON document would be.
+    '''
+    kind, name, row_key = unit
+    if kind == 'document':
+        row = conn.execute('SELECT value FROM documents WHERE key = ?', (name,)).fetchone()
+        return {} if row is None else {name: json.loads(row[0])}
+
+    key_column = routed_tables[name]
+    if kind == 'row':
+        row = conn.execute(f'SELECT value FROM {name} WHERE {key_column} = ?', (row_key,)).fetchone()
+        return {name: {} if row is None else {row_key: json.loads(row[0])}}
+
+    rows = conn.execute(f'SELECT {key_column}, value FROM {name}')
+    return {name: {row[0]: json.loads(row[1]) for row in rows}}
+
+def _store_row(conn, table:str, row_key:str, record) -> None:
+    encoded = json.dumps(record)
+    fields = record if isinstance(record, dict) else {}
+    if table == 'accounts':
+        conn.execute(
+            'INSERT OR REPLACE INTO accounts (email_address, current_session, value) VALUES (?, ?, ?)',
+            (row_key, fields.get('current_session'), encoded)
+        )
+    else:
+        conn.execute(
+            'INSERT OR REPLACE INTO tokens (token, belongs_to, expire_on, value) VALUES (?, ?, ?, ?)',
+            (row_key, fields.get('belongs_to'), fields.get('expire_on'), encoded)
+        )
+
+def _store_unit(conn, unit:tuple, partial:dict) -> None:
+    '''
+    Writes a unit loaded by _load_unit back after it has been changed. Anything removed from it is deleted.
+    '''
+    kind, name, row_key = unit
+    if kind == 'document':
+        if name in partial:
+            conn.execute('INSERT OR REPLACE INTO documents (key, value) VALUES (?, ?)', (name, json.dumps(partial[name])))
+        else:
+            conn.execute('DELETE FROM documents WHERE key = ?', (name,))
+        return
+
+    records = partial.get(name)
+    if not isinstance(records, dict):
+        records = {}
+
+    if kind == 'row':
+        if row_key in records:
+            _store_row(conn, name, row_key, records[row_key])
+        else:
+            conn.execute(f'DELETE FROM {name} WHERE {routed_tables[name]} = ?', (row_key,))
+        return
+
+    conn.execute(f'DELETE FROM {name}')
+    for record_key, record in records.items():
+        _store_row(conn, name, record_key, record)
+
+def _fill(conn, file, data:dict) -> None:
+    '''
+    Replaces everything in the database with the contents of a dict.
+    '''
+    in_transaction = conn.in_transaction
+    if not in_transaction:
+        conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM documents')
+        for table in routed_tables:
+            conn.execute(f'DELETE FROM {table}')
+
+        for key, value in dict(data).items():
+            unit = _unit(file, [key])
+            _store_unit(conn, unit, {key: value})
+    except BaseException:
+        if not in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    if not in_transaction:
+        conn.execute('COMMIT')
+
+class transaction:
+    '''
+    The sqlite version of storage.transaction. Changes are made inside one sqlite transaction, so only the rows
+    a key path touches are read and written. A transaction opened while another is open on the same database
+    (in the same thread) joins the outer one.
+    '''
+    def __init__(self, file=settings_path, dt_default=None):
+        self.file = file
+        self.dt_default = dt_default
+        self.conn = None
+        self.owns_transaction = False
+
+    def __enter__(self):
+        self.conn = _connect(self.file, self.dt_default)
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.owns_transaction = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.owns_transaction:
+            self.conn.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        self.conn = None
+        return False
+
+    def get(self, key, default=None) -> object:
+        keys = key_path(key)
+        try:
+            return _get_path(_load_unit(self.conn, _unit(self.file, keys)), keys, default)
+        except KeyError:
+            return default
+
+    def set(self, key, value) -> bool:
+        keys = key_path(key)
+        unit = _unit(self.file, keys)
+        partial = _load_unit(self.conn, unit)
+        _set_path(partial, keys, value)
+        _store_unit(self.conn, unit, partial)
+        return True
+
+    def delete(self, key) -> bool:
+        keys = key_path(key)
+        unit = _unit(self.file, keys)
+        partial = _load_unit(self.conn, unit)
+        deleted = _delete_path(partial, keys)
+        if deleted is True:
+            _store_unit(self.conn, unit, partial)
+        return deleted
+
+class sqlstore:
+    '''
+    A storage engine that keeps var files in sqlite databases (WAL mode) instead of JSON files.
+    It is used by storage.var when the STORAGE_ENGINE environment variable is set to 'sqlite', and keeps the same
+    'key1//key2' semantics. In the settings file, 'accounts' and 'tokens' are stored one row per account/token.
+    '''
+    def get(file, keys:list, default=None, dt_default=None) -> object:
+        conn = _connect(file, dt_default)
+        return _get_path(_load_unit(conn, _unit(file, keys)), keys, default)
+
+    def keys(file, keys:list) -> list:
+        conn = _connect(file, None)
+        unit = _unit(file, keys)
+        if unit[0] == 'table':
+            return [row[0] for row in conn.execute(f'SELECT {routed_tables[unit[1]]} FROM {unit[1]}')]
+        value = _get_path(_load_unit(conn, unit), keys, None)
+        return list(value) if isinstance(value, dict) else []
+
+    def fields(file, keys:list, names:list) -> dict:
+        # Rows are parsed fresh from the database, so there is no cached copy to avoid.
+        return _pick_fields(sqlstore.get(file, keys, default=None), names)
+
+    def load_all(file, dt_default=None) -> dict:
+        conn = _connect(file, dt_default)
+        data = {row[0]: json.loads(row[1]) for row in conn.execute('SELECT key, value FROM documents')}
+        if _uses_tables(file):
+            for table in routed_tables:
+                data.update(_load_unit(conn, ('table', table, None)))
+        return data
+
+    def fill(file, data:dict) -> bool:
+        conn = _connect(file, data)
+        _fill(conn, file, data)
+        return True
+
+    def transaction(file=settings_path, dt_default=None) -> transaction:
+        return transaction(file=file, dt_default=dt_default)
+
+    def migrate(file) -> bool:
+        '''
+        One-shot migration of a JSON var file into its database.
+        The JSON file is renamed to '<file>.migrated' afterwards so it is obvious it is no longer used.
+
+        :param file: The JSON file to migrate.
+        :return: True if it was migrated, False if there was nothing to migrate or it was already migrated.
+        '''
+        db_path = database_path(file)
+        if not os.path.exists(file) or os.path.exists(db_path):
+            return False
+
+        # Locked like a write, so nothing can be added to the file or its journal while it is copied.
+        with file_lock(file, exclusive=True):
+            if not os.path.exists(file) or os.path.exists(db_path):
+                return False
+            # Read through the cache, so journal records that were never compacted into the file come along.
+            data = _read_document(file)
+
+            # Filled under another name and then moved into place, so nobody opens it half filled.
+            temp_path = f'{db_path}.migrating'
+            conn = sqlite3.connect(temp_path, isolation_level=None)
+            try:
+                conn.executescript(schema)
+                _fill(conn, file, data)
+            except BaseException:
+                conn.close()
+                os.remove(temp_path)
+                raise
+            conn.close()
+            os.replace(temp_path, db_path)
+
+            # The journal is folded into the file first, so the '.migrated' copy has everything the database has.
+            if _journal_signature(os.path.abspath(file)) is not None:
+                _write_document(file, data)
+                _discard_journal(file)
+            os.replace(file, f'{file}.migrated')
+            _document_cache.pop(os.path.abspath(file), None)
+
+        logging.info(f"Migrated '{file}' into the sqlite database '{db_path}'.")
+        return True
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")
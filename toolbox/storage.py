@@ -1,8 +1,21 @@
+from toolbox.errors import error
 from toolbox.pylog import pylog
+import functools
+import threading
+import tempfile
 import inspect
+import marshal
+import struct
+import copy
 import json
+import time
 import os
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows. Only the threads of a single process are kept apart there.
+
 logging = pylog(os.path.abspath("logs/rose_%TIMENOW%.log"))
 
 DEBUG = os.environ.get('DEBUG', False)
@@ -11,13 +24,96 @@ settings_path = 'settings.json'
 # The seperator used to split keys in the var class when you access like 'key1//key2//key3'
 key_seperator = "//"
 
+# Parsed documents, keyed by absolute file path. Each entry is a dict of
+# 'signature': the file's (mtime_ns, size, inode), so any rewrite of the file invalidates the entry.
+# 'journal': (inode, offset) of how much of the file's journal has been replayed into 'data', or None.
+# 'journal_started': when the first record in the journal was written, or None.
+# 'data': the parsed document.
+_document_cache = {}
+cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'journal_replays': 0,
+}
+
+# Journaling. When enabled, writes append their changes to '<file>.journal' instead of rewriting the file.
+# The journal is folded back into the file once it is bigger than journal_max_bytes or older than journal_max_age.
+journal_suffix = '.journal'
+journal_max_bytes = int(os.environ.get('STORAGE_JOURNAL_MAX_BYTES', 1024 * 1024))
+journal_max_age = float(os.environ.get('STORAGE_JOURNAL_MAX_AGE', 300))
+_compacting = set()
+
+# Locking. Readers hold '<file>.lock' shared and writers hold it exclusively, so processes can't lose each
+# other's writes. Writers to the same file within this process also take turns through a thread lock.
+lock_suffix = '.lock'
+lock_timeout = float(os.environ.get('STORAGE_LOCK_TIMEOUT', 10))
+lock_stats = {
+    'acquired': 0,
+    'contended': 0, # How many times the lock was held by someone else and we had to wait.
+    'wait_seconds': 0.0,
+    'timeouts': 0,
+}
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+# Per thread: the locks held, and the transactions open, keyed by absolute file path.
+_local = threading.local()
+
+class serializers:
+    '''
+    The formats var can write files in. Which one is used for writing is set with the STORAGE_FORMAT
+    environment variable. Reading works the format out from the file itself, so files can be mixed.
+
+    pretty: Indented JSON. Easy to read and edit by hand. (default)
+    compact: JSON without any whitespace. Smaller and faster to parse.
+    binary: Python's marshal format, behind a magic header and the length of the data. The smallest and
+    fastest, but not readable by hand, and only for internal stores.
+    '''
+    formats = ['pretty', 'compact', 'binary']
+    binary_magic = b'ROSEVAR\x01'
+    binary_header = struct.Struct('>8sQ')
+
+    def current() -> str:
+        '''
+        Returns the format files are written in. Read on every call so secrets.env can change it after import.
+        '''
+        chosen = str(os.environ.get('STORAGE_FORMAT', 'pretty')).lower()
+        if chosen not in serializers.formats:
+            raise ValueError(f"Unknown storage format '{chosen}'. Use one of: {', '.join(serializers.formats)}")
+        return chosen
+
+    def dumps(data:dict, format:str=None) -> bytes:
+        format = format or serializers.current()
+        if format == 'binary':
+            payload = marshal.dumps(data, 4)
+            return serializers.binary_header.pack(serializers.binary_magic, len(payload)) + payload
+        if format == 'compact':
+            return json.dumps(data, separators=(',', ':')).encode()
+        return json.dumps(data, indent=4).encode()
+
+    def loads(raw:bytes) -> dict:
+        if raw.startswith(serializers.binary_magic):
+            _, length = serializers.binary_header.unpack_from(raw)
+            payload = raw[serializers.binary_header.size:]
+            if len(payload) != length:
+                raise ValueError(f"Binary storage file is {len(payload)} bytes long but should be {length}.")
+            return dict(marshal.loads(payload))
+        return dict(json.loads(raw))
+
+    def detect(raw:bytes) -> str:
+        '''
+        Returns which format some file contents are in. Compact and pretty JSON are told apart by whitespace.
+        '''
+        if raw.startswith(serializers.binary_magic):
+            return 'binary'
+        return 'pretty' if raw[:2] == b'{\n' else 'compact'
+
 class dt:
     '''
     a list of variables that are Data Tables (DTs) or python dictionaries.
     Does not determine data
     '''
     ACCOUNT = {
-        'permissions': {},
+        'permissions': 0, # A bitmask of the account's permissions. See permissions.permissions.
         'email_address': None, # The key should be the username, but it'll be stored here too for easy access.
         'password': None,
         'current_session': None,
@@ -35,12 +131,16 @@ class dt:
             'api': 5005,
         },
         'root_email': None, # typically the email of the root account made on welcome CLI func
+        'accounts_version': 0, # Bumped whenever an account is added or removed, so indexes know to rebuild.
+        'permissions_version': 0, # Bumped whenever any account's permissions change, so caches know to refresh.
+        'tokens_version': 0, # Bumped whenever tokens change. 'token_changes' lists which, as [version, token] pairs.
+        'token_changes': [],
         'accounts': {},
         'tokens': {},
     }
 
     TOKEN_DICT = {
-        'activity': {},  # Logs for this session token
+        # What a session has done is kept in the audit log (toolbox/audit.py), not here.
         'expire_on': None,
         'belongs_to': None
     }
@@ -57,6 +157,11 @@ class dt:
         'kill_signal': 2, # Default is SIGINT. Might be a string or an int.
         'online': False,
         'process_pid': None,
+        'started_at': None, # When it was last started.
+        'exit_code': None, # How it last exited, and how long it had been up. (in seconds)
+        'uptime': None,
+        'supervisor_pid': None, # The panel process running it, and when another process last asked that one to stop it.
+        'stop_requested': None,
         'content_dir': None,
         'resources': {
             'RAM': {'used': 0, 'total': None},
@@ -65,6 +170,644 @@ class dt:
         }
     }
 
+    # servers/registry.json. See toolbox/registry.py
+    SERVER_REGISTRY = {
+        'servers': {},  # suid -> {'identifier', 'owner', 'online', 'process_pid', 'config_mtime'}
+        'version': 0,
+    }
+
+def _file_signature(file) -> tuple:
+    '''
+    Returns what we use to tell if a file has changed since we last parsed it.
+    Raises FileNotFoundError if the file does not exist.
+    '''
+    stat = os.stat(file)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+def _journal_enabled() -> bool:
+    '''
+    Whether writes to JSON files go to a journal. Read on every call so secrets.env can change it after import.
+    '''
+    return str(os.environ.get('STORAGE_JOURNAL', False)).lower() == 'true'
+
+def _apply_record(data:dict, record:dict) -> None:
+    if record['op'] == 'set':
+        _set_path(data, record['key'], record['value'])
+    elif record['op'] == 'delete':
+        _delete_path(data, record['key'])
+
+def _copy_path(data:dict, keys:list, copied:set) -> dict:
+    '''
+    Shallow copies the dicts along a key path that weren't already copied, so a record can be applied
+    without changing any dict that readers of the old document might be iterating.
+
+    :param copied: The ids of the dicts copied so far, which are safe to change.
+    :return: The root of the copy.
+    '''
+    if id(data) not in copied:
+        data = dict(data)
+        copied.add(id(data))
+    temp = data
+    for k in keys[:-1]:
+        child = temp.get(k)
+        if not isinstance(child, dict):
+            break
+        if id(child) not in copied:
+            child = temp[k] = dict(child)
+            copied.add(id(child))
+        temp = child
+    return data
+
+def _replay_journal(path, data:dict, offset:int, shared:bool=False) -> tuple:
+    '''
+    Applies the journal records from offset onwards to data.
+    A half-written last record (from a crash mid-append) is left for the next replay.
+
+    :param shared: If data is the cached document. It is then left as is, and the records are applied to a copy
+    of only the parts they change.
+    :return: (the document, the offset replayed up to, the time of the first record if replayed from the start, else None)
+    '''
+    with open(path + journal_suffix, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read()
+
+    complete = chunk[:chunk.rfind(b'\n') + 1]
+    started = None
+    copied = None if not shared else set()
+    for line in complete.splitlines():
+        if line.strip() == b'':
+            continue
+        record = json.loads(line)
+        if started is None and offset == 0:
+            started = record.get('time')
+        if copied is not None:
+            data = _copy_path(data, record['key'], copied)
+        _apply_record(data, record)
+
+    cache_stats['journal_replays'] += 1
+    return data, offset + len(complete), started
+
+def _journal_signature(path) -> tuple:
+    try:
+        stat = os.stat(path + journal_suffix)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size
+
+def _is_current(path, cached:dict) -> bool:
+    if cached['signature'] != _file_signature(path):
+        return False
+    journal = _journal_signature(path)
+    if journal is None or cached['journal'] is None:
+        return journal is None and cached['journal'] is None
+    return journal == cached['journal']
+
+def _read_document(file) -> dict:
+    '''
+    Returns the parsed contents of a file, only parsing it again if the file changed since the last read.
+    If the file has a journal, it is replayed on top. Records appended since the last read are replayed
+    onto the cached document without parsing the file again.
+    The returned dict is the cached object itself, so it must not be mutated or handed to callers. It is never
+    changed after being cached either (replays make a new document), so it is safe to read without the lock.
+    '''
+    path = os.path.abspath(file)
+
+    # Files are only ever replaced whole, so an unchanged signature can be trusted without taking the lock.
+    cached = _document_cache.get(path)
+    if cached is not None and _is_current(path, cached):
+        cache_stats['hits'] += 1
+        return cached['data']
+
+    with file_lock(path):
+        return _load_document(path)
+
+def _load_document(path) -> dict:
+    '''
+    The part of _read_document that reads from disk. Must be called with the file locked.
+    '''
+    signature = _file_signature(path)
+    journal = _journal_signature(path)
+
+    cached = _document_cache.get(path)
+    if cached is not None and cached['signature'] == signature:
+        cached_journal = cached['journal']
+        if journal is None and cached_journal is None:
+            cache_stats['hits'] += 1
+            return cached['data']
+        if journal is not None and cached_journal is not None and journal[0] == cached_journal[0]:
+            if journal[1] == cached_journal[1]:
+                cache_stats['hits'] += 1
+                return cached['data']
+            if journal[1] > cached_journal[1]:
+                cache_stats['hits'] += 1
+                data, offset, _ = _replay_journal(path, cached['data'], cached_journal[1], shared=True)
+                # Swapped in whole, so lock-free readers see either the old entry or the new one.
+                _document_cache[path] = {**cached, 'journal': (journal[0], offset), 'data': data}
+                return data
+
+    cache_stats['misses'] += 1
+    with open(path, 'rb') as f:
+        data = serializers.loads(f.read())
+
+    entry = {'signature': signature, 'journal': None, 'journal_started': None, 'data': data}
+    if journal is not None:
+        data, offset, started = _replay_journal(path, data, 0)
+        entry['data'] = data
+        entry['journal'] = (journal[0], offset)
+        entry['journal_started'] = started
+
+    _document_cache[path] = entry
+    return data
+
+def _write_document(file, data:dict, keep_copy=True, format:str=None) -> None:
+    '''
+    Atomically writes a dict to a file and keeps the cache warm with what was just written.
+    The data is written to a temporary file next to the target and then swapped in with os.replace,
+    so readers only ever see the old file or the new file and never a half-written one.
+
+    :param keep_copy: If False, the cache takes 'data' itself rather than a copy. Only for callers that drop it after.
+    :param format: The serializer format to write in. Defaults to STORAGE_FORMAT.
+    '''
+    path = os.path.abspath(file)
+    raw = serializers.dumps(data, format)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # mkstemp makes the file owner-only, so carry over the permissions of the file being replaced.
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    _document_cache[path] = {
+        'signature': _file_signature(path),
+        'journal': None,
+        'journal_started': None,
+        # Cache a private copy so later mutations of 'data' by the caller can't leak into it.
+        'data': copy.deepcopy(data) if keep_copy else data,
+    }
+
+def _thread_lock(path) -> threading.RLock:
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.RLock()
+    return lock
+
+def _held_locks() -> dict:
+    held = getattr(_local, 'locks', None)
+    if held is None:
+        held = _local.locks = {}
+    return held
+
+def _active_transactions() -> dict:
+    active = getattr(_local, 'transactions', None)
+    if active is None:
+        active = _local.transactions = {}
+    return active
+
+class file_lock:
+    '''
+    A shared (reading) or exclusive (writing) lock on a var file, held through '<file>.lock' so that it
+    still applies after the file itself is replaced. Re-entrant within a thread. Taking an exclusive lock
+    while holding a shared one upgrades it, and it stays exclusive until the outermost release.
+
+    Waiting is bounded by STORAGE_LOCK_TIMEOUT seconds, after which error.StorageLockTimeout is raised.
+    '''
+    def __init__(self, file, exclusive=False):
+        self.path = os.path.abspath(file)
+        self.exclusive = exclusive
+        self.thread_lock = None
+
+    def __enter__(self):
+        if self.exclusive:
+            self.thread_lock = _thread_lock(self.path)
+            if not self.thread_lock.acquire(timeout=lock_timeout):
+                lock_stats['timeouts'] += 1
+                raise error.StorageLockTimeout(self.path)
+
+        try:
+            self._acquire()
+        except BaseException:
+            if self.thread_lock is not None:
+                self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        try:
+            self._release()
+        finally:
+            if self.thread_lock is not None:
+                self.thread_lock.release()
+        return False
+
+    def _acquire(self) -> None:
+        if fcntl is None:
+            return
+
+        held = _held_locks()
+        entry = held.get(self.path)
+        if entry is not None:
+            if self.exclusive and not entry['exclusive']:
+                self._flock(entry['fd'], fcntl.LOCK_EX)
+                entry['exclusive'] = True
+            entry['depth'] += 1
+            return
+
+        lock_path = self.path + lock_suffix
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            self._flock(fd, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            os.close(fd)
+            raise
+        held[self.path] = {'fd': fd, 'exclusive': self.exclusive, 'depth': 1}
+
+    def _release(self) -> None:
+        if fcntl is None:
+            return
+
+        held = _held_locks()
+        entry = held[self.path]
+        entry['depth'] -= 1
+        if entry['depth'] == 0:
+            del held[self.path]
+            try:
+                fcntl.flock(entry['fd'], fcntl.LOCK_UN)
+            finally:
+                os.close(entry['fd'])
+
+    def _flock(self, fd, mode) -> None:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            lock_stats['acquired'] += 1
+            return
+        except BlockingIOError:
+            pass
+
+        # Someone else has it. Poll with a growing delay rather than blocking, so the wait can be bounded.
+        lock_stats['contended'] += 1
+        started = time.monotonic()
+        delay = 0.001
+        while True:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() - started > lock_timeout:
+                    lock_stats['timeouts'] += 1
+                    lock_stats['wait_seconds'] += time.monotonic() - started
+                    raise error.StorageLockTimeout(self.path)
+
+        lock_stats['acquired'] += 1
+        lock_stats['wait_seconds'] += time.monotonic() - started
+
+def _discard_journal(file) -> None:
+    '''
+    Removes a file's journal. Only call this right after writing a file that already has the journal folded in.
+    '''
+    path = os.path.abspath(file)
+    try:
+        os.remove(path + journal_suffix)
+    except FileNotFoundError:
+        pass
+
+def _append_journal(file, records:list, data:dict) -> None:
+    '''
+    Appends records to a file's journal in a single write, instead of rewriting the file.
+
+    :param records: The journal records to append.
+    :param data: The whole document with the records applied. The cache takes it as is.
+    '''
+    path = os.path.abspath(file)
+    now = time.time()
+    payload = ''.join(json.dumps({**record, 'time': now}) + '\n' for record in records).encode()
+
+    previous = _document_cache.get(path)
+    fd = os.open(path + journal_suffix, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, payload)
+        os.fsync(fd)
+        journal_stat = os.fstat(fd)
+    finally:
+        os.close(fd)
+
+    journal_size = journal_stat.st_size
+    cached_offset = None
+    if previous is not None and previous['journal'] is not None and previous['journal'][0] == journal_stat.st_ino:
+        cached_offset = previous['journal'][1]
+    elif previous is not None and previous['journal'] is None:
+        cached_offset = 0
+
+    if cached_offset is not None and cached_offset + len(payload) == journal_size:
+        # Nobody else appended in between, so 'data' is exactly the file plus the journal.
+        started = previous['journal_started'] if cached_offset != 0 else now
+        _document_cache[path] = {
+            'signature': previous['signature'],
+            'journal': (journal_stat.st_ino, journal_size),
+            'journal_started': started,
+            'data': data,
+        }
+    else:
+        _document_cache.pop(path, None)
+        started = None
+
+    too_old = started is not None and now - started > journal_max_age
+    if journal_size > journal_max_bytes or too_old:
+        _compact_in_background(path)
+
+def _compact_in_background(path) -> None:
+    if path in _compacting:
+        return
+    _compacting.add(path)
+
+    def compact():
+        try:
+            var.compact(path)
+        except Exception as err:
+            logging.error(f"Failed to compact the journal of '{path}'.", err)
+        finally:
+            _compacting.discard(path)
+
+    threading.Thread(target=compact, name=f'compact {os.path.basename(path)}', daemon=True).start()
+
+def _ensure_document(file, dt_default) -> None:
+    '''
+    Creates the file filled with dt_default if it does not exist yet.
+    Raises FileNotFoundError if it does not exist and dt_default is None.
+    '''
+    if os.path.exists(file) is True:
+        return
+
+    if dt_default is None:
+        raise FileNotFoundError(f"file '{file}' does not exist.")
+
+    file_dir = os.path.dirname(file)
+    if file_dir == '':
+        file_dir = os.getcwd()
+    os.makedirs(file_dir, exist_ok=True)
+    with file_lock(file, exclusive=True):
+        # Someone else may have created it while we waited for the lock.
+        if os.path.exists(file) is False:
+            _write_document(file, dt_default)
+
+@functools.lru_cache(maxsize=4096)
+def _compile_key(key:str) -> tuple:
+    return tuple(key.split(key_seperator))
+
+def key_path(key) -> tuple:
+    '''
+    Splits a 'key1//key2' path into its keys. The same paths are looked up over and over,
+    so each one is only split once and then served from a cache.
+    '''
+    return _compile_key(str(key))
+
+def _set_path(data:dict, keys:list, value) -> None:
+    '''
+    Sets the value at a split key path, creating any missing parent dicts.
+    '''
+    temp = data
+    for k in keys[:-1]:
+        if k not in temp:
+            temp[k] = {}
+        temp = temp[k]
+
+    temp[keys[-1]] = value
+
+def _get_path(data:dict, keys:list, default=None) -> object:
+    '''
+    Gets the value at a split key path.
+    Returns default if a parent key is missing, and raises KeyError if only the last key is missing.
+    '''
+    temp = data
+    for k in keys[:-1]:
+        if k not in temp:
+            return default
+        temp = temp[k]
+
+    return temp[keys[-1]]
+
+def _delete_path(data:dict, keys:list) -> bool:
+    '''
+    Deletes the value at a split key path.
+    :return: True if something was deleted, False if the key did not exist.
+    '''
+    temp = data
+    for k in keys[:-1]:
+        if k not in temp:
+            return False
+        temp = temp[k]
+
+    if keys[-1] in temp:
+        del temp[keys[-1]]
+        return True
+    return False
+
+def _sqlite_engine():
+    '''
+    Returns the sqlite engine if STORAGE_ENGINE is set to 'sqlite', otherwise None (the default JSON files).
+    Read on every call, so the environment can be changed after import (such as by secrets.env).
+    '''
+    if str(os.environ.get('STORAGE_ENGINE', 'json')).lower() != 'sqlite':
+        return None
+
+    from toolbox.sqlstore import sqlstore
+    return sqlstore
+
+def _sharded_layout(file):
+    '''
+    Returns the sharded layout if STORAGE_LAYOUT is set to 'sharded' and the file is the settings file, otherwise None.
+    Accounts and tokens are then kept one file per record. Has no effect with the sqlite engine, which already
+    stores them one row per record.
+    '''
+    if str(os.environ.get('STORAGE_LAYOUT', 'single')).lower() != 'sharded':
+        return None
+    if os.path.abspath(file) != os.path.abspath(settings_path):
+        return None
+
+    from toolbox.shards import shards
+    return shards
+
+def _engine(file):
+    '''
+    Returns the storage engine that handles a file, or None for plain JSON documents.
+    '''
+    sql_engine = _sqlite_engine()
+    if sql_engine is not None:
+        return sql_engine
+    return _sharded_layout(file)
+
+def _watch_targets(file, keys:list) -> list:
+    '''
+    Returns what has to be watched to notice a change to a key, as (directory, file names, recursive) tuples.
+    The names are matched exactly, so lock and temporary files next to them don't count as changes.
+    Recursive targets have no names, and count every file under the directory but those.
+    '''
+    if _sqlite_engine() is not None:
+        from toolbox.sqlstore import database_path
+        db_path = database_path(file)
+        name = os.path.basename(db_path)
+        return [(os.path.dirname(db_path), (name, f'{name}-wal'), False)]
+
+    if _sharded_layout(file) is not None:
+        from toolbox.shards import sharded_tables, shard_root, shard_path
+        if keys[0] in sharded_tables:
+            if len(keys) == 1:
+                return [(os.path.join(shard_root(file), keys[0]), None, True)]
+            path = shard_path(file, keys[0], keys[1])
+            name = os.path.basename(path)
+            return [(os.path.dirname(path), (name, name + journal_suffix), False)]
+
+    path = os.path.abspath(file)
+    name = os.path.basename(path)
+    return [(os.path.dirname(path), (name, name + journal_suffix), False)]
+
+def _detach(value):
+    '''
+    Copies mutable values taken out of the cache so callers can't modify the cached document.
+    '''
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+    return value
+
+_missing = object()
+
+def _pick_fields(records, names:list) -> dict:
+    '''
+    Takes some fields out of every record in a dict of records. See var.fields.
+    '''
+    if not isinstance(records, dict):
+        return {}
+    picked = {}
+    for record_key, record in records.items():
+        if not isinstance(record, dict):
+            continue
+        fields = picked[record_key] = {}
+        for name in names:
+            value = record.get(name, _missing)
+            if value is not _missing:
+                # Most fields are strings and numbers, which _detach would hand back as they are anyway.
+                fields[name] = copy.deepcopy(value) if isinstance(value, (dict, list)) else value
+    return picked
+
+class transaction:
+    '''
+    Applies several key changes to one file with a single read and a single write.
+    Use it through var.transaction(), like so
+
+    with var.transaction(file=settings_path) as tx:
+        tx.set(f'tokens//{token}', token_dict)
+        tx.set(f'accounts//{email_address}//current_session', token)
+
+    Nothing is written if the block raises, or if nothing was changed.
+    '''
+    def __init__(self, file=settings_path, dt_default=dt.SETTINGS):
+        self.file = file
+        self.dt_default = dt_default
+        self.data = None
+        # The ids of the dicts in 'data' that belong to this transaction, rather than to the cached document.
+        self.copied = set()
+        self.records = []
+        self.lock = None
+        self.outer = None
+
+    @property
+    def changed(self) -> bool:
+        return len(self.records) != 0
+
+    def __enter__(self):
+        path = os.path.abspath(self.file)
+        active = _active_transactions()
+
+        # A transaction opened inside another one on the same file joins it, rather than writing
+        # on its own and then being overwritten when the outer one commits.
+        self.outer = active.get(path)
+        if self.outer is not None:
+            return self.outer
+
+        self.lock = file_lock(path, exclusive=True)
+        self.lock.__enter__()
+        try:
+            _ensure_document(self.file, self.dt_default)
+            # Shared with every reader, so only the dicts along a changed key path are copied, as it is changed.
+            self.data = _read_document(self.file)
+        except BaseException:
+            self.lock.__exit__(None, None, None)
+            raise
+        active[path] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self.outer is not None:
+            self.outer = None
+            return False
+
+        del _active_transactions()[os.path.abspath(self.file)]
+        try:
+            if exc_type is None and self.changed is True:
+                if _journal_enabled():
+                    _append_journal(self.file, self.records, self.data)
+                else:
+                    _write_document(self.file, self.data, keep_copy=False)
+                    _discard_journal(self.file)
+        finally:
+            self.data = None
+            self.copied = set()
+            self.records = []
+            self.lock.__exit__(None, None, None)
+        return False
+
+    def get(self, key, default=None) -> object:
+        '''
+        Gets a value as it currently stands in the transaction, including changes not yet written.
+        Copied like var.get, as it may still be part of the cached document.
+        '''
+        keys = key_path(key)
+        temp = self.data
+        for k in keys[:-1]:
+            if k not in temp:
+                return default
+            temp = temp[k]
+        return _detach(temp.get(keys[-1], default))
+
+    def set(self, key, value) -> bool:
+        keys = key_path(key)
+        # Copied, as the document ends up in the cache and the caller may keep changing 'value'.
+        value = copy.deepcopy(value)
+        self.data = _copy_path(self.data, keys, self.copied)
+        _set_path(self.data, keys, value)
+        self.records.append({'op': 'set', 'key': keys, 'value': value})
+        return True
+
+    def delete(self, key) -> bool:
+        keys = key_path(key)
+        missing = object()
+        try:
+            if _get_path(self.data, keys, missing) is missing:
+                return False
+        except (KeyError, TypeError):
+            return False
+        self.data = _copy_path(self.data, keys, self.copied)
+        deleted = _delete_path(self.data, keys)
+        if deleted is True:
+            self.records.append({'op': 'delete', 'key': keys})
+        return deleted
+
 class var:
     def set(key, value, file=settings_path, dt_default=dt.SETTINGS) -> bool:
         '''
@@ -80,35 +823,15 @@ class var:
         if DEBUG is True:
             logging.info(f'file \'{file}\' was set by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
-
-        if os.path.exists(file) is False:
-            os.makedirs(file_dir, exist_ok=True)
-            with open(file, 'w+') as f:
-                json.dump(dt_default, f, indent=4, separators=(',', ':'))
-
-        with open(file, 'r+') as f:
-            data = json.load(f)
-
-        temp = data
-        for k in keys[:-1]:
-            if k not in temp:
-                temp[k] = {}
-            temp = temp[k]
-
-        temp[keys[-1]] = value
-
-        with open(file, 'w+') as f:
-            json.dump(data, f, indent=4)
+        with var.transaction(file=file, dt_default=dt_default) as tx:
+            tx.set(key, value)
 
         return True
 
     def get(key, default=None, dt_default=dt.SETTINGS, file=settings_path) -> object:
         '''
         Gets the value of a key in the memory file.
+        The file is only parsed again if it changed since the last read, otherwise it is served from memory.
 
         :param key: The key to get the value of.
         :param default: The default value to return if the key does not exist.
@@ -120,37 +843,74 @@ class var:
         if DEBUG is True:
             logging.info(f'file \'{file}\' was retrieved from by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
-
-        if os.path.exists(file) is True:
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
-        else:
-            if dt_default is not None:
-                os.makedirs(file_dir, exist_ok=True)
-                with open(file, 'w+') as f:
-                    json.dump(dt_default, f, indent=4, separators=(',', ':'))
-            else:
-                raise FileNotFoundError(f"file '{file}' does not exist.")
-
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
-
-        temp = data
+        engine = _engine(file)
         try:
-            for k in keys[:-1]:
-                if k not in temp:
-                    return default
-                temp = temp[k]
+            if engine is not None:
+                return engine.get(file, key_path(key), default=default, dt_default=dt_default)
 
-            return temp[keys[-1]]
+            _ensure_document(file, dt_default)
+            return _detach(_get_path(_read_document(file), key_path(key), default))
         except KeyError as err:
             logging.error(f"key '{key}' not found in file '{file}'.", err)
             raise KeyError(f"key '{key}' not found in file '{file}'.")
 
+    def exists(key, file=settings_path) -> bool:
+        '''
+        Checks if a key exists, without copying its value out like var.get does.
+        With the sharded layout, checking for an account or token only looks at that record's file.
+
+        :param key: The key to check for.
+        :param file: The file to check in.
+        :return: True if the key exists, False if it or the file does not.
+        '''
+        keys = key_path(key)
+        missing = object()
+        try:
+            engine = _engine(file)
+            if engine is not None:
+                return engine.get(file, keys, default=missing, dt_default=None) is not missing
+            return _get_path(_read_document(file), keys, missing) is not missing
+        except (KeyError, TypeError, FileNotFoundError):
+            return False
+
+    def keys(key, file=settings_path) -> list:
+        '''
+        Lists the keys of the dict under a key, without copying the values out like var.get does.
+
+        :param key: The key of the dict. (such as 'accounts')
+        :param file: The file the key is in.
+        :return: A list of its keys. Empty if the key or the file does not exist, or it is not a dict.
+        '''
+        keys = key_path(key)
+        try:
+            engine = _engine(file)
+            if engine is not None:
+                return engine.keys(file, keys)
+            value = _get_path(_read_document(file), keys, None)
+        except (KeyError, TypeError, FileNotFoundError):
+            return []
+        return list(value) if isinstance(value, dict) else []
+
+    def fields(key, names:list, file=settings_path) -> dict:
+        '''
+        Gets some fields of every record in a dict, such as the owner and expiry of every token, without copying
+        the whole records out like var.get does. Use it instead of var.get for big dicts like 'accounts' and 'tokens'.
+
+        :param key: The key of the dict of records. (such as 'tokens')
+        :param names: The fields to get from each record. (such as ['belongs_to', 'expire_on'])
+        :param file: The file the key is in.
+        :return: Each record's key -> {field: value} of the fields it has. Records that aren't dicts are left out.
+        Empty if the key or the file does not exist.
+        '''
+        keys = key_path(key)
+        try:
+            engine = _engine(file)
+            if engine is not None:
+                return engine.fields(file, keys, names)
+            return _pick_fields(_get_path(_read_document(file), keys, None), names)
+        except (KeyError, TypeError, FileNotFoundError):
+            return {}
+
     def delete(key, file=settings_path, default=dt.SETTINGS):
         '''
         Delete a key.
@@ -163,38 +923,8 @@ class var:
         if DEBUG is True:
             logging.info(f'file \'{file}\' was had a key deleted by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
 
-        keys = str(key).split(key_seperator)
-        file_dir = os.path.dirname(file)
-        if file_dir == '':
-            file_dir = os.getcwd()
-
-        if os.path.exists(file) is True:
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
-        else:
-            if default is not None:
-                os.makedirs(file_dir, exist_ok=True)
-                with open(file, 'w+') as f:
-                    json.dump(default, f, indent=4, separators=(',', ':'))
-            else:
-                raise FileNotFoundError(f"file '{file}' does not exist.")
-
-            with open(file, 'r+') as f:
-                data = dict(json.load(f))
-
-        temp = data
-        for k in keys[:-1]:
-            if k not in temp:
-                return False
-            temp = temp[k]
-
-        if keys[-1] in temp:
-            del temp[keys[-1]]
-            with open(file, 'w+') as f:
-                json.dump(data, f, indent=4)
-            return True
-        else:
-            return False
+        with var.transaction(file=file, dt_default=default) as tx:
+            return tx.delete(key)
 
     def load_all(file=settings_path, dt_default={}) -> dict:
         '''
@@ -207,15 +937,14 @@ class var:
         if DEBUG is True:
             logging.info(f'file \'{file}\' was fully loaded by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
 
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        if not os.path.exists(file):
-            with open(file, 'w+') as f:
-                json.dump(dt_default, f, indent=4, separators=(',', ':'))
+        engine = _engine(file)
+        if engine is not None:
+            return engine.load_all(file, dt_default=dt_default)
 
-        with open(file, 'r+') as f:
-            data = dict(json.load(f))
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        _ensure_document(file, dt_default)
 
-        return data
+        return copy.deepcopy(_read_document(file))
 
     def fill_json(file=settings_path, data=dt.SETTINGS):
         '''
@@ -227,8 +956,146 @@ class var:
         if DEBUG is True:
             logging.info(f'file \'{file}\' was filled with data by {inspect.stack()[1].filename}:{inspect.stack()[1].lineno}')
 
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        with open(file, 'w+') as f:
-            json.dump(data, f, indent=4, separators=(',', ':'))
+        engine = _engine(file)
+        if engine is not None:
+            return engine.fill(file, data)
+
+        os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+        _write_document(file, data)
+        _discard_journal(file)
 
         return True
+
+    def transaction(file=settings_path, dt_default=dt.SETTINGS):
+        '''
+        Opens a transaction on a file. Every set/delete made through it is written at once when the 'with' block exits.
+
+        :param file: The file the transaction applies to.
+        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
+        '''
+        engine = _engine(file)
+        if engine is not None:
+            return engine.transaction(file=file, dt_default=dt_default)
+
+        return transaction(file=file, dt_default=dt_default)
+
+    def set_many(items:dict, file=settings_path, dt_default=dt.SETTINGS) -> bool:
+        '''
+        Sets several keys with a single read and a single write.
+
+        :param items: A dict of key paths to the values to set them to.
+        :param file: The file to set the keys in.
+        :param dt_default: The default dictionary to fill a json file with if the file does not exist.
+        '''
+        with var.transaction(file=file, dt_default=dt_default) as tx:
+            for key, value in items.items():
+                tx.set(key, value)
+        return True
+
+    def delete_many(keys:list, file=settings_path, default=dt.SETTINGS) -> int:
+        '''
+        Deletes several keys with a single read and a single write.
+
+        :param keys: A list of key paths to delete.
+        :param file: The file to delete the keys from.
+        :param default: The default dictionary to fill a json file with if the file does not exist.
+        :return: How many of the keys existed and were deleted.
+        '''
+        deleted = 0
+        with var.transaction(file=file, dt_default=default) as tx:
+            for key in keys:
+                if tx.delete(key) is True:
+                    deleted += 1
+        return deleted
+
+    def watch(file, key_prefix, callback):
+        '''
+        Calls callback(key_prefix, new_value) whenever the value under key_prefix changes, no matter which
+        process changed it. Uses inotify where available, otherwise the files are checked every
+        STORAGE_WATCH_POLL_INTERVAL seconds. Callbacks run on a background thread, and new_value is None
+        if the key was removed.
+
+        :param file: The file the key is in.
+        :param key_prefix: The key to watch. Changes anywhere under it count. (such as 'tokens')
+        :param callback: The function to call with (key_prefix, new_value).
+        :return: A watch. Call .cancel() on it to stop watching.
+        '''
+        from toolbox.watcher import watcher, watch
+
+        targets = _watch_targets(file, key_path(key_prefix))
+        try:
+            value = var.get(key_prefix, file=file, dt_default=None) if var.exists(key_prefix, file=file) else None
+        except (KeyError, FileNotFoundError):
+            value = None
+        return watcher.add(watch(file, key_prefix, callback, targets, value))
+
+    def compact(file=settings_path) -> bool:
+        '''
+        Folds a file's journal back into the file and removes the journal.
+        This happens by itself in the background once the journal is big or old enough.
+
+        :param file: The file to compact.
+        :return: True if there was a journal to compact, False if not.
+        '''
+        if _sqlite_engine() is not None or _journal_signature(os.path.abspath(file)) is None:
+            return False
+
+        with file_lock(file, exclusive=True):
+            data = copy.deepcopy(_read_document(file))
+            _write_document(file, data, keep_copy=False)
+            _discard_journal(file)
+        logging.info(f"Compacted the journal of '{file}'.")
+        return True
+
+    def convert(file=settings_path, format:str=None) -> bool:
+        '''
+        Rewrites a JSON-engine file in another serializer format, folding in its journal on the way.
+
+        :param file: The file to convert.
+        :param format: The format to convert to. (pretty, compact or binary) Defaults to STORAGE_FORMAT.
+        :return: True if the file was rewritten, False if it was already in that format.
+        '''
+        format = format or serializers.current()
+        if format not in serializers.formats:
+            raise ValueError(f"Unknown storage format '{format}'. Use one of: {', '.join(serializers.formats)}")
+        if _sqlite_engine() is not None:
+            return False
+
+        with file_lock(file, exclusive=True):
+            with open(file, 'rb') as f:
+                current_format = serializers.detect(f.read(len(serializers.binary_magic)))
+            if current_format == format and _journal_signature(os.path.abspath(file)) is None:
+                return False
+
+            data = copy.deepcopy(_read_document(file))
+            _write_document(file, data, keep_copy=False, format=format)
+            _discard_journal(file)
+        return True
+
+    def lock_info() -> dict:
+        '''
+        Returns how often this process has taken file locks, how often it had to wait for them, for how long,
+        and how many times it gave up waiting.
+        '''
+        return dict(lock_stats)
+
+    def cache_info() -> dict:
+        '''
+        Returns the read cache's hit/miss counters and how many documents it currently holds.
+        '''
+        return {
+            'hits': cache_stats['hits'],
+            'misses': cache_stats['misses'],
+            'journal_replays': cache_stats['journal_replays'],
+            'documents': len(_document_cache),
+        }
+
+    def clear_cache(file=None) -> None:
+        '''
+        Drops cached documents so the next read parses the file again.
+        :param file: The file to drop from the cache. Drops every file if None.
+        '''
+        if file is None:
+            _document_cache.clear()
+        else:
+            _document_cache.pop(os.path.abspath(file), None)
@@ -1,12 +1,21 @@
 from toolbox.storage import var, dt
+from toolbox.records import server_record
+from toolbox.registry import server_registry
+from toolbox.console import console_log, console_dir
+from toolbox.audit import audit
 from toolbox.pylog import pylog
-import multiprocessing
 import subprocess
+import threading
+import functools
+import warnings
+import asyncio
 import inspect
 import random
 import shutil
 import signal
 import shlex
+import time
+import sys
 import os
 
 logging = pylog('logs/rose_%TIMENOW%.log')
@@ -15,6 +24,408 @@ os.makedirs('servers', exist_ok=True)
 DEBUG = os.environ.get('DEBUG', False)
 maximum_args = 4
 
+# The most output read from a server's pipe at once.
+console_chunk = 64 * 1024
+# How long a server gets to stop on its own after each stop signal, before a stronger one is sent.
+stop_timeout = float(os.environ.get('SERVER_STOP_TIMEOUT', 10))
+
+def _process_alive(pid:int) -> bool:
+    '''
+    Whether a process is still running. A zombie (exited, but not yet reaped by its parent) counts as stopped.
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return True
+    return raw[raw.rfind(b')') + 2:][:1] != b'Z'
+
+class server_protocol(asyncio.subprocess.SubprocessStreamProtocol):
+    '''
+    Tells the supervisor the moment a server exits, through 'exited'. Process.wait() only returns once the
+    server's output pipe has closed too, which anything it left running can keep open.
+    '''
+    def __init__(self, limit, loop):
+        super().__init__(limit=limit, loop=loop)
+        self.exited = loop.create_future()
+
+    def process_exited(self) -> None:
+        # Read first, as the stream protocol lets go of the transport when the process exits.
+        returncode = self._transport.get_returncode()
+        super().process_exited()
+        if not self.exited.done():
+            self.exited.set_result(returncode)
+
+class managed_server:
+    '''
+    What the supervisor keeps for each running server. The asyncio process, when it started, and its console.
+    '''
+    __slots__ = ('suid', 'process', 'exited', 'started_at', 'server_file', 'console', 'capture', 'recorded', 'kill_signal', 'stop_watch')
+
+    def __init__(self, suid, process, exited, started_at, server_file, console, kill_signal):
+        self.suid = suid
+        self.process = process
+        # Resolves to the exit code once the server exits.
+        self.exited = exited
+        self.started_at = started_at
+        self.server_file = server_file
+        self.console = console
+        self.capture = None
+        # Saving that the server started, which has to finish before saving that it exited.
+        self.recorded = None
+        self.kill_signal = kill_signal
+        # Watches 'stop_requested' in the config, for other processes asking for the server to be stopped.
+        self.stop_watch = None
+
+class supervisor:
+    '''
+    Runs every server this process starts as a child of one asyncio event loop, on a background thread,
+    instead of a Python process per server. The loop is told when a child exits (through a pidfd where the
+    system has them), and then records the exit code and uptime in the server's config.
+
+    Only the process that started a server can wait for it, so other processes (the API, the resource sampler)
+    stop it by setting 'stop_requested' in its config, which the supervisor running it watches. See request_stop.
+
+    Reading and writing configs can wait on file locks, so it is done on the loop's thread pool rather than on the
+    loop itself, where it would hold up every other server's console and exit.
+    '''
+    loop = None
+    thread = None
+    pid = None
+    lock = threading.Lock()
+    # suid -> managed_server, for the servers running right now.
+    servers = {}
+    # suid -> the task starting it, so starting a server twice at once only starts it once.
+    launching = {}
+
+    def _ensure_running() -> asyncio.AbstractEventLoop:
+        if supervisor.pid == os.getpid() and supervisor.thread.is_alive():
+            return supervisor.loop
+        with supervisor.lock:
+            if supervisor.pid == os.getpid() and supervisor.thread.is_alive():
+                return supervisor.loop
+
+            loop = asyncio.new_event_loop()
+            # Python 3.12+ uses pidfds by itself. Before that the default watcher starts a thread per child.
+            if sys.version_info < (3, 12) and hasattr(os, 'pidfd_open'):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', DeprecationWarning)
+                    child_watcher = asyncio.PidfdChildWatcher()
+                    child_watcher.attach_loop(loop)
+                    asyncio.set_child_watcher(child_watcher)
+
+            thread = threading.Thread(target=loop.run_forever, name='thorns-supervisor', daemon=True)
+            thread.start()
+            supervisor.loop = loop
+            supervisor.thread = thread
+            supervisor.servers = {}
+            supervisor.launching = {}
+            supervisor.pid = os.getpid()
+            return loop
+
+    def _call(coroutine, timeout=None):
+        '''
+        Runs a coroutine on the supervisor's loop from any other thread, and waits for its result.
+        '''
+        loop = supervisor._ensure_running()
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result(timeout)
+
+    def launch(suid:str) -> int:
+        '''
+        Starts a server's init_cmd in its content directory.
+
+        :return: The PID of the server's process.
+        '''
+        return supervisor._call(supervisor._launch(suid))
+
+    def _blocking(function, *args, **kwargs) -> asyncio.Future:
+        '''
+        Runs a function that may block (such as reading or writing a config) on the loop's thread pool.
+        '''
+        return asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    async def _launch(suid:str) -> int:
+        if suid in supervisor.servers:
+            return supervisor.servers[suid].process.pid
+        starting = supervisor.launching.get(suid)
+        if starting is None:
+            starting = asyncio.get_running_loop().create_task(supervisor._start(suid))
+            supervisor.launching[suid] = starting
+            starting.add_done_callback(lambda _: supervisor.launching.pop(suid, None))
+        return await asyncio.shield(starting)
+
+    async def _start(suid:str) -> int:
+        server_file = os.path.abspath(f'servers/{suid}/config.json')
+        server = dict(await supervisor._blocking(var.load_all, file=server_file, dt_default=dt.SERVER_INSTANCE))
+        init_cmd = shlex.split(str(server['init_cmd']))
+        content_dir = server['content_dir'] or os.path.dirname(server_file)
+
+        if DEBUG is True:
+            logging.debug(f'Running command: {init_cmd}')
+            logging.debug(f'Content directory: {content_dir}')
+            logging.debug(f'Server file: {server_file}')
+
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.subprocess_exec(
+            lambda: server_protocol(limit=console_chunk, loop=loop),
+            *init_cmd,
+            cwd=content_dir,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True,
+        )
+        process = asyncio.subprocess.Process(transport, protocol, loop)
+        console = console_log(suid)
+        managed = managed_server(suid, process, protocol.exited, time.time(), server_file, console, server['kill_signal'])
+        supervisor.servers[suid] = managed
+        managed.capture = asyncio.get_running_loop().create_task(supervisor._capture(managed))
+        # Watched before this process is saved as the one running it, so no request can be missed.
+        try:
+            managed.stop_watch = await supervisor._blocking(
+                var.watch, server_file, 'stop_requested', functools.partial(supervisor._on_stop_request, suid)
+            )
+        except Exception as err:
+            logging.error(f"Could not watch '{suid}' for stop requests from other processes.", exception=err)
+
+        managed.recorded = supervisor._blocking(supervisor._record_start, managed)
+        asyncio.get_running_loop().create_task(supervisor._wait(managed))
+        await managed.recorded
+        return process.pid
+
+    def _record_start(managed:managed_server) -> None:
+        var.set_many({
+            'process_pid': managed.process.pid,
+            'online': True,
+            'started_at': managed.started_at,
+            'exit_code': None,
+            'supervisor_pid': os.getpid(),
+            'stop_requested': None,
+        }, file=managed.server_file, dt_default=dt.SERVER_INSTANCE)
+        server_registry.set_online(managed.suid, True, managed.process.pid)
+
+    async def _capture(managed:managed_server) -> None:
+        '''
+        Copies a server's output into its console log for as long as it runs. The pipe is always read straight
+        away, so a server never blocks on a full pipe.
+        '''
+        stream = managed.process.stdout
+        try:
+            while True:
+                data = await stream.read(console_chunk)
+                if not data:
+                    break
+                managed.console.write(data)
+        except OSError as err:
+            logging.error(f"Could not save the console output of '{managed.suid}'.", exception=err)
+        finally:
+            managed.console.close()
+
+    async def _wait(managed:managed_server) -> None:
+        exit_code = await managed.exited
+        uptime = time.time() - managed.started_at
+        # Whatever the server printed last is still in the pipe. Anything it left running can hold the pipe open
+        # after it exits, so this only waits a moment, and the capture carries on for as long as they print.
+        try:
+            await asyncio.wait_for(asyncio.shield(managed.capture), 1)
+        except asyncio.TimeoutError:
+            pass
+        if supervisor.servers.get(managed.suid) is managed:
+            del supervisor.servers[managed.suid]
+        if managed.stop_watch is not None:
+            managed.stop_watch.cancel()
+
+        try:
+            # Otherwise a server that exits straight away could be saved as online after being saved as offline.
+            await managed.recorded
+        except Exception as err:
+            logging.error(f"Could not save that '{managed.suid}' started.", exception=err)
+        try:
+            await supervisor._blocking(supervisor._record_exit, managed, exit_code, uptime)
+        except Exception as err:
+            logging.error(f"Could not save that '{managed.suid}' exited.", exception=err)
+        logging.info(f"Server '{managed.suid}' exited with code {exit_code} after {uptime:.1f} seconds.")
+
+    def _record_exit(managed:managed_server, exit_code:int, uptime:float) -> None:
+        try:
+            var.set_many({
+                'process_pid': None,
+                'online': False,
+                'exit_code': exit_code,
+                'uptime': uptime,
+                'supervisor_pid': None,
+                'stop_requested': None,
+            }, file=managed.server_file, dt_default=None)
+            server_registry.set_online(managed.suid, False)
+        except FileNotFoundError:
+            # The server was deleted while it was running.
+            pass
+
+    def send(suid:str, text:str) -> bool:
+        '''
+        Writes a line to a running server's input.
+
+        :return: True if it was sent, False if the server isn't running under this supervisor.
+        '''
+        if supervisor.pid != os.getpid():
+            return False
+        return supervisor._call(supervisor._send(suid, text))
+
+    async def _send(suid:str, text:str) -> bool:
+        managed = supervisor.servers.get(suid)
+        if managed is None or managed.process.stdin is None:
+            return False
+        try:
+            managed.process.stdin.write(f'{text}\n'.encode())
+            await managed.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+        return True
+
+    def stop(suid:str, kill_signal) -> int:
+        '''
+        Stops a running server. The server's own kill signal is tried first (a signal number, or a command
+        written to its input such as 'stop'), then SIGINT, SIGTERM and finally SIGKILL, each given
+        SERVER_STOP_TIMEOUT seconds to work.
+
+        :return: The exit code, or None if the server isn't running under this supervisor.
+        '''
+        if supervisor.pid != os.getpid() or suid not in supervisor.servers:
+            return None
+        return supervisor._call(supervisor._stop(suid, kill_signal))
+
+    async def _stop(suid:str, kill_signal) -> int:
+        managed = supervisor.servers.get(suid)
+        if managed is None:
+            return None
+        process = managed.process
+
+        for attempt in [kill_signal, signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
+            if managed.exited.done():
+                break
+            try:
+                if isinstance(attempt, str) and not attempt.isdigit():
+                    await supervisor._send(suid, attempt)
+                else:
+                    # The server leads its own session, so this reaches everything it started too.
+                    os.killpg(process.pid, int(attempt))
+            except ProcessLookupError:
+                break
+            except (ValueError, OSError) as err:
+                logging.error(f"Could not send {attempt} to {suid}.", exception=err)
+                continue
+            try:
+                await asyncio.wait_for(asyncio.shield(managed.exited), stop_timeout)
+            except asyncio.TimeoutError:
+                continue
+        exit_code = await managed.exited
+        await supervisor._stop_leftovers(suid, process.pid)
+        return exit_code
+
+    async def _stop_leftovers(suid:str, process_group:int) -> None:
+        '''
+        Stops anything still in a stopped server's process group, such as a child that ignored the signal its parent exited on.
+        '''
+        for attempt in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                os.killpg(process_group, attempt)
+            except ProcessLookupError:
+                return
+            except OSError as err:
+                logging.error(f"Could not send {attempt} to what '{suid}' left running.", exception=err)
+                return
+            deadline = time.monotonic() + stop_timeout
+            while time.monotonic() < deadline:
+                try:
+                    os.killpg(process_group, 0)
+                except ProcessLookupError:
+                    return
+                await asyncio.sleep(0.1)
+
+    def _on_stop_request(suid:str, key_prefix, requested) -> None:
+        '''
+        Called by var.watch when another process sets 'stop_requested' in the config of a server this process runs.
+        '''
+        managed = supervisor.servers.get(suid)
+        if requested is None or managed is None or supervisor.pid != os.getpid():
+            return
+        logging.info(f"Another process asked for '{suid}' to be stopped.")
+        # Doesn't wait, as this runs on the watcher's thread. The supervisor saves the exit when it happens.
+        asyncio.run_coroutine_threadsafe(supervisor._stop(suid, managed.kill_signal), supervisor.loop)
+
+    def request_stop(suid:str, server:dict) -> bool:
+        '''
+        Asks the panel process running a server to stop it, and waits for the server to exit. That process tries
+        each stop signal in turn, the same as supervisor.stop.
+
+        :param server: The server's config.
+        :return: True if it stopped. False if no other live process runs it, or it didn't stop in time.
+        '''
+        owner_pid = server.get('supervisor_pid')
+        process_pid = server.get('process_pid')
+        if owner_pid is None or process_pid is None or owner_pid == os.getpid() or not _process_alive(owner_pid):
+            return False
+        if not _process_alive(process_pid):
+            return True
+
+        var.set('stop_requested', time.time(), file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE)
+        # Four signals, each given stop_timeout, and a little longer for the request to be noticed.
+        deadline = time.monotonic() + stop_timeout * 4 + 5
+        while time.monotonic() < deadline:
+            if not _process_alive(process_pid):
+                return True
+            time.sleep(0.1)
+        logging.warning(f"The process running '{suid}' (PID {owner_pid}) did not stop it in time.")
+        return False
+
+    def stop_unowned(suid:str, process_pid:int, kill_signal) -> None:
+        '''
+        Stops a server this process isn't running, such as one started by an earlier run of the panel, with
+        only its PID to go on. Each signal goes to the server's whole process group (it leads its own session)
+        and is given SERVER_STOP_TIMEOUT seconds to work, like supervisor.stop. A kill signal that is a command
+        for its input can't be sent from here, so it is skipped.
+        '''
+        logging.warning(f"Server '{suid}' (PID {process_pid}) isn't run by this process, so it is stopped by signalling its PID.")
+        for attempt in [kill_signal, signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
+            if isinstance(attempt, str) and not attempt.isdigit():
+                continue
+            try:
+                try:
+                    os.killpg(process_pid, int(attempt))
+                except ProcessLookupError:
+                    # Not a process group leader, such as a server started before the supervisor.
+                    os.kill(process_pid, int(attempt))
+            except ProcessLookupError:
+                return
+            except (ValueError, OSError) as err:
+                logging.error(f"Could not send {attempt} to {suid}.", exception=err)
+                continue
+
+            deadline = time.monotonic() + stop_timeout
+            while time.monotonic() < deadline:
+                if not _process_alive(process_pid):
+                    return
+                time.sleep(0.1)
+        if _process_alive(process_pid):
+            # Not an error to raise, as the server is still marked offline. It may also be a reused PID
+            # belonging to someone else, which is alive but can't be signalled.
+            logging.warning(f"Server '{suid}' (PID {process_pid}) did not stop, even after SIGKILL.")
+
+    def status(suid:str) -> dict:
+        '''
+        :return: A dict of 'online', 'process_pid' and 'uptime' for a server run by this supervisor.
+        '''
+        managed = supervisor.servers.get(suid) if supervisor.pid == os.getpid() else None
+        if managed is None:
+            return {'online': False, 'process_pid': None, 'uptime': None}
+        return {'online': True, 'process_pid': managed.process.pid, 'uptime': time.time() - managed.started_at}
+
 class thorns:
     class errors:
         '''
@@ -46,10 +457,7 @@ class thorns:
         if suid is not None and name_id is None:
             return os.path.exists(f'servers/{suid}') is True
         elif suid is None and name_id is not None:
-            for server in os.listdir('servers'):
-                server_identifier = var.get('identifier', file=f'servers/{server}/config.json', dt_default=dt.SERVER_INSTANCE)
-                if server_identifier == name_id:
-                    return True
+            return server_registry.exists(name=name_id)
         else:
             raise ValueError("suid and name_id cannot both be None or both be not None.")
 
@@ -62,12 +470,9 @@ class thorns:
         :return str: The opposite id.
         '''
         if suid is not None and name_id is None:
-            return var.get('identifier', file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE)
+            return server_registry.name_of(suid)
         elif suid is None and name_id is not None:
-            for server in os.listdir('servers'):
-                server_identifier = var.get('identifier', file=f'servers/{server}/config.json', dt_default=dt.SERVER_INSTANCE)
-                if server_identifier == name_id:
-                    return server
+            return server_registry.suid_of(name_id)
         else:
             raise ValueError("suid and name_id cannot both be None or both be not None.")
 
@@ -114,53 +519,6 @@ class thorns:
         else:
             raise ValueError("target_type must be either 'suid' or 'name'.")
 
-    # TODO: Fix this function. Figure out why the subprocess.Popen never starts the process.
-    def worker(identifier, input_pipe: multiprocessing.Pipe, DEBUG=False) -> bool:
-        '''
-        This function is used to run a command in a separate process in a certain directory. AKA The backbone of Thorns.
-        Writes to a file in server/identifier/stdout which is text-based. This is used to read the output of the server.
-
-        :param identifier: The identifier of the server.
-        :param input_pipe: The pipe to send input to the subprocess.
-        :param DEBUG: Whether to run in debug mode or not.
-        :return bool: True if the server was started successfully, False if it was not.
-        '''
-        identifier = thorns.get_idtype_target(identifier, 'suid')
-        content_dir = var.get('content_dir', file=f'servers/{identifier}/config.json', dt_default=dt.SERVER_INSTANCE)
-        project_wd = var.get('working_directory')
-        project_wd = os.path.abspath(project_wd)
-
-        server_file = os.path.join(project_wd, f'servers/{identifier}/config.json')
-        # Loads the init command from the server file and splits it into a list.
-        init_cmd = str(dict(var.load_all(file=server_file, dt_default=dt.SERVER_INSTANCE))['init_cmd']).split(" ")
-
-        if DEBUG is True:
-            logging.debug(f'Running command: {init_cmd}')
-            logging.debug(f'Working directory: {os.getcwd()}')
-            logging.debug(f'Content directory: {content_dir}')
-            logging.debug(f'Server file: {server_file}')
-            logging.debug(f'Project working directory: {project_wd}')
-
-        process = subprocess.Popen(
-            args=init_cmd,
-            start_new_session=True,
-            cwd=project_wd,
-        )
-
-        var.set(key='process_pid', value=process.pid, file=server_file, dt_default=dt.SERVER_INSTANCE)
-        var.set(key='online', value=True, file=server_file, dt_default=dt.SERVER_INSTANCE)
-
-        if DEBUG is True:
-            if process.pid is not None:
-                logging.debug(f'Server {identifier} started successfully.')
-            else:
-                logging.debug(f'Server {identifier} did not start successfully.')
-
-        # Ends the process
-        var.set(key='process_pid', value=None, file=server_file, dt_default=dt.SERVER_INSTANCE)
-        var.set(key='online', value=False, file=server_file, dt_default=dt.SERVER_INSTANCE)
-        return True
-
     def create(identifier:str,
                description:str,
                owner_email:str,
@@ -205,21 +563,22 @@ class thorns:
         assert not identifier.startswith('thorn_'), "the name id cannot start with 'thorn_'"
 
         # Creates the server data's template
-        server = dt.SERVER_INSTANCE
-        server['owner'] = owner_email
-        server['identifier'] = identifier
-        server['server_unique_id'] = ServerUniqueID
-        server['description'] = description
-        server['hostname'] = hostname
-        server['port'] = port
-        server['init_cmd'] = init_cmd
-        server['install_cmds'] = install_cmds
-        server['kill_signal'] = kill_signal
-        server['online'] = False
-        server['content_dir'] = os.path.abspath(f'servers/{ServerUniqueID}/content')
-        server['resources']['RAM']['total'] = max_ram
-        server['resources']['CPU']['allowed'] = max_cpu
-        server['resources']['STORAGE']['total'] = max_storage
+        server = server_record(
+            owner=owner_email,
+            identifier=identifier,
+            server_unique_id=ServerUniqueID,
+            description=description,
+            hostname=hostname,
+            port=port,
+            init_cmd=init_cmd,
+            install_cmds=install_cmds,
+            kill_signal=kill_signal,
+            online=False,
+            content_dir=os.path.abspath(f'servers/{ServerUniqueID}/content'),
+        )
+        server.resources['RAM']['total'] = max_ram
+        server.resources['CPU']['allowed'] = max_cpu
+        server.resources['STORAGE']['total'] = max_storage
 
         logging.info(
             f"User '{owner_email}' created a new server with the identifier '{identifier}' ({ServerUniqueID})."
@@ -230,10 +589,11 @@ class thorns:
             os.makedirs(f'servers/{ServerUniqueID}', exist_ok=True)
 
             # Creates config file.
-            var.fill_json(file=f'servers/{ServerUniqueID}/config.json', data=server)
+            var.fill_json(file=f'servers/{ServerUniqueID}/config.json', data=server.to_dict())
+            server_registry.add(server.to_dict())
 
             # Creates server content dir
-            os.makedirs(server['content_dir'], exist_ok=True)
+            os.makedirs(server.content_dir, exist_ok=True)
         except PermissionError as err:
             err_msg = f"PERMISSION ERROR: The OS is stopping us from accessing 'servers/{ServerUniqueID}' Please fix this."
             print(err_msg)
@@ -243,12 +603,14 @@ class thorns:
             )
             return False
 
+        audit.record('server_create', owner_email, identifier)
+
         # Attempts the install command.
-        if len(server['install_cmds']) > 0:
+        if len(server.install_cmds) > 0:
             index_place = 0
             try:
-                os.chdir(server['content_dir'])
-                for cmd in server['install_cmds']:
+                os.chdir(server.content_dir)
+                for cmd in server.install_cmds:
                     subprocess.run(shlex.split(cmd))
                     index_place += 1
             except Exception as err:
@@ -271,59 +633,75 @@ class thorns:
 
         # Deletes the server
         shutil.rmtree(f'servers/{suid}')
+        server_registry.remove(suid)
+        audit.record('server_delete', senders_email, identifier)
 
         logging.info(f"User '{senders_email}' deleted the server '{identifier}'.")
         return True
 
-    def start(identifier, senders_email:str) -> multiprocessing.Queue:
+    def start(identifier, senders_email:str) -> int:
+        '''
+        Starts a server under the supervisor. Use thorns.send to write to its input.
+
+        :return: The PID of the server's process.
+        '''
         identifier = thorns.get_idtype_target(identifier, 'suid')
-        if thorns.check_exists(suid=identifier) is False:
+        if identifier is None or thorns.check_exists(suid=identifier) is False:
             raise thorns.errors.ServerDoesNotExist(f"Server '{identifier}' does not exist.")
 
-        input_pipe = multiprocessing.Pipe()
-
-        # Start the server
-        assert identifier is not None, 'suid is None.'
-        process = multiprocessing.Process(
-            target=thorns.worker,
-            args=(identifier, input_pipe, DEBUG),
-            name=identifier
-        )
-        process.start()
+        process_pid = supervisor.launch(identifier)
+        audit.record('server_start', senders_email, identifier)
 
         logging.info(f"User '{senders_email}' started the server '{identifier}'{' in debug mode' if DEBUG else ''}.")
-        return input_pipe
+        return process_pid
+
+    def send(identifier, text:str) -> bool:
+        '''
+        Writes a line (such as a command) to a running server's input.
+        '''
+        return supervisor.send(thorns.get_idtype_target(identifier, 'suid'), text)
+
+    def tail(identifier, lines:int=200, since_offset:int=None) -> dict:
+        '''
+        Gets a server's console output. Works whether or not the server is running, and from any process.
+
+        :param identifier: The name or SUID of the server.
+        :param lines: How many of the last lines to get.
+        :param since_offset: Instead of the last lines, get everything after this offset. Pass back the
+        'next_offset' of the last call to only get new output.
+        :return: A dict of 'offset', 'next_offset', 'end_offset', 'data' and 'truncated'. (see console_log.read)
+        '''
+        suid = thorns.get_idtype_target(identifier, 'suid')
+        if suid is None or thorns.check_exists(suid=suid) is False:
+            raise thorns.errors.ServerDoesNotExist(f"Server '{identifier}' does not exist.")
+
+        managed = supervisor.servers.get(suid) if supervisor.pid == os.getpid() else None
+        if managed is not None:
+            return managed.console.tail(lines, since_offset)
+        return console_log.read(console_dir(suid), lines, since_offset)
 
     def stop(identifier:str, senders_email:str) -> bool:
         thorns.validate_data(thorns.compile_data_from_func())
 
-        if thorns.check_exists(name_id=identifier) is False:
+        suid = thorns.get_idtype_target(identifier, 'suid')
+        if suid is None or thorns.check_exists(suid=suid) is False:
             raise thorns.errors.ServerDoesNotExist(f"Server '{identifier}' does not exist.")
-        if not identifier.startswith('thorn_'):
-            suid = thorns.get_opposite_id(name_id=identifier)
-        else:
-            suid = identifier
 
         server = dict(var.load_all(file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE))
         saved_code = server['kill_signal']
 
-        subprocess_pid = server['process_pid']
-
-        for killcode in [saved_code, signal.SIGINT, signal.SIGTERM, signal.SIGKILL]:
-            try:
-                os.kill(subprocess_pid, killcode)
-                # Checks if its dead
-                # TODO: Find reliable way to check if the process is dead.
-            except Exception as err:
-                logging.error(f"Something went wrong stopping {suid}.", exception=err)
-
-        # Stop the server
-        server['online'] = False
-        server['process_pid'] = None
-
-        # Update the config file
-        var.set(key='process_pid', value=None, file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE)
-        var.set(key='online', value=False, file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE)
+        # The supervisor waits for the server to exit, and records it in the config itself.
+        # Otherwise the process running it is asked to stop it, which also records it.
+        if supervisor.stop(suid, saved_code) is None and supervisor.request_stop(suid, server) is False:
+            # Nothing is running it any more, such as when it was started by an earlier run of the panel.
+            subprocess_pid = server['process_pid']
+            if subprocess_pid is not None:
+                supervisor.stop_unowned(suid, subprocess_pid, saved_code)
+
+            # Update the config file
+            var.set_many({'process_pid': None, 'online': False}, file=f'servers/{suid}/config.json', dt_default=dt.SERVER_INSTANCE)
+            server_registry.set_online(suid, False)
+        audit.record('server_stop', senders_email, identifier)
 
         logging.info(f"User '{senders_email}' stopped the server '{identifier}'.")
         return True
@@ -0,0 +1,308 @@
+from toolbox.pylog import pylog
+import ctypes.util
+import threading
+import ctypes
+import select
+import struct
+import time
+import os
+
+logging = pylog('logs/rose_%TIMENOW%.log')
+
+# How often to check for changes when inotify is not available.
+poll_interval = float(os.environ.get('STORAGE_WATCH_POLL_INTERVAL', 1))
+# How long to wait after a change for more to arrive, so a burst of writes only fires callbacks once.
+settle_delay = 0.05
+
+class inotify:
+    '''
+    A small ctypes wrapper around Linux's inotify, so we can be told when files change instead of re-reading them.
+    Raises OSError on creation if inotify is not available (such as on Windows or macOS).
+    '''
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    IN_NONBLOCK = os.O_NONBLOCK if hasattr(os, 'O_NONBLOCK') else 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    # Everything that means a file in a directory was written, replaced, created or removed.
+    CHANGES = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError("libc could not be found.")
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify is not supported on this system.")
+
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = self.libc.inotify_init1(inotify.IN_NONBLOCK | inotify.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path:str, mask:int=CHANGES) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def remove_watch(self, wd:int) -> None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout:float=None) -> list:
+        '''
+        Waits up to timeout seconds for events.
+        :return: A list of (watch descriptor, mask, cookie, name) tuples. Empty if nothing happened.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + inotify.event_header.size <= len(buffer):
+            wd, mask, cookie, length = inotify.event_header.unpack_from(buffer, offset)
+            offset += inotify.event_header.size
+            name = buffer[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def _ignored(name:str) -> bool:
+    '''
+    Lock files (taken around every read and write) and the temporary files writes are made in never change a key.
+    '''
+    from toolbox.storage import lock_suffix
+    return name.endswith(lock_suffix) or (name.startswith('.') and name.endswith('.tmp'))
+
+class watch:
+    '''
+    A subscription made with var.watch(). Call cancel() to stop being told about changes.
+    '''
+    def __init__(self, file, key_prefix:str, callback, targets:list, value):
+        self.file = file
+        self.key_prefix = key_prefix
+        self.callback = callback
+        # (directory, file names, recursive) for everything whose changes could change the key.
+        self.targets = targets
+        self.value = value
+        self.active = True
+
+    def matches(self, directory:str, name:str) -> bool:
+        for target_dir, names, recursive in self.targets:
+            if recursive:
+                if (directory == target_dir or directory.startswith(target_dir + os.sep)) and not _ignored(name):
+                    return True
+            elif directory == target_dir and (name in names or name == ''):
+                return True
+        return False
+
+    def cancel(self) -> None:
+        watcher.remove(self)
+
+class watcher:
+    '''
+    Runs one background thread per process that watches the directories var files live in, and calls
+    the callbacks of any watch whose key changed. Uses inotify when it can, otherwise stats the files
+    every STORAGE_WATCH_POLL_INTERVAL seconds.
+    '''
+    pid = None
+    lock = threading.Lock()
+    subscriptions = []
+    thread = None
+    notifier = None
+    # Directory -> watch descriptor, and the reverse.
+    watched_dirs = {}
+    watched_wds = {}
+    # Directory -> whether its sub-directories are watched too.
+    recursive_dirs = {}
+    # Stat signatures of everything watched, for when we are polling.
+    poll_signatures = {}
+
+    def add(subscription:watch) -> watch:
+        with watcher.lock:
+            watcher._reset_after_fork()
+            watcher.subscriptions.append(subscription)
+            for directory, _, recursive in subscription.targets:
+                watcher._watch_dir(directory, recursive)
+            if subscription.targets and watcher.notifier is None:
+                watcher.poll_signatures.update(watcher._signatures(subscription))
+
+            if watcher.thread is None or not watcher.thread.is_alive():
+                watcher.thread = threading.Thread(target=watcher._run, name='var watcher', daemon=True)
+                watcher.thread.start()
+        return subscription
+
+    def remove(subscription:watch) -> None:
+        with watcher.lock:
+            subscription.active = False
+            if subscription in watcher.subscriptions:
+                watcher.subscriptions.remove(subscription)
+
+    def _reset_after_fork() -> None:
+        # Watches belong to the process that made them. A forked child starts with none.
+        if watcher.pid == os.getpid():
+            return
+        watcher.pid = os.getpid()
+        watcher.subscriptions = []
+        watcher.thread = None
+        watcher.watched_dirs = {}
+        watcher.watched_wds = {}
+        watcher.recursive_dirs = {}
+        watcher.poll_signatures = {}
+        try:
+            watcher.notifier = inotify()
+        except OSError:
+            watcher.notifier = None
+            logging.info(f"inotify is not available, var.watch will poll every {poll_interval} seconds.")
+
+    def _watch_dir(directory:str, recursive:bool) -> None:
+        os.makedirs(directory, exist_ok=True)
+        if recursive:
+            watcher.recursive_dirs[directory] = True
+
+        if watcher.notifier is not None and directory not in watcher.watched_dirs:
+            wd = watcher.notifier.add_watch(directory)
+            watcher.watched_dirs[directory] = wd
+            watcher.watched_wds[wd] = directory
+
+        if recursive:
+            for entry in os.scandir(directory):
+                if entry.is_dir():
+                    watcher._watch_dir(entry.path, True)
+
+    def _signatures(subscription:watch) -> dict:
+        '''
+        Stats everything a subscription depends on. Only used when polling.
+        '''
+        signatures = {}
+        for directory, names, recursive in subscription.targets:
+            for root, dirs, files in (os.walk(directory) if recursive else [(directory, [], os.listdir(directory))]):
+                for name in files:
+                    if (names is not None and name not in names) or _ignored(name):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    signatures[path] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return signatures
+
+    def _changed_paths() -> list:
+        '''
+        Blocks until something changes (or a poll interval passes).
+        :return: A list of (directory, file name) that changed.
+        '''
+        if watcher.notifier is not None:
+            changed = []
+            for wd, mask, _, name in watcher.notifier.read_events(timeout=poll_interval):
+                if mask & inotify.IN_Q_OVERFLOW:
+                    # Too many events to keep up with. Treat everything as changed.
+                    return [(directory, '') for directory in list(watcher.watched_dirs)]
+                directory = watcher.watched_wds.get(wd)
+                if directory is None:
+                    continue
+                if mask & inotify.IN_IGNORED:
+                    # The directory itself is gone.
+                    with watcher.lock:
+                        watcher.watched_dirs.pop(directory, None)
+                        watcher.watched_wds.pop(wd, None)
+                    continue
+                if mask & inotify.IN_ISDIR and mask & inotify.IN_CREATE and watcher.recursive_dirs.get(directory):
+                    with watcher.lock:
+                        watcher._watch_dir(os.path.join(directory, name), True)
+                changed.append((directory, name))
+            return changed
+
+        time.sleep(poll_interval)
+        with watcher.lock:
+            subscriptions = list(watcher.subscriptions)
+        signatures = {}
+        for subscription in subscriptions:
+            signatures.update(watcher._signatures(subscription))
+
+        changed = []
+        for path in set(signatures) | set(watcher.poll_signatures):
+            if signatures.get(path) != watcher.poll_signatures.get(path):
+                changed.append((os.path.dirname(path), os.path.basename(path)))
+        watcher.poll_signatures = signatures
+        return changed
+
+    def _run() -> None:
+        while True:
+            try:
+                changed = watcher._changed_paths()
+                if not changed:
+                    continue
+
+                # Let a burst of writes finish so the callbacks fire once for all of it.
+                time.sleep(settle_delay)
+                if watcher.notifier is not None:
+                    changed += watcher._changed_paths_nowait()
+
+                with watcher.lock:
+                    subscriptions = list(watcher.subscriptions)
+                for subscription in subscriptions:
+                    if any(subscription.matches(directory, name) for directory, name in changed):
+                        watcher._check(subscription)
+            except Exception as err:
+                logging.error("The var watcher ran into an error.", err)
+                time.sleep(poll_interval)
+
+    def _changed_paths_nowait() -> list:
+        changed = []
+        for wd, _, _, name in watcher.notifier.read_events(timeout=0):
+            directory = watcher.watched_wds.get(wd)
+            if directory is not None:
+                changed.append((directory, name))
+        return changed
+
+    def _check(subscription:watch) -> None:
+        '''
+        Re-reads the watched key and calls the callback if its value is different from last time.
+        '''
+        from toolbox.storage import var
+
+        try:
+            # Checked first, as var.get logs a missing key as an error and a watched key may not exist yet.
+            if var.exists(subscription.key_prefix, file=subscription.file):
+                value = var.get(subscription.key_prefix, file=subscription.file, dt_default=None)
+            else:
+                value = None
+        except (KeyError, FileNotFoundError):
+            value = None
+
+        if value == subscription.value or subscription.active is False:
+            return
+        subscription.value = value
+
+        try:
+            subscription.callback(subscription.key_prefix, value)
+        except Exception as err:
+            logging.error(f"A var.watch callback for '{subscription.key_prefix}' raised an error.", err)
+
+if __name__ == "__main__":
+    print("Do not run this file directly.")